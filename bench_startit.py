@@ -0,0 +1,485 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for the stages of a Startit crawl: retrieving and parsing the page,
+extracting divs, extracting jobs, turning them into rows, diffing them against
+the database, and writing new jobs. iter_jobs times fetching, parsing and
+extracting end to end, which is the only way the stream backend works.
+
+Pages are served by a local mock HTTP handler, so no network is involved. The
+fixture used by the tests is replayed if present, along with generated
+listings of the given sizes:
+
+    python bench_startit.py --sizes 100 1000 10000 50000 --json bench.json
+    python bench_startit.py --compare bench.json
+
+Each stage is timed on its own, `--repeat` times, and the median is reported
+with ops/sec (ads per second) and peak memory, measured by tracemalloc in a
+separate run so that it does not skew the timings.
+
+Parsing batches of pages in worker processes (see StartitBatchParser) is
+benchmarked with `--processes`, against parsing them in this process:
+
+    python bench_startit.py --sizes 1000 --processes 1 2 4 8 --batch 32
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import platform
+import tempfile
+import tracemalloc
+
+from io import BytesIO
+from collections import OrderedDict
+from argparse import ArgumentParser
+from email.message import Message
+from urllib.request import addinfourl
+from urllib.request import build_opener
+from urllib.request import install_opener
+from urllib.request import HTTPSHandler
+from urllib.error import HTTPError
+
+from startit import Startit
+from startit import StartitStorage
+from startit import StartitBatchParser
+from startit import parse_page_jobs
+
+BENCH_URL = 'https://startit.rs/poslovi/pretraga/bench/'
+
+FIXTURE = 'example_page_python.html'
+
+STAGES = (
+    'retrieve_page',
+    'extract_divs',
+    'extract_jobs',
+    'turn_jobs_into_tuples',
+    'iter_jobs',
+    'diff',
+    'write',
+)
+
+# Share of premium and standard ads in generated listings, the rest are mini.
+PREMIUM_SHARE = 0.1
+STANDARD_SHARE = 0.3
+
+# Share of jobs which change between the stored and the benchmarked crawl.
+CHURN = 0.1
+
+WORDS = (
+    'Python', 'Java', 'Senior', 'Junior', 'Backend', 'Frontend', 'Data',
+    'DevOps', 'Developer', 'Engineer', 'QA', 'Mobile', 'Lead', 'Cloud',
+)
+
+TAGS = (
+    'python', 'django', 'java', 'spring', 'javascript', 'react', 'sql',
+    'docker', 'aws', 'linux', 'Beograd', 'Novi Sad', 'Niš', 'remote',
+)
+
+
+class BenchHttpHandler(HTTPSHandler):
+    """
+    Serve registered pages from memory.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.pages = {}
+
+    def https_open(self, request):
+        url = request.get_full_url()
+        if url not in self.pages:
+            raise HTTPError(url, 404, 'Not Found', Message(), None)
+        response = addinfourl(BytesIO(self.pages[url]), Message(), url)
+        response.code = 200
+        response.msg = 'OK'
+        return response
+
+
+def sponsored_ad(i, kind, rnd):
+    """
+    Markup of a premium or standard ad.
+    """
+    tags = ''.join(
+        '<small><a href="/t/%d">%s</a></small>' % (n, tag)
+        for n, tag in enumerate(rnd.sample(TAGS, rnd.randint(1, 5)))
+    )
+    return (
+        '<div class="listing-oglas-%(kind)s">'
+        '<div class="listing-oglas-%(kind)s-logo"><img src="/logo/%(i)d.png"></div>'
+        '<div class="listing-oglas-%(kind)s-text">'
+        '<h1><a href="https://startit.rs/poslovi/%(kind)s-%(i)d/"> %(title)s </a></h1>'
+        '<div><a href="https://startit.rs/poslodavci/%(i)d/">Company %(i)d</a></div>'
+        '%(tags)s</div></div>\n'
+    ) % {
+        'kind': kind, 'i': i, 'tags': tags,
+        'title': ' '.join(rnd.sample(WORDS, 3)),
+    }
+
+
+def mini_ad(i, rnd):
+    tags = ''.join(
+        '<small><a href="#">%s</a></small>' % tag
+        for tag in rnd.sample(TAGS, rnd.randint(1, 3))
+    )
+    return (
+        '<div class="oglas-mini">'
+        '<h1><a href="https://startit.rs/poslovi/mini-%(i)d/">%(title)s</a></h1>'
+        '<div> Company %(i)d </div>'
+        '<div class="oglas-mini-tagovi">%(tags)s</div></div>\n'
+    ) % {'i': i, 'tags': tags, 'title': ' '.join(rnd.sample(WORDS, 2))}
+
+
+def synthetic_page(ads, seed=0):
+    """
+    Return a listing page with the given number of ads, as bytes. The same
+    seed always gives the same page.
+    """
+    rnd = random.Random(seed)
+    premium = int(ads * PREMIUM_SHARE)
+    standard = int(ads * STANDARD_SHARE)
+
+    body = []
+    for i in range(ads):
+        if i < premium:
+            body.append(sponsored_ad(i, 'premium', rnd))
+        elif i < premium + standard:
+            body.append(sponsored_ad(i, 'standard', rnd))
+        else:
+            body.append(mini_ad(i, rnd))
+
+    return (
+        '<!DOCTYPE html><html><head><meta charset="utf-8">'
+        '<title>Poslovi</title></head><body><div id="poslovi">%s</div>'
+        '</body></html>' % ''.join(body)
+    ).encode('utf-8')
+
+
+def previous_rows(rows):
+    """
+    Return rows of the crawl stored before the benchmarked one: a share of
+    the jobs has expired since, and as many new ones showed up.
+    """
+    churn = int(len(rows) * CHURN)
+    expired = [
+        ('Company', 'Expired job', 'https://startit.rs/poslovi/expired-%d/' % i, '[]')
+        for i in range(churn)
+    ]
+    return expired + list(rows[churn:])
+
+
+class StartitBenchmark(object):
+    """
+    Time each stage of a crawl of a single page, for a given backend.
+    """
+
+    def __init__(self, handler, name, body, backend='soup', repeat=5):
+        self.handler = handler
+        self.name = name
+        self.body = body
+        self.backend = backend
+        self.repeat = repeat
+        self.tmpdir = None
+        self.ads = 0
+        self.done = None
+
+        handler.pages[BENCH_URL] = body
+
+    def spider(self):
+        return Startit(BENCH_URL, 'bench@example.com', self.backend)
+
+    def spider_at(self, stage):
+        """
+        Return a spider with every stage before the given one done. Results
+        of earlier stages are computed once and shared, since later stages
+        do not change them.
+        """
+        spider = self.spider()
+        if stage in ('retrieve_page', 'iter_jobs'):
+            return spider
+        if self.done is None:
+            self.done = self.spider()
+            self.done.extract_divs()
+            self.done.extract_jobs()
+        spider.page = self.done.page
+        if stage == 'extract_divs':
+            return spider
+        spider.raw_data = self.done.raw_data
+        if stage == 'extract_jobs':
+            return spider
+        spider.jobs = self.done.jobs
+        return spider
+
+    def storage_at(self):
+        """
+        Return a fresh database holding the previous crawl, and rows of the
+        current one.
+        """
+        rows = list(self.spider_at('turn_jobs_into_tuples').turn_jobs_into_tuples())
+        path = os.path.join(self.tmpdir, 'bench.db')
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+
+        storage = StartitStorage(path)
+        storage.insert_jobs(previous_rows(rows), 1, BENCH_URL)
+        return storage, rows
+
+    def setup(self, stage):
+        if stage in ('diff', 'write'):
+            return self.storage_at()
+        return self.spider_at(stage)
+
+    def run(self, stage, state):
+        """
+        Run the stage, and return the seconds spent in it.
+        """
+        if stage == 'retrieve_page':
+            start = time.perf_counter()
+            state.page
+            return time.perf_counter() - start
+        if stage == 'extract_divs':
+            start = time.perf_counter()
+            state.extract_divs()
+            return time.perf_counter() - start
+        if stage == 'extract_jobs':
+            start = time.perf_counter()
+            state.extract_jobs()
+            return time.perf_counter() - start
+        if stage == 'turn_jobs_into_tuples':
+            start = time.perf_counter()
+            list(state.turn_jobs_into_tuples())
+            return time.perf_counter() - start
+        if stage == 'iter_jobs':
+            start = time.perf_counter()
+            for _ in state.iter_jobs():
+                pass
+            return time.perf_counter() - start
+
+        storage, rows = state
+        try:
+            start = time.perf_counter()
+            storage.stage(rows)
+            with storage.transaction() as c:
+                storage.deactivate_unstaged(c, BENCH_URL)
+                storage.update_staged(c, BENCH_URL)
+                storage.new_staged(c, BENCH_URL)
+                diffed = time.perf_counter()
+                storage.insert_new_staged(c, BENCH_URL)
+            written = time.perf_counter()
+        finally:
+            storage.close()
+        if stage == 'diff':
+            return diffed - start
+        return written - diffed
+
+    def measure(self, stage):
+        timings = []
+        for _ in range(self.repeat):
+            timings.append(self.run(stage, self.setup(stage)))
+        timings.sort()
+
+        state = self.setup(stage)
+        tracemalloc.start()
+        try:
+            self.run(stage, state)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+        median = timings[len(timings) // 2]
+        return {
+            'seconds': median,
+            'min-seconds': timings[0],
+            'ops-per-sec': self.ads / median if median else None,
+            'peak-bytes': peak,
+        }
+
+    def bench(self, stages=STAGES):
+        self.tmpdir = tempfile.mkdtemp(prefix='startit-bench-')
+        try:
+            self.ads = len(self.spider_at('extract_jobs').raw_data)
+            results = OrderedDict()
+            for stage in stages:
+                results[stage] = self.measure(stage)
+        finally:
+            shutil.rmtree(self.tmpdir)
+            self.tmpdir = None
+            self.done = None
+
+        return {
+            'page': self.name,
+            'backend': self.backend,
+            'ads': self.ads,
+            'bytes': len(self.body),
+            'stages': results,
+        }
+
+
+def bench_pages(sizes):
+    """
+    Yield (name, body) of pages to benchmark.
+    """
+    if os.path.exists(FIXTURE):
+        with open(FIXTURE, 'rb') as f:
+            yield 'fixture', f.read()
+    for size in sizes:
+        yield 'synthetic-%d' % size, synthetic_page(size)
+
+
+def run_benchmarks(sizes, backends=('soup', 'lxml'), repeat=5, stages=STAGES):
+    """
+    Benchmark every page with every backend, and return the report.
+    """
+    handler = BenchHttpHandler()
+    install_opener(build_opener(handler))
+
+    results = []
+    for name, body in bench_pages(sizes):
+        for backend in backends:
+            benchmark = StartitBenchmark(handler, name, body, backend, repeat)
+            results.append(benchmark.bench(stages))
+            print_result(results[-1])
+
+    return {
+        'created': time.time(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'repeat': repeat,
+        'results': results,
+    }
+
+
+def bench_batch(sizes, processes, backend='lxml', batch=16, repeat=3):
+    """
+    Time parsing a batch of pages in this process, then in pools of each
+    number of processes. Pools are started before they are timed.
+    """
+    results = []
+    for size in sizes:
+        pages = [(BENCH_URL, synthetic_page(size, seed)) for seed in range(batch)]
+
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            for url, body in pages:
+                parse_page_jobs(url, body, backend)
+            timings.append(time.perf_counter() - start)
+        baseline = sorted(timings)[len(timings) // 2]
+        results.append(batch_result(size, batch, backend, 0, baseline, baseline))
+
+        for workers in processes:
+            with StartitBatchParser(workers, backend) as parser:
+                parser.parse(pages[:workers])
+                timings = []
+                for _ in range(repeat):
+                    start = time.perf_counter()
+                    parser.parse(pages)
+                    timings.append(time.perf_counter() - start)
+            median = sorted(timings)[len(timings) // 2]
+            results.append(
+                batch_result(size, batch, backend, workers, median, baseline)
+            )
+    return results
+
+
+def batch_result(size, batch, backend, processes, seconds, baseline):
+    result = OrderedDict([
+        ('page', 'synthetic-%d' % size),
+        ('pages', batch),
+        ('backend', backend),
+        ('processes', processes),
+        ('seconds', seconds),
+        ('pages-per-sec', batch / seconds),
+        ('ops-per-sec', batch * size / seconds),
+        ('speedup', baseline / seconds),
+    ])
+    print('%s x %d, %s backend, %s: %8.3f s %10.0f ops/s %6.2fx' % (
+        result['page'], batch, backend,
+        '%d processes' % processes if processes else 'in process',
+        seconds, result['ops-per-sec'], result['speedup']
+    ))
+    sys.stdout.flush()
+    return result
+
+
+def print_result(result, baseline=None):
+    print('%s (%d ads, %d bytes), %s backend' % (
+        result['page'], result['ads'], result['bytes'], result['backend']
+    ))
+    for stage, measured in result['stages'].items():
+        line = '  %-22s %10.4f s %12.0f ops/s %10.1f KiB' % (
+            stage, measured['seconds'], measured['ops-per-sec'] or 0,
+            measured['peak-bytes'] / 1024
+        )
+        if baseline and stage in baseline['stages']:
+            before = baseline['stages'][stage]['seconds']
+            if before:
+                line += ' %+7.1f%%' % ((measured['seconds'] - before) / before * 100)
+        print(line)
+    sys.stdout.flush()
+    return
+
+
+def compare(report, baseline):
+    """
+    Print results of the report next to changes against the baseline.
+    """
+    previous = {
+        (result['page'], result['backend']): result
+        for result in baseline['results']
+    }
+    for result in report['results']:
+        print_result(result, previous.get((result['page'], result['backend'])))
+    return
+
+
+def parse_arguments():
+    parser = ArgumentParser(description='Benchmark stages of a Startit crawl.')
+    parser.add_argument(
+        '--sizes', type=int, nargs='+', default=[100, 1000, 10000, 50000],
+        help='numbers of ads in generated pages'
+    )
+    parser.add_argument(
+        '--backends', nargs='+', choices=Startit.BACKENDS,
+        default=list(Startit.BACKENDS), help='extraction backends to benchmark'
+    )
+    parser.add_argument(
+        '--stages', nargs='+', choices=STAGES, default=list(STAGES),
+        help='stages to benchmark'
+    )
+    parser.add_argument(
+        '--repeat', type=int, default=5, help='timed runs of each stage'
+    )
+    parser.add_argument(
+        '--processes', type=int, nargs='+', default=[],
+        help='benchmark batch parsing with these numbers of processes'
+    )
+    parser.add_argument(
+        '--batch', type=int, default=16,
+        help='pages in a batch, when benchmarking batch parsing'
+    )
+    parser.add_argument('--json', help='save results to this JSON file')
+    parser.add_argument(
+        '--compare', help='JSON results of an earlier run to compare against'
+    )
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+
+    report = run_benchmarks(args.sizes, args.backends, args.repeat, args.stages)
+    if args.processes:
+        report['batch'] = bench_batch(
+            args.sizes, args.processes, args.backends[0], args.batch, args.repeat
+        )
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        print('\nCompared to %s:' % args.compare)
+        compare(report, baseline)
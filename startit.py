@@ -15,82 +15,371 @@ startit.extract_divs()
 startit.extract_jobs()
 
 startit.check_and_notify()
+startit.close()
+```
+
+Jobs from every page of results can also be streamed straight into the
+database, without collecting them first:
+
+```python
+startit.check_and_notify(startit.iter_jobs())
+```
+
+How to crawl several categories at once?
+
+```python
+from startit import StartitCrawler
+crawler = StartitCrawler([
+    'https://startit.rs/poslovi/pretraga/python/',
+    'https://startit.rs/poslovi/pretraga/django/',
+], 'email@example.com')
+
+crawler.db_path = db_path
+crawler.config_path = config_path
+
+crawler.run()
+```
+
+How to find out where the time of a run goes?
+
+```python
+from startit import StartitMetrics, StartitPrometheusTextfile
+crawler.metrics = StartitMetrics([StartitPrometheusTextfile('startit.prom')])
+crawler.run()
 ```
 """
 
 
 import os
 import re
+import ssl
+import sys
+import gzip
+import zlib
 import json
+import math
+import hashlib
 import sqlite3
 import smtplib
+import time
+import heapq
+import queue
+import random
+import signal
+import tarfile
+import logging
+import threading
+import http.client
+from io import BytesIO
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from datetime import datetime
 from argparse import ArgumentParser
 from urllib.request import Request
 from urllib.request import urlopen
+from urllib.parse import urlparse
+from urllib.parse import urljoin
+from urllib.parse import urlsplit
+from urllib.parse import parse_qs
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
 from urllib.error import HTTPError
 from urllib.error import URLError
 from bs4 import BeautifulSoup
+from bs4 import UnicodeDammit
+from lxml import etree
 from collections import OrderedDict
 from collections import deque
+from contextlib import contextmanager
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import Future
 
 
 __version__ = 'v0.1.0'
 __status__ = 'Development'
 
 
+log = logging.getLogger('startit')
+
+# Stands in for stage timers of spiders which are not instrumented.
+NO_TIMING = nullcontext()
+
+
 def parse_arguments():
     """
     Example:
 
     startit.py https://startit.rs/poslovi/pretraga/python/ example@mail.com
 
+    Several categories can be crawled in a single run:
+
+    startit.py https://startit.rs/poslovi/pretraga/python/ \
+        https://startit.rs/poslovi/pretraga/django/ example@mail.com
+
     For more information type:
 
     crawlddit.py --help
+
+    To keep polling categories every 10 minutes:
+
+    startit.py --daemon --interval 600 \
+        https://startit.rs/poslovi/pretraga/python/ example@mail.com
     """
     parser = ArgumentParser(description='startit job crawler')
 
-    parser.add_argument('URL', help='source link')
+    parser.add_argument('URL', nargs='+', help='source link(s)')
     parser.add_argument('email', help='Email receiving notifications')
     parser.add_argument('database', help='Path to the database')
     parser.add_argument('config', help='Path to configuration file')
+    parser.add_argument(
+        '--workers', type=int, default=8,
+        help='Number of pages fetched concurrently'
+    )
+    parser.add_argument(
+        '--per-host', type=int, default=2,
+        help='Number of concurrent requests allowed per host'
+    )
+    parser.add_argument(
+        '--backend', choices=Startit.BACKENDS, default='soup',
+        help='Extraction backend'
+    )
+    parser.add_argument(
+        '--processes', type=int, default=0,
+        help='Number of processes parsing pages, instead of the fetching threads'
+    )
+    parser.add_argument(
+        '--low-memory', action='store_true',
+        help='Release document trees as soon as jobs are extracted'
+    )
+    parser.add_argument(
+        '--serve', type=int, default=None, metavar='PORT',
+        help='Answer queries over the jobs database as JSON on this port'
+    )
+    parser.add_argument(
+        '--serve-host', default='127.0.0.1',
+        help='Address the query service listens on'
+    )
+    parser.add_argument(
+        '--backfill', default=None,
+        help='Load archived pages of the categories from this directory or tarball'
+    )
+    parser.add_argument(
+        '--daemon', action='store_true',
+        help='Keep running, and poll categories periodically'
+    )
+    parser.add_argument(
+        '--interval', type=float, default=900,
+        help='Seconds between polls of a category, in daemon mode'
+    )
+    parser.add_argument(
+        '--jitter', type=float, default=0.1,
+        help='Random variation of the interval, as a fraction of it'
+    )
+    parser.add_argument(
+        '--min-interval', type=float, default=None,
+        help='Shortest interval a busy category is polled at'
+    )
+    parser.add_argument(
+        '--max-interval', type=float, default=None,
+        help='Longest interval a quiet category is polled at'
+    )
+    parser.add_argument(
+        '--digest-window', type=float, default=0,
+        help='Seconds new jobs are collected for before an email is sent'
+    )
+    parser.add_argument(
+        '--connect-timeout', type=float, default=10,
+        help='Seconds to wait for a connection to be established'
+    )
+    parser.add_argument(
+        '--timeout', type=float, default=30,
+        help='Seconds to wait for a response, or for more of its body'
+    )
+    parser.add_argument(
+        '--retries', type=int, default=3,
+        help='Times a failed request is retried, with exponential backoff'
+    )
+    parser.add_argument(
+        '--details', action='store_true',
+        help='Fetch detail pages of new jobs'
+    )
+    parser.add_argument(
+        '--detail-workers', type=int, default=4,
+        help='Number of detail pages fetched concurrently'
+    )
+    parser.add_argument(
+        '--detail-rate', type=float, default=1.0,
+        help='Detail pages fetched per second, per host'
+    )
+    parser.add_argument(
+        '--bloom', type=int, default=0,
+        help='Keep postings handled so far in a Bloom filter sized for this many'
+    )
+    parser.add_argument(
+        '--cache', default=None,
+        help='Directory keeping responses, to process pages again without fetching them'
+    )
+    parser.add_argument(
+        '--cache-size', type=float, default=256,
+        help='Size the response cache is kept under, in MiB'
+    )
+    parser.add_argument(
+        '--offline', action='store_true',
+        help='Serve every page from the response cache'
+    )
+    parser.add_argument(
+        '--metrics-json', default=None,
+        help='Append timings and counters of each run to this file, as JSON'
+    )
+    parser.add_argument(
+        '--metrics-textfile', default=None,
+        help='Write timings and counters of the last run to this Prometheus textfile'
+    )
 
     args = parser.parse_args()
-
-    return (args.URL, args.email, args.database, args.config)
+    if args.offline and not args.cache:
+        parser.error('--offline requires --cache')
+    return args
 
 
 class Startit(object):
-    DB_TEMPLATE = """
-        DROP TABLE IF EXISTS jobs;
+    # Safety net against pagination loops, in case the site misbehaves.
+    MAX_PAGES = 100
 
-        CREATE TABLE jobs (
-          CompanyTitle TEXT,
-          JobTitle TEXT,
-          Url TEXT,
-          Tags BLOB,
-          Active TEXT,
-          FirstCrawled TEXT
-         );
-    """
+    USER_AGENT = 'Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:55.0) Gecko/20100101 Firefox/55.0'
+
+    # Extraction backends. 'soup' works on the BeautifulSoup tree, 'lxml' does
+    # a single pass over the lxml tree (see StartitLxmlBackend), 'stream'
+    # extracts jobs while the page downloads (see StartitStreamBackend).
+    BACKENDS = ('soup', 'lxml', 'stream')
+
+    # Bytes read from the response at a time, when streaming.
+    CHUNK_SIZE = 16 * 1024
 
-    def __init__(self, url, email):
+    # Seconds a request may block, when no HTTP client is set.
+    TIMEOUT = 30
+
+    def __init__(self, url, email, backend='soup'):
         """
         Initiate Startit object.
         """
         self.url = self.sanitize(url)
         self.email = email
 
+        if backend not in self.BACKENDS:
+            raise StartitException('Unknown extraction backend!')
+        self.backend = backend
+        if backend == 'stream':
+            self.lxml = StartitStreamBackend()
+        else:
+            self.lxml = StartitLxmlBackend() if backend == 'lxml' else None
+        # Pages are parsed by this batch parser's processes, if set.
+        self.batch = None
+        # The first page, requested by changed() ahead of iter_jobs: chunks
+        # of it when streaming (see open_stream), its body when parsing in
+        # a batch parser.
+        self.first = None
+        self.requested = False
+        # In low-memory mode, the document tree is released as soon as jobs
+        # are extracted from it, divs are dropped once extracted, and strings
+        # repeated across jobs are interned.
+        self.low_memory = False
+        self.released = False
+
         self.db_path = None
         self.config_path = None
+        self.storage = None
+        # Applies crawls, and writes validators and details, instead of the
+        # storage, if set. See StartitWriter.
+        self.writer = None
+        self.notifier = None
+        # Routes new jobs to subscribers (see StartitRouter), in addition to
+        # the email the spider was created with.
+        self.router = None
+        # Fetches detail pages of new jobs (see StartitDetailFetcher).
+        self.details = None
+        # Postings handled by other categories, which are not handled again
+        # (see StartitSeenIndex).
+        self.seen = None
+        # Keeps responses on disk (see StartitResponseCache).
+        self.cache = None
+        # Keeps connections alive between requests (see StartitHTTPClient).
+        # Without it, every request opens a new connection through urlopen.
+        self.client = None
+
+        # Limits concurrent requests when several spiders share a host. See
+        # StartitCrawler.
+        self.throttle = None
+
+        # If set, the first page is requested conditionally, and it is None
+        # when it has not changed since the previous crawl.
+        self.conditional = True
+        self.unchanged = False
+        self.validators = None
 
-        self.page = self.retrieve_page()
+        self.stats = {
+            'pages' : 0,
+            'bytes' : 0,
+            'skipped' : False,
+            # Set if crawling the category failed (see StartitCrawler).
+            'failed' : False,
+            StartitJobTypes.PREMIUM : 0,
+            StartitJobTypes.STANDARD : 0,
+            StartitJobTypes.MINI : 0,
+            'new' : 0,
+            'expired' : 0,
+            'updated' : 0,
+            'duplicates' : 0,
+            'rows' : 0,
+            'emails' : 0,
+        }
+        # Seconds spent in each stage, kept only if the spider is watched by
+        # StartitMetrics.
+        self.metrics = None
+        self.timings = None
+
+        self._page = None
         self.raw_data = deque()
         self.jobs = deque()
 
+    @property
+    def page(self):
+        """
+        Page with job listing. It is retrieved on first access, so that the
+        spider can be configured (or handed to a worker thread) before any
+        network traffic takes place.
+
+        The page is None if it has not changed since the last crawl, or once
+        it is released in low-memory mode.
+        """
+        if self._page is None and not self.unchanged and not self.released:
+            self._page = self.retrieve_page(conditional=self.conditional)
+        return self._page
+
+    @page.setter
+    def page(self, page):
+        self._page = page
+
+    def release_page(self):
+        """
+        Drop the first page's tree, without fetching it again on the next
+        access to page.
+        """
+        self._page = None
+        self.released = True
+        return
+
+    def timer(self, stage):
+        """
+        Return a context manager adding the time spent in the block to the
+        stage. It does nothing unless the spider is instrumented.
+        """
+        if self.timings is None:
+            return NO_TIMING
+        return self.timings.measure(stage)
+
     def read_sensitive_data(self):
         """
         Read in data from the configuration file.
@@ -119,209 +408,556 @@ class Startit(object):
             return url
         raise StartitException('Invalid link.')
 
-    def retrieve_page(self, parser='lxml'):
+    def retrieve_page(self, parser='lxml', conditional=False):
         """
-        Retrieve page with job listing.
+        Retrieve page with job listing. If conditional is set and the page has
+        not changed since the last crawl, return None.
         """
-        return BeautifulSoup(urlopen(
-            Request(
-                self.url,
-                data=None,
-                headers={
-                    'User-Agent' : 'Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:55.0) Gecko/20100101 Firefox/55.0'
-                }
-            )
-        ).read(), parser)
-        # return BeautifulSoup(urlopen(self.url).read(), parser)
-        # add try catch, HTTPError URLError
-        # if anything goes wrong, send email!
+        body = self.fetch_page(self.url, conditional)
+        if body is None:
+            self.unchanged = True
+            return None
+        return self.parse_page(body, parser)
 
-    def check_and_notify(self):
+    def parse_page(self, body, parser='lxml'):
         """
-        Check if there are new jobs, and notify if there are. If the spider is
-        set loose for the first time, just scrape the page, and do not notify.
+        Build the document tree used by the extraction backend.
+        """
+        with self.timer('parse'):
+            if self.lxml is not None:
+                return self.lxml.parse(body)
+            return BeautifulSoup(body, parser)
+
+    def fetch_page(self, url, conditional=False):
         """
-        if self.db_exists(self.db_path):
-            stale_data = self.get_existing_data(self.db_path)
+        Return the raw body of the page. If the throttle is set, the request
+        is made only once the throttle lets it through.
 
-            tup_jobs = self.turn_jobs_into_tuples()
+        If conditional is set, validators from the previous crawl are sent
+        along, and None is returned if the server answers with 304 Not
+        Modified, or if the body hashes the same as the last time. Validators
+        of the response are kept in self.validators until save_validators is
+        called.
 
-            new_jobs = set(tup_jobs).difference(stale_data)
-            expired_jobs = set(stale_data).difference(tup_jobs)
+        If the spider has a response cache, responses are stored in it, and
+        in offline mode every page is served from it.
+        """
+        stored = self.load_validators(url) if conditional else None
+        if self.cache is not None and self.cache.offline:
+            fetched = self.cache.get(url)
+            if fetched is None:
+                raise StartitException('Page is not in the cache: %s' % url)
+        else:
+            fetched = self.download(url, stored)
+            if fetched is None:
+                return None
+        body, etag, last_modified = fetched
 
-            if expired_jobs:
-                self.deactivate_expired_jobs(expired_jobs, self.db_path)
+        self.stats['pages'] += 1
+        if not conditional:
+            return body
 
-            if new_jobs:
-                self.add_new_jobs(new_jobs, self.db_path)
-                self.notify_master_about_new_jobs(new_jobs)
+        digest = hashlib.sha1(
+            body.encode('utf-8') if isinstance(body, str) else body
+        ).hexdigest()
+        if stored and stored['hash'] == digest:
+            return None
 
-            return
+        self.validators = (url, etag, last_modified, digest)
+        return body
+
+    def download(self, url, stored=None):
+        """
+        Download the page, and return its body, ETag and Last-Modified.
+
+        Validators stored by the previous crawl are sent along if given, and
+        None is returned if the page has not changed. Otherwise validators of
+        the cached response are sent, and the cached response is returned if
+        it is still fresh. Its body is read from the cache only then.
+        """
+        cached = None
+        if stored is None and self.cache is not None:
+            cached = self.cache.validators(url)
+        request = self.page_request(url, stored or cached)
+        try:
+            with self.timer('fetch'):
+                if self.throttle is None:
+                    response = self.open_url(request)
+                    body = response.read()
+                else:
+                    with self.throttle:
+                        response = self.open_url(request)
+                        body = response.read()
+        except HTTPError as e:
+            if e.code == 304 and stored:
+                return None
+            if e.code == 304 and cached:
+                fetched = self.cache.get(url)
+                if fetched is not None:
+                    return fetched
+                # The body was evicted since, so fetch it again.
+                return self.download(url, stored)
+            raise
 
-        self.execute_first_time_scarping(self.db_path)
-        self.send_welcome_email()
+        self.stats['bytes'] += len(body)
+        info = response.info()
+        etag, last_modified = info.get('ETag'), info.get('Last-Modified')
+        if self.cache is not None:
+            self.cache.put(url, body, etag, last_modified)
+        return body, etag, last_modified
+
+    def open_url(self, request):
+        """
+        Send the request through the spider's HTTP client, or urlopen if it
+        has none, and return the response.
+        """
+        if self.client is not None:
+            return self.client.open(request)
+        return urlopen(request, timeout=self.TIMEOUT)
+
+    def page_request(self, url, validators=None):
+        """
+        Build the request for the page, conditional if validators are given.
+        """
+        headers = {
+            'User-Agent' : self.USER_AGENT
+        }
+        if validators and validators.get('etag'):
+            headers['If-None-Match'] = validators['etag']
+        if validators and validators.get('last-modified'):
+            headers['If-Modified-Since'] = validators['last-modified']
+        return Request(url, data=None, headers=headers)
+
+    def open_stream(self, url, conditional=False):
+        """
+        Request the page, and return an iterator over chunks of its body as
+        they arrive, or None if the page has not changed since the previous
+        crawl. Only the response headers are waited for, and the throttle is
+        held only until then.
+
+        Skipping the page relies on the server's validators: the body's hash
+        is only known once it has been processed. With a response cache, the
+        whole body is fetched first (see fetch_page), then fed in chunks.
+        """
+        if self.cache is not None:
+            body = self.fetch_page(url, conditional)
+            if body is None:
+                return None
+            if isinstance(body, str):
+                body = body.encode('utf-8')
+            return (
+                body[start:start + self.CHUNK_SIZE]
+                for start in range(0, len(body), self.CHUNK_SIZE)
+            )
+
+        stored = self.load_validators(url) if conditional else None
+        request = self.page_request(url, stored)
+        try:
+            with self.timer('fetch'):
+                if self.throttle is None:
+                    response = self.open_url(request)
+                else:
+                    with self.throttle:
+                        response = self.open_url(request)
+        except HTTPError as e:
+            if e.code == 304 and stored:
+                return None
+            raise
+
+        self.stats['pages'] += 1
+        return self.read_chunks(url, response, conditional)
+
+    def read_chunks(self, url, response, conditional=False):
+        """
+        Yield chunks of the response's body. If conditional is set, the
+        validators of the response are kept once it has been read through.
+        """
+        digest = hashlib.sha1()
+        try:
+            while True:
+                with self.timer('fetch'):
+                    chunk = response.read(self.CHUNK_SIZE)
+                if not chunk:
+                    break
+                if isinstance(chunk, str):
+                    chunk = chunk.encode('utf-8')
+                self.stats['bytes'] += len(chunk)
+                digest.update(chunk)
+                yield chunk
+        finally:
+            response.close()
+
+        if conditional:
+            info = response.info()
+            self.validators = (
+                url, info.get('ETag'), info.get('Last-Modified'), digest.hexdigest()
+            )
         return
 
-    def deactivate_expired_jobs(self, expired_jobs, path):
-        conn = sqlite3.connect(path)
-        c = conn.cursor()
+    def changed(self):
+        """
+        Return False if the first page has not changed since the previous
+        crawl. When streaming, the page is only requested, not read; with a
+        batch parser, it is fetched, but not parsed.
+        """
+        if self.backend != 'stream' and self.batch is None:
+            return self.released or self.page is not None
+        if not self.requested:
+            self.requested = True
+            if self.batch is not None:
+                self.first = self.fetch_page(self.url, self.conditional)
+            else:
+                self.first = self.open_stream(self.url, self.conditional)
+            self.unchanged = self.first is None
+        return not self.unchanged
 
-        for job in expired_jobs:
-            c.execute("""
-                UPDATE jobs
-                SET Active=0
-                WHERE CompanyTitle=? AND JobTitle=? AND Url=? AND Tags=?
-            """, (
-                job[0], job[1], job[2], job[3]
-            ))
+    def open_storage(self, path=None):
+        """
+        Return the storage of the jobs database, opening it on first use. One
+        connection is used for the whole run; it can be shared by several
+        spiders (see StartitCrawler).
+        """
+        if self.storage is None:
+            self.storage = StartitStorage(self.db_path if path is None else path)
+        return self.storage
 
-        conn.commit()
-        conn.close()
+    def close(self):
+        """
+        Close the jobs database, the response cache and idle connections, and
+        wait for queued emails to be sent. If the spider is instrumented, the
+        run is then reported.
+        """
+        notifier, client = self.notifier, self.client
+        if self.storage is not None:
+            self.storage.close()
+            self.storage = None
+        if self.cache is not None:
+            self.cache.close()
+            self.cache = None
+        if self.client is not None:
+            self.client.close()
+            self.client = None
+        if self.notifier is not None:
+            self.notifier.close()
+            self.notifier = None
+        if self.metrics is not None:
+            self.metrics.report(notifier, client)
         return
 
-    def add_new_jobs(self, new_jobs, path):
-        conn = sqlite3.connect(path)
-        c = conn.cursor()
+    def load_validators(self, url):
+        """
+        Return validators stored for the url by the previous crawl, or None.
+        """
+        if self.db_path is None:
+            return None
+        with self.timer('sqlite'):
+            return self.open_storage().load_validators(url)
 
-        for job in new_jobs:
-            self.write_a_tuple_to_db(c, job, True)
+    def save_validators(self):
+        """
+        Store validators of the processed page, so that the next crawl can skip
+        it if it does not change. Call this only once the page is processed.
+        """
+        if self.validators is None:
+            return
 
-        conn.commit()
-        conn.close()
+        with self.timer('sqlite'):
+            (self.writer or self.open_storage()).save_validators(self.validators)
+        self.validators = None
         return
 
-    def notify_master_about_new_jobs(self, new_jobs):
-        from_address = self.spidy_mail
-        password = self.spidy_password
-        to_address = self.email
+    def next_page_url(self, page):
+        """
+        Return the link to the next page of results, or None if this is the
+        last page. Only links within the same category are followed.
 
-        msg = MIMEMultipart()
-        msg['From'] = from_address
-        msg['To'] = to_address
-        msg['Subject'] = "Hey, a new job! ::::)"
+        Only the first page is requested conditionally: new postings always
+        show up on top of the listing, so if it did not change, the whole
+        category is skipped. Expired postings further down are picked up with
+        the next change of the first page.
+        """
+        if self.lxml is not None:
+            href = self.lxml.next_page_href(page)
+        else:
+            candidate = page.find('link', attrs={'rel' : 'next'})
+            if candidate is None:
+                candidate = page.find('a', attrs={'class' : 'next'})
+            href = candidate.get('href') if candidate is not None else None
+        if not href:
+            return None
 
-        body = ''
+        url = urljoin(self.url, href)
+        return url if url.startswith(self.url) else None
 
-        for job in new_jobs:
-            body += job[0] + '\n' + job[1] + '\n' + job[2] + '\n' + job[3] + '\n\n'
+    def iter_pages(self):
+        """
+        Yield pages of results one at a time, following pagination. Only the
+        first page is kept on the object, the rest are released as soon as the
+        caller moves on.
+        """
+        page = self.page
+        if page is None:
+            return
+        if self.low_memory:
+            self.release_page()
 
-        msg.attach(MIMEText(body.encode('utf-8'), _charset='utf-8'))
+        seen = {self.url}
+        yield page
 
-        server = smtplib.SMTP('smtp.gmail.com', 587)
-        server.starttls()
-        server.login(from_address, password)
-        text = msg.as_string()
-        server.sendmail(from_address, to_address, text)
-        server.quit()
+        url = self.next_page_url(page)
+        while url and url not in seen and len(seen) < self.MAX_PAGES:
+            seen.add(url)
+            page = self.parse_page(self.fetch_page(url))
+            yield page
+            url = self.next_page_url(page)
         return
 
-    def turn_jobs_into_tuples(self):
-        tup_jobs = []
-        for job in self.jobs:
-            job['tags'] = json.dumps(job['tags'])
-            tup_jobs.append(tuple(job.values()))
-        return tup_jobs
+    def iter_jobs(self):
+        """
+        Yield jobs from all pages of results as they are extracted. Unlike
+        extract_divs/extract_jobs nothing is collected on the object, so the
+        memory used stays the same regardless of the number of pages.
+        """
+        if self.batch is not None:
+            yield from self.iter_batch()
+            return
+        if self.backend == 'stream':
+            yield from self.iter_stream()
+            return
+        for page in self.iter_pages():
+            for packed in self.iter_divs(page):
+                yield self.extract_job(packed)
+        return
 
-    def get_existing_data(self, path):
+    def iter_stream(self):
         """
-        Return all active jobs from the database.
+        Yield jobs from all pages of results as each ad is parsed, while the
+        page is still downloading. Ads are discarded once extracted, so
+        neither the page nor its tree is ever held whole. Jobs come in the
+        order they appear on the page.
         """
-        conn = sqlite3.connect(path)
-        c = conn.cursor()
+        if not self.changed():
+            return
+        chunks, self.first = self.first, None
+        if chunks is None:
+            # The first page was streamed before.
+            chunks = self.open_stream(self.url)
 
-        c.execute('SELECT CompanyTitle, JobTitle, Url, Tags FROM jobs WHERE Active=1')
-        rows = c.fetchall()
+        url = self.url
+        seen = {url}
+        while True:
+            divs = self.lxml.iter_stream(chunks)
+            while True:
+                try:
+                    with self.timer('parse'):
+                        packed = next(divs)
+                except StopIteration as stop:
+                    href = stop.value
+                    break
+                yield self.extract_job(packed)
 
-        conn.close()
-        return rows
+            url = urljoin(self.url, href) if href else None
+            if not url or not url.startswith(self.url) or url in seen \
+                    or len(seen) >= self.MAX_PAGES:
+                return
+            seen.add(url)
+            chunks = self.open_stream(url)
 
-    def execute_first_time_scarping(self, path):
+    def iter_batch(self):
         """
-        Execute this method when the bot is scraping for the first time. Create
-        database and populate it with new jobs.
+        Yield jobs from all pages of results, parsed by the batch parser's
+        processes. Pages are fetched by the calling thread, so several
+        spiders can keep the processes busy.
         """
-        conn = sqlite3.connect(path)
-        c = conn.cursor()
-        c.executescript(self.DB_TEMPLATE)
+        if not self.changed():
+            return
+        body, self.first = self.first, None
+        if body is None:
+            # The first page was parsed before.
+            body = self.fetch_page(self.url)
 
-        for job in self.jobs:
-            self.write_a_record_to_db(c, job, True)
+        seen = {self.url}
+        while True:
+            with self.timer('parse'):
+                jobs, url, ads = self.batch.submit(self.url, body).result()
+            for job_type, count in ads.items():
+                self.stats[job_type] += count
+            if self.low_memory:
+                jobs = [self.compact(job) for job in jobs]
+            yield from jobs
 
-        conn.commit()
-        conn.close()
-        return
+            if not url or url in seen or len(seen) >= self.MAX_PAGES:
+                return
+            seen.add(url)
+            body = self.fetch_page(url)
 
-    def send_welcome_email(self):
+    def check_and_notify(self, jobs=None):
         """
-        When the script is executed for the first time, send greeting email.
+        Check if there are new jobs, and notify if there are. If the spider is
+        set loose for the first time, just scrape the page, and do not notify.
+
+        Jobs can be any iterable (e.g. iter_jobs()), and default to self.jobs.
+
+        If the page did not change since the previous crawl, nothing is done,
+        and stats['skipped'] is set.
         """
-        from_address = self.spidy_mail
-        password = self.spidy_password
-        to_address = self.email
+        if not self.changed():
+            self.stats['skipped'] = True
+            return
 
-        msg = MIMEMultipart()
-        msg['From'] = from_address
-        msg['To'] = to_address
-        msg['Subject'] = "Greetings, it's your itsy bitsy spider /\(00)/\\"
+        jobs = self.jobs if jobs is None else jobs
+        storage = self.open_storage()
+        # The greeting is sent only once, when the database is created.
+        created = storage.claim_created()
 
-        body = """
-        The itsy bitsy spider climbed up the waterspout.
-        Down came the rain
-        and washed the spider out.
-        Out came the sun
-        and dried up all the rain
-        and the itsy bitsy spider climbed up the spout again.
+        # Jobs may be streamed, so fetching and extracting happens in here
+        # too. The timer only counts the database's share. Whether the
+        # category was crawled before is decided with the write, so spiders
+        # sharing a writer see each other's first crawls.
+        with self.timer('sqlite'):
+            first, new_jobs, self.stats['expired'], updated_jobs = \
+                (self.writer or storage).record_crawl(
+                    self.url, self.turn_jobs_into_tuples(jobs)
+                )
+        if not first:
+            self.stats['new'] = len(new_jobs)
+            self.stats['updated'] = len(updated_jobs)
+            self.stats['rows'] += \
+                self.stats['new'] + self.stats['expired'] + self.stats['updated']
+
+            if self.seen is not None:
+                fresh = self.seen.claim(new_jobs, self.url)
+                fresh_updates = self.seen.claim(updated_jobs, self.url)
+                self.stats['duplicates'] = \
+                    len(new_jobs) - len(fresh) + len(updated_jobs) - len(fresh_updates)
+                new_jobs, updated_jobs = fresh, fresh_updates
+
+            if new_jobs and self.details is not None:
+                self.details.fetch(storage, new_jobs, self.writer)
+            if new_jobs:
+                self.notify_master_about_new_jobs(new_jobs)
+            if updated_jobs:
+                self.notify_master_about_updated_jobs(updated_jobs)
+
+            self.save_validators()
+            return
+
+        # A category crawled for the first time is only stored.
+        self.stats['new'] = len(new_jobs)
+        self.stats['rows'] += self.stats['new']
+        # Postings are not notified about, but other categories should not
+        # notify about them either.
+        if self.seen is not None:
+            self.seen.claim(new_jobs, self.url)
+        self.save_validators()
+        if created:
+            self.send_welcome_email()
+        return
+
+    def deactivate_expired_jobs(self, expired_jobs, path):
+        self.open_storage(path).deactivate_jobs(expired_jobs, self.url)
+        return
+
+    def add_new_jobs(self, new_jobs, path):
+        self.open_storage(path).insert_jobs(new_jobs, True, self.url)
+        return
+
+    def open_notifier(self):
+        """
+        Return the notifier, starting one which sends through Gmail on first
+        use. It can be shared by several spiders (see StartitCrawler).
         """
-        msg.attach(MIMEText(body, 'plain'))
+        if self.notifier is None:
+            self.notifier = StartitNotifier(
+                StartitSMTPTransport(self.spidy_mail, self.spidy_password),
+                self.spidy_mail
+            )
+            self.notifier.start()
+        return self.notifier
 
-        server = smtplib.SMTP('smtp.gmail.com', 587)
-        server.starttls()
-        server.login(from_address, password)
-        text = msg.as_string()
-        server.sendmail(from_address, to_address, text)
-        server.quit()
+    def notify_master_about_new_jobs(self, new_jobs):
+        """
+        Queue new jobs for the next digest email. This does not wait for the
+        email to be sent. If there is a router, subscribers get the jobs they
+        are interested in as well.
+        """
+        notifier = self.open_notifier()
+        notifier.notify_new_jobs(self.email, new_jobs)
+        self.stats['emails'] += 1
+
+        if self.router is not None:
+            for email, jobs in self.router.route(new_jobs).items():
+                notifier.notify_new_jobs(email, jobs)
+                self.stats['emails'] += 1
         return
 
-    def write_a_tuple_to_db(self, cursor, job, active):
+    def notify_master_about_updated_jobs(self, updated_jobs):
         """
-        Write a single record to database.
+        Queue jobs whose ads were edited for the next digest email, which
+        lists them apart from new jobs.
         """
-        to_write = (
-            job[0],
-            job[1],
-            job[2],
-            job[3],
-            active,
-            str(datetime.now()),
-        )
-        cursor.execute('INSERT INTO jobs VALUES(?,?,?,?,?,?)', to_write)
+        notifier = self.open_notifier()
+        notifier.notify_updated_jobs(self.email, updated_jobs)
+        self.stats['emails'] += 1
+
+        if self.router is not None:
+            for email, jobs in self.router.route(updated_jobs).items():
+                notifier.notify_updated_jobs(email, jobs)
+                self.stats['emails'] += 1
         return
 
-    def write_a_record_to_db(self, cursor, job, active):
+    def turn_jobs_into_tuples(self, jobs=None):
+        jobs = self.jobs if jobs is None else jobs
+        for job in jobs:
+            yield job.as_row()
+
+    def get_existing_data(self, path):
+        """
+        Return all active jobs of this category from the database.
+        """
+        return self.open_storage(path).active_jobs(self.url)
+
+    def execute_first_time_scarping(self, path, jobs=None):
         """
-        Write a single record to database.
+        Execute this method when the bot is scraping for the first time.
+        Populate the database with new jobs.
         """
-        to_write = (
-            job['company-title'],
-            job['job-title'],
-            job['url'],
-            json.dumps(job['tags']),
-            active,
-            str(datetime.now()),
-        )
-        cursor.execute('INSERT INTO jobs VALUES(?,?,?,?,?,?)', to_write)
+        jobs = self.jobs if jobs is None else jobs
+
+        with self.timer('sqlite'):
+            new_jobs, _, _ = (self.writer or self.open_storage(path)).apply_crawl(
+                self.url, self.turn_jobs_into_tuples(jobs)
+            )
+        self.stats['new'] = len(new_jobs)
+        self.stats['rows'] += self.stats['new']
+        # Postings are not notified about, but other categories should not
+        # notify about them either.
+        if self.seen is not None:
+            self.seen.claim(new_jobs, self.url)
         return
 
-    def db_exists(self, path):
+    def send_welcome_email(self):
+        """
+        When the script is executed for the first time, send greeting email.
         """
-        Check if database exists on a given path.
+        subject = "Greetings, it's your itsy bitsy spider /\\(00)/\\"
+
+        body = """
+        The itsy bitsy spider climbed up the waterspout.
+        Down came the rain
+        and washed the spider out.
+        Out came the sun
+        and dried up all the rain
+        and the itsy bitsy spider climbed up the spout again.
         """
-        return os.path.exists(path)
+        self.open_notifier().send(self.email, subject, body)
+        self.stats['emails'] += 1
+        return
 
     def extract_jobs(self):
         """
-        Using the raw_data, extract jobs as deque collection of  dictionary
-        objects, where a job dictionary is in the following form:
+        Using the raw_data, extract jobs as deque collection of StartitJob
+        objects. StartitJob.as_dict() gives a job in the following form:
 
         {
             'company-title' : company_title,
@@ -330,17 +966,58 @@ class Startit(object):
             'tags' : tags,
         }
         """
-        for job in self.raw_data:
-            if job['type'] == StartitJobTypes.PREMIUM:
-                self.jobs.append(self.extract_from_premium(job['job-post']))
-            elif job['type'] == StartitJobTypes.STANDARD:
-                self.jobs.append(self.extract_from_standard(job['job-post']))
-            elif job['type'] == StartitJobTypes.MINI:
-                self.jobs.append(self.extract_from_mini(job['job-post']))
-            else:
-                raise StartitException('Unknown job type!')
+        if not self.low_memory:
+            for job in self.raw_data:
+                self.jobs.append(self.extract_job(job))
+            return
+
+        while self.raw_data:
+            self.jobs.append(self.extract_job(self.raw_data.popleft()))
+        self.release_page()
         return
 
+    def extract_job(self, job):
+        """
+        Extract content from a packed job ad, and count it by type.
+        """
+        if self.timings is None:
+            extracted = self.extract_by_type(job)
+        else:
+            start = self.timings.enter()
+            try:
+                extracted = self.extract_by_type(job)
+            finally:
+                self.timings.leave('extract', start)
+        self.stats[job['type']] += 1
+        if self.low_memory:
+            return self.compact(extracted)
+        return extracted
+
+    def compact(self, job):
+        """
+        Return the job with plain strings, so it keeps nothing of the tree
+        alive, and with its company and tags interned, as they repeat across
+        jobs and categories.
+        """
+        return StartitJob(
+            sys.intern(str(job.company_title)), str(job.job_title), str(job.url),
+            [sys.intern(str(tag)) for tag in job.tags]
+        )
+
+    def extract_by_type(self, job):
+        """
+        Extract content from a packed job ad, according to its type.
+        """
+        if self.lxml is not None:
+            return self.lxml.extract_job(job)
+        if job['type'] == StartitJobTypes.PREMIUM:
+            return self.extract_from_premium(job['job-post'])
+        elif job['type'] == StartitJobTypes.STANDARD:
+            return self.extract_from_standard(job['job-post'])
+        elif job['type'] == StartitJobTypes.MINI:
+            return self.extract_from_mini(job['job-post'])
+        raise StartitException('Unknown job type!')
+
     def extract_from_premium(self, premium):
         """
         Extract content from premium job ad.
@@ -354,13 +1031,7 @@ class Startit(object):
         company_title = title.strip() if title else text.div.a.span.text.strip()
         tags = self.extract_tags(text.find_all('small'))
 
-        d = OrderedDict()
-        d['company-title'] = company_title
-        d['job-title'] = job_title
-        d['url'] = url
-        d['tags'] = tags
-
-        return d
+        return StartitJob(company_title, job_title, url, tags)
 
     def extract_from_standard(self, standard):
         """
@@ -375,13 +1046,7 @@ class Startit(object):
         company_title = title.strip() if title else text.div.a.span.text.strip()
         tags = self.extract_tags(text.find_all('small'))
 
-        d = OrderedDict()
-        d['company-title'] = company_title
-        d['job-title'] = job_title
-        d['url'] = url
-        d['tags'] = tags
-
-        return d
+        return StartitJob(company_title, job_title, url, tags)
 
     def extract_from_mini(self, mini):
         """
@@ -394,13 +1059,7 @@ class Startit(object):
             mini.find('div', attrs={'class' : 'oglas-mini-tagovi'}).find_all('small')
         )
 
-        d = OrderedDict()
-        d['company-title'] = company_title
-        d['job-title'] = job_title
-        d['url'] = url
-        d['tags'] = tags
-
-        return d
+        return StartitJob(company_title, job_title, url, tags)
 
     def extract_tags(self, smalls):
         """
@@ -417,52 +1076,53 @@ class Startit(object):
         premium, standard, and mini. Each of those object is labled correspondingly
         using constants from the StartitJobTypes class.
         """
-        premium = self.get_premium_jobs()
-        if premium:
-            self.raw_data.extend(
-                self.pack_by_type(
-                    premium, StartitJobTypes.PREMIUM
-                )
-            )
-
-        standard = self.get_standard_jobs()
-        if standard:
-            self.raw_data.extend(
-                self.pack_by_type(
-                    standard, StartitJobTypes.STANDARD
-                )
-            )
-
-        mini = self.get_mini_jobs()
-        if mini:
-            self.raw_data.extend(
-                self.pack_by_type(
-                    mini, StartitJobTypes.MINI
-                )
-            )
+        if self.page is None:
+            return
+        self.raw_data.extend(self.iter_divs(self.page))
+        return
 
+    def iter_divs(self, page):
+        """
+        Yield packed job related divs of the given page, in the same order as
+        extract_divs stores them.
+        """
+        if self.lxml is not None:
+            yield from self.lxml.iter_divs(page)
+            return
+        yield from self.pack_by_type(
+            self.get_premium_jobs(page), StartitJobTypes.PREMIUM
+        )
+        yield from self.pack_by_type(
+            self.get_standard_jobs(page), StartitJobTypes.STANDARD
+        )
+        yield from self.pack_by_type(
+            self.get_mini_jobs(page), StartitJobTypes.MINI
+        )
         return
 
-    def get_premium_jobs(self):
+    def get_premium_jobs(self, page=None):
         """
         Parse page to get all premium sponsored job ads. Append the result to
         raw_data.
         """
-        return self.page.find_all('div', attrs={'class' : 'listing-oglas-premium'})
+        page = self.page if page is None else page
+        return page.find_all('div', attrs={'class' : 'listing-oglas-premium'})
 
-    def get_standard_jobs(self):
+    def get_standard_jobs(self, page=None):
         """
         Parse page to get standard sponsored job ads. Append the result to
         raw_data.
         """
-        return self.page.find_all('div', attrs={'class' : 'listing-oglas-standard'})
+        page = self.page if page is None else page
+        return page.find_all('div', attrs={'class' : 'listing-oglas-standard'})
 
-    def get_mini_jobs(self):
+    def get_mini_jobs(self, page=None):
         """
         Parse page to extract all jobs from the mini class. Append the result to
         raw_data.
         """
-        return self.page.find_all('div', attrs={'class' : 'oglas-mini'})
+        page = self.page if page is None else page
+        return page.find_all('div', attrs={'class' : 'oglas-mini'})
 
     def pack_by_type(self, divs, job_type):
         """
@@ -482,30 +1142,3660 @@ class Startit(object):
         return packed
 
 
-class StartitJobTypes(object):
-    PREMIUM = 'premium'
-    STANDARD = 'standard'
-    MINI = 'mini'
+def parse_page_jobs(url, body, backend='lxml'):
+    """
+    Parse a raw page of results of the category at url. Return its jobs, the
+    link to the next page, and the number of ads of each type.
+
+    This runs in worker processes (see StartitBatchParser), so it takes and
+    returns only picklable values: StartitJobs, not document trees.
+    """
+    spider = Startit(url, None, backend)
+    page = spider.parse_page(body)
+    jobs = [spider.extract_job(packed) for packed in spider.iter_divs(page)]
+    ads = {
+        job_type : spider.stats[job_type] for job_type in StartitLxmlBackend.ORDER
+    }
+    return jobs, spider.next_page_url(page), ads
 
 
-class StartitException(Exception):
+class StartitBatchParser(object):
     """
-    This exception is raised if the supplied link is not valid.
+    Parse pages in a pool of processes, for when parsing, not fetching, is
+    the bottleneck, e.g. crawling dozens of categories, or replaying archived
+    pages. Raw bodies go to the processes and only compact jobs come back,
+    so the parent merges them for a single diff and write per category.
     """
-    pass
 
+    def __init__(self, max_workers=None, backend='lxml', chunksize=1):
+        self.max_workers = max_workers
+        self.backend = backend
+        self.chunksize = chunksize
+        self.executor = None
+        self.lock = threading.Lock()
 
-if __name__ == '__main__':
-    url, email, db_path, config_path = parse_arguments()
+    def open(self):
+        with self.lock:
+            if self.executor is None:
+                self.executor = ProcessPoolExecutor(max_workers=self.max_workers)
+            return self.executor
+
+    def close(self):
+        with self.lock:
+            if self.executor is not None:
+                self.executor.shutdown()
+                self.executor = None
+        return
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def submit(self, url, body):
+        """
+        Parse a single page, and return a future of parse_page_jobs' result.
+        """
+        return self.open().submit(parse_page_jobs, url, body, self.backend)
+
+    def parse(self, pages):
+        """
+        Parse pages, given as (category url, body) pairs. Return results of
+        parse_page_jobs in the same order.
+        """
+        pages = list(pages)
+        return list(self.open().map(
+            parse_page_jobs,
+            [url for url, _ in pages], [body for _, body in pages],
+            [self.backend] * len(pages), chunksize=self.chunksize
+        ))
+
+    def merge(self, pages):
+        """
+        Parse pages, given as (category url, body) pairs, and return jobs of
+        each category by url. A category may have several pages.
+        """
+        pages = list(pages)
+        merged = OrderedDict()
+        for (url, _), (jobs, _, _) in zip(pages, self.parse(pages)):
+            merged.setdefault(url, []).extend(jobs)
+        return merged
+
+    def apply(self, storage, pages):
+        """
+        Parse pages, given as (category url, body) pairs, and diff jobs of
+        each category against the database. Return results of apply_crawl
+        by category url.
+        """
+        pages = list(pages)
+        return OrderedDict(
+            (url, storage.apply_crawl(url, (job.as_row() for job in jobs)))
+            for url, jobs in self.merge(pages).items()
+        )
 
-    startit = Startit(url, email)
 
-    startit.db_path = db_path
-    startit.config_path = config_path
+class StartitBackfill(object):
+    """
+    Load archived pages of results into the jobs database, as if they had
+    been crawled when they were captured. Snapshots are named
+
+        <category>/[<capture time>][<name>][-<page>].html[.gz]
+
+    in a directory or a tarball, the category being the last part of its
+    url, e.g. python/20190301T120000.html. Capture times are given as
+    YYYYmmddHHMMSS, with or without a T, or as YYYY-mm-dd[THH-MM-SS]. If
+    the name does not start with one, e.g. python/index-2.html, pages of the
+    category sharing the rest of the name are taken for one capture, dated
+    by the earliest modification time among them.
+
+    Snapshots are parsed in a pool of processes, and their jobs stored in
+    the snapshots table. Captures of each category are then replayed in
+    order through apply_crawl, so jobs get the date they first appeared,
+    and the date they expired. Both steps skip what is done already, so an
+    interrupted backfill continues where it left off. Captures older than
+    the category's first live jobs are replayed as their history (see
+    replay_history), and captures newer than its latest change continue
+    it. Captures in between are skipped, and kept, so live crawls are never
+    rolled back.
+    """
+    SNAPSHOT = re.compile(
+        r'(?P<captured>\d{8}T?\d{6}|\d{4}-\d{2}-\d{2}(T\d{2}-\d{2}-\d{2})?)?'
+        r'(?P<stem>[^/]*?)(-(?P<page>\d+))?\.html?(?P<gz>\.gz)?$'
+    )
+    CAPTURE_FORMATS = ('%Y%m%d%H%M%S', '%Y%m%dT%H%M%S', '%Y-%m-%d', '%Y-%m-%dT%H-%M-%S')
+    CATEGORY_URL = 'https://startit.rs/poslovi/pretraga/%s/'
+    # Suffix of the source captures older than live crawls are replayed under.
+    HISTORY = '#history'
+
+    # Snapshots handed to the processes at a time.
+    BATCH = 256
 
-    startit.read_sensitive_data()
+    def __init__(self, storage, urls=None, processes=None, backend='lxml'):
+        self.storage = storage
+        # If set, only snapshots of these categories are loaded.
+        self.urls = set(urls) if urls else None
+        self.processes = processes
+        self.backend = backend
+
+        self.stats = {
+            'snapshots' : 0,
+            'loaded' : 0,
+            'captures' : 0,
+            'skipped' : 0,
+            'new' : 0,
+            'expired' : 0,
+            'updated' : 0,
+        }
+
+    def run(self, path):
+        """
+        Load snapshots from the directory or tarball, then replay them.
+        """
+        self.load(path)
+        self.replay()
+        return self.stats
+
+    def snapshot(self, name, mtime, undated=None):
+        """
+        Return the source, capture time and page of the snapshot's name, or
+        None if it is not a snapshot. A name without a capture time is dated
+        by undated (see undated_times), or else by mtime.
+        """
+        parts = name.replace(os.sep, '/').strip('/').split('/')
+        match = self.SNAPSHOT.match(parts[-1])
+        if match is None or len(parts) < 2:
+            return None
+        source = self.CATEGORY_URL % parts[-2]
+        if self.urls is not None and source not in self.urls:
+            return None
+
+        if undated:
+            mtime = undated.get((tuple(parts[:-1]), match.group('stem')), mtime)
+        captured = datetime.fromtimestamp(mtime)
+        if match.group('captured'):
+            for capture_format in self.CAPTURE_FORMATS:
+                try:
+                    captured = datetime.strptime(match.group('captured'), capture_format)
+                    break
+                except ValueError:
+                    continue
+        return source, str(captured), int(match.group('page') or 1)
+
+    def undated_times(self, entries):
+        """
+        Return the earliest modification time of snapshots without a capture
+        time in their name, given as (name, mtime), by directory and stem,
+        so that pages of one capture get the same date.
+        """
+        times = {}
+        for name, mtime in entries:
+            parts = name.replace(os.sep, '/').strip('/').split('/')
+            match = self.SNAPSHOT.match(parts[-1])
+            if match is None or match.group('captured'):
+                continue
+            key = (tuple(parts[:-1]), match.group('stem'))
+            times[key] = min(times.get(key, mtime), mtime)
+        return times
+
+    def iter_snapshots(self, path):
+        """
+        Yield (source, captured, page, gzipped, read) for the snapshots in
+        the directory or tarball, read returning the raw body. A tarball is
+        read in one pass, so bodies must be read before moving on; its
+        headers are read in a pass of their own first, to date undated
+        snapshots.
+        """
+        if os.path.isdir(path):
+            for directory, subdirectories, names in os.walk(path):
+                subdirectories.sort()
+                entries = [
+                    (os.path.relpath(os.path.join(directory, name), path),
+                     os.path.getmtime(os.path.join(directory, name)))
+                    for name in sorted(names)
+                ]
+                undated = self.undated_times(entries)
+                for (relative, mtime), name in zip(entries, sorted(names)):
+                    key = self.snapshot(relative, mtime, undated)
+                    if key is not None:
+                        yield key + (
+                            name.endswith('.gz'),
+                            self.reader(os.path.join(directory, name))
+                        )
+            return
+
+        with tarfile.open(path, 'r|*') as tar:
+            undated = self.undated_times(
+                (member.name, member.mtime) for member in tar if member.isfile()
+            )
+        with tarfile.open(path, 'r|*') as tar:
+            for member in tar:
+                if not member.isfile():
+                    continue
+                key = self.snapshot(member.name, member.mtime, undated)
+                if key is not None:
+                    yield key + (
+                        member.name.endswith('.gz'),
+                        lambda member=member: tar.extractfile(member).read()
+                    )
+        return
+
+    def reader(self, path):
+        def read():
+            with open(path, 'rb') as f:
+                return f.read()
+        return read
+
+    def load(self, path):
+        """
+        Parse snapshots which are not in the database yet, and store their
+        jobs. Return the number of snapshots loaded.
+        """
+        done = self.storage.snapshot_keys()
+        batch = []
+        with StartitBatchParser(self.processes, self.backend, chunksize=16) as parser:
+            for source, captured, page, gzipped, read in self.iter_snapshots(path):
+                self.stats['snapshots'] += 1
+                if (source, captured, page) in done:
+                    continue
+                body = gzip.decompress(read()) if gzipped else read()
+                batch.append(((source, captured, page), body))
+                if len(batch) >= self.BATCH:
+                    self.load_batch(parser, batch)
+                    batch = []
+            if batch:
+                self.load_batch(parser, batch)
+        return self.stats['loaded']
+
+    def load_batch(self, parser, batch):
+        results = parser.parse((key[0], body) for key, body in batch)
+        self.storage.save_snapshots(
+            key + ([job.as_row() for job in jobs],)
+            for (key, _), (jobs, _, _) in zip(batch, results)
+        )
+        self.stats['loaded'] += len(batch)
+        return
+
+    def replay(self):
+        """
+        Replay captures of every category in order, dating changes with the
+        capture time. Jobs which appear are marked as seen, so that they are
+        not notified about later (see StartitSeenIndex).
+        """
+        for source in self.storage.snapshot_sources():
+            first_change, last_change = self.storage.changes(source)
+            captures = self.storage.snapshot_captures(source)
+            history = [c for c in captures if first_change and c < first_change]
+            if history:
+                self.replay_history(source, history, first_change)
+            for captured in captures:
+                if last_change is None or captured > last_change:
+                    self.replay_capture(
+                        source, captured, self.storage.snapshot_jobs(source, captured)
+                    )
+                    self.storage.finish_snapshot(source, captured)
+                elif captured >= first_change:
+                    self.stats['skipped'] += 1
+        return
+
+    def replay_history(self, source, captures, until):
+        """
+        Replay captures older than the source's first live jobs under a
+        separate source, so they are diffed against each other only, then
+        move their jobs to the source, ending those still active when the
+        live jobs begin. Captures are marked replayed with the move, so an
+        interrupted replay starts over.
+        """
+        history = source + self.HISTORY
+        self.storage.drop_history(history)
+        for captured in captures:
+            self.replay_capture(
+                source, captured, self.storage.snapshot_jobs(source, captured), history
+            )
+        self.storage.merge_history(history, source, until, captures)
+        return
+
+    def replay_capture(self, source, captured, jobs, target=None):
+        new_jobs, expired, updated_jobs = self.storage.apply_crawl(
+            target or source, jobs, captured
+        )
+        self.storage.mark_seen(
+            [self.storage.hashed(job)[:2] for job in new_jobs + updated_jobs],
+            source
+        )
+        self.stats['captures'] += 1
+        self.stats['new'] += len(new_jobs)
+        self.stats['expired'] += expired
+        self.stats['updated'] += len(updated_jobs)
+        return
+
+
+class StartitCrawler(object):
+    """
+    Crawl several categories in one run. Pages are fetched concurrently by a
+    bounded pool of threads, with at most max_per_host requests in flight per
+    host, so the whole run takes about as long as the slowest category. Jobs
+    of each category are then passed through the usual check_and_notify
+    pipeline, by as many threads. They share one database connection for
+    reading, and a StartitWriter applies their diffs, and their other
+    writes, in grouped transactions.
+    """
+
+    def __init__(self, urls, email, max_workers=8, max_per_host=2,
+                 backend='soup', processes=0, digest_window=0):
+        self.spiders = [Startit(url, email, backend) for url in urls]
+        self.email = email
+        self.backend = backend
+        # If set, pages are parsed by this many processes, instead of the
+        # threads fetching them.
+        self.processes = processes
+        # Seconds new jobs are collected for before an email is sent. Any
+        # window longer than the run sends a single digest when it ends.
+        self.digest_window = digest_window
+
+        self.db_path = None
+        self.config_path = None
+
+        self.max_workers = max_workers
+        self.max_per_host = max_per_host
+        self.host_limits = {}
+
+        # If set, every spider is watched, and the run is reported once all
+        # emails are sent.
+        self.metrics = None
+        # If set, detail pages of new jobs are fetched.
+        self.details = None
+        self.cache = None
+        self.client = None
+        # Bloom filter capacity of the seen-posting index, 0 to keep it in
+        # a set.
+        self.bloom = 0
+        # See Startit.low_memory.
+        self.low_memory = False
+
+    def host_limit(self, url):
+        """
+        Return the semaphore limiting concurrent requests to the url's host.
+        """
+        host = urlparse(url).netloc
+        if host not in self.host_limits:
+            self.host_limits[host] = threading.BoundedSemaphore(self.max_per_host)
+        return self.host_limits[host]
+
+    def crawl(self):
+        """
+        Fetch pages of all spiders concurrently, and extract their jobs. Every
+        page of results is fetched, but only the extracted jobs are kept. A
+        category which fails is logged, and its spider's stats['failed'] set,
+        so the others carry on.
+        """
+        storage = StartitStorage(self.db_path) if self.db_path else None
+        for spider in self.spiders:
+            spider.db_path = self.db_path
+            spider.storage = storage
+            spider.throttle = self.host_limit(spider.url)
+            spider.cache = self.cache
+            spider.client = self.client
+            spider.low_memory = self.low_memory
+            if self.metrics is not None:
+                self.metrics.watch(spider)
+
+        batch = None
+        if self.processes:
+            batch = StartitBatchParser(self.processes, self.backend)
+            for spider in self.spiders:
+                spider.batch = batch
+
+        workers = min(self.max_workers, len(self.spiders)) or 1
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                list(executor.map(self.crawl_one, self.spiders))
+        finally:
+            if batch is not None:
+                batch.close()
+        return
+
+    def crawl_one(self, spider):
+        try:
+            spider.jobs.extend(spider.iter_jobs())
+        except Exception:
+            log.exception('Crawling %s failed', spider.url)
+            spider.stats['failed'] = True
+        return
+
+    def check_one(self, spider):
+        spider.check_and_notify()
+        return
+
+    def run(self):
+        """
+        Crawl all categories, then check for new jobs and notify. Categories
+        which failed to crawl are left as they are, rather than have all of
+        their jobs expire.
+        """
+        try:
+            self.crawl()
+
+            storage = self.spiders[0].open_storage()
+            router = StartitRouter.from_storage(storage)
+            seen = StartitSeenIndex(storage, self.bloom)
+            notifier = None
+            for spider in self.spiders:
+                spider.config_path = self.config_path
+                spider.read_sensitive_data()
+                spider.router = router
+                spider.seen = seen
+                spider.details = self.details
+                if notifier is None:
+                    notifier = StartitNotifier(
+                        StartitSMTPTransport(spider.spidy_mail, spider.spidy_password),
+                        spider.spidy_mail, self.digest_window
+                    )
+                    notifier.start()
+                # New jobs of all categories share the notifier's digests.
+                spider.notifier = notifier
+
+            writer = StartitWriter(self.db_path).start()
+            seen.writer = writer
+            for spider in self.spiders:
+                spider.writer = writer
+            crawled = [spider for spider in self.spiders if not spider.stats['failed']]
+            workers = min(self.max_workers, len(crawled)) or 1
+            try:
+                with ThreadPoolExecutor(max_workers=workers) as executor:
+                    list(executor.map(self.check_one, crawled))
+            finally:
+                writer.close()
+        finally:
+            # All spiders share the same storage, cache, client and notifier.
+            self.spiders[-1].close()
+        return
+
+
+class StartitDaemon(object):
+    """
+    Keep the spider resident, and poll each category on its own schedule,
+    give or take jitter (a fraction of the interval) so that polls do not
+    bunch up. The database connections and the lxml parser are reused
+    across polls, so a poll costs only the fetch and the diff. Polls write
+    through a StartitWriter, as StartitCrawler does. SIGTERM and SIGINT
+    stop the daemon once the current poll is done.
+
+    Each category starts at interval seconds between polls. A poll which
+    finds new, expired or edited jobs shortens the category's interval by
+    TIGHTEN, a quiet one lengthens it by BACK_OFF, within min_interval and
+    max_interval.
+    Intervals and poll history are kept in the database, so they survive
+    restarts.
+    """
+    TIGHTEN = 0.5
+    BACK_OFF = 1.5
+
+    def __init__(self, urls, email, interval=900, jitter=0.1, backend='soup',
+                 min_interval=None, max_interval=None, digest_window=0):
+        self.urls = [Startit(url, email).url for url in urls]
+        self.email = email
+
+        self.db_path = None
+        self.config_path = None
+        self.storage = None
+        # Applies crawls and every other write of the polls, see
+        # StartitWriter.
+        self.writer = None
+        self.notifier = None
+        self.router = None
+        self.metrics = None
+        self.details = None
+        self.cache = None
+        self.client = None
+        self.seen = None
+        self.bloom = 0
+        self.low_memory = False
+        self.digest_window = digest_window
+
+        self.interval = interval
+        self.min_interval = interval / 4 if min_interval is None else min_interval
+        self.max_interval = interval * 4 if max_interval is None else max_interval
+        self.intervals = {}
+        self.jitter = jitter
+        self.backend = backend
+        self.lxml = StartitLxmlBackend() if backend == 'lxml' else None
+
+        self.schedule = []
+        self.stopping = threading.Event()
+
+    def next_delay(self, url):
+        """
+        Return the number of seconds until the url should be polled again.
+        """
+        interval = self.intervals.get(url, self.interval)
+        return interval * (1 + random.uniform(-self.jitter, self.jitter))
+
+    def adapt_interval(self, url, spider):
+        """
+        Adjust the url's interval to what its last poll found, and store it
+        together with the poll.
+        """
+        changed = bool(
+            spider.stats['new'] or spider.stats['expired'] or spider.stats['updated']
+        )
+        previous = self.intervals.get(url, self.interval)
+        if changed:
+            interval = max(self.min_interval, previous * self.TIGHTEN)
+        else:
+            interval = min(self.max_interval, previous * self.BACK_OFF)
+
+        self.intervals[url] = interval
+        polls, changes = (self.writer or self.storage).record_poll(
+            url, interval, changed
+        )
+        log.info(
+            'Next poll of %s in %.0fs, was %.0fs (%s; %d of %d polls changed)',
+            url, interval, previous, 'changed' if changed else 'quiet',
+            changes, polls
+        )
+        return interval
+
+    def restore_schedule(self):
+        """
+        Schedule every url, continuing where the previous run left off.
+        """
+        now, wall = time.monotonic(), time.time()
+        self.schedule = []
+        for url in self.urls:
+            state = self.storage.load_poll(url)
+            due = now
+            if state is not None:
+                self.intervals[url] = min(
+                    self.max_interval, max(self.min_interval, state['interval'])
+                )
+                due += max(0, state['last-polled'] + self.intervals[url] - wall)
+            self.schedule.append((due, url))
+        heapq.heapify(self.schedule)
+        return
+
+    def poll(self, url):
+        """
+        Crawl a single category, and check for new jobs.
+        """
+        spider = Startit(url, self.email, self.backend)
+        spider.db_path = self.db_path
+        spider.storage = self.storage
+        spider.writer = self.writer
+        spider.notifier = self.notifier
+        spider.router = self.open_router()
+        spider.details = self.details
+        spider.cache = self.cache
+        spider.client = self.client
+        spider.seen = self.seen
+        spider.low_memory = self.low_memory
+        if self.lxml is not None:
+            spider.lxml = self.lxml
+        if self.metrics is not None:
+            self.metrics.watch(spider)
+
+        spider.check_and_notify(spider.iter_jobs())
+        log.info(
+            'Polled %s: new %d, expired %d, skipped %s', url,
+            spider.stats['new'], spider.stats['expired'], spider.stats['skipped']
+        )
+        self.adapt_interval(url, spider)
+        if self.metrics is not None:
+            # Emails are sent in the background, so they are reported with
+            # the poll during which they went out.
+            self.metrics.report(self.notifier, self.client)
+        return spider
+
+    def open_router(self):
+        """
+        Return the router, rebuilding it if subscriptions changed since.
+        """
+        version = self.storage.subscriptions_version()
+        if self.router is None or self.router.version != version:
+            self.router = StartitRouter.from_storage(self.storage)
+        return self.router
+
+    def stop(self, *args):
+        self.stopping.set()
+        return
+
+    def run(self):
+        """
+        Poll categories until stopped. Categories which are due are polled
+        right away, then each is rescheduled after its own delay. A failed
+        poll is logged, and retried with the next tick.
+        """
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, self.stop)
+            signal.signal(signal.SIGINT, self.stop)
+
+        spider = Startit(self.urls[0], self.email)
+        spider.config_path = self.config_path
+        spider.read_sensitive_data()
+        self.notifier = StartitNotifier(
+            StartitSMTPTransport(spider.spidy_mail, spider.spidy_password),
+            spider.spidy_mail, self.digest_window
+        )
+        self.notifier.start()
+
+        self.storage = StartitStorage(self.db_path)
+        self.writer = StartitWriter(self.db_path).start()
+        try:
+            self.seen = StartitSeenIndex(self.storage, self.bloom)
+            self.seen.writer = self.writer
+            self.restore_schedule()
+            while not self.stopping.is_set():
+                due, url = self.schedule[0]
+                if self.stopping.wait(max(0, due - time.monotonic())):
+                    break
+
+                heapq.heappop(self.schedule)
+                try:
+                    self.poll(url)
+                except Exception:
+                    log.exception('Polling %s failed', url)
+                heapq.heappush(
+                    self.schedule, (time.monotonic() + self.next_delay(url), url)
+                )
+        finally:
+            self.writer.close()
+            self.writer = None
+            self.storage.close()
+            if self.cache is not None:
+                self.cache.close()
+            if self.client is not None:
+                self.client.close()
+            self.notifier.close()
+            if self.metrics is not None:
+                self.metrics.report(self.notifier, self.client)
+        return
+
+
+class StartitHTTPClient(object):
+    """
+    Send requests over persistent connections, kept alive per host, so that
+    a page costs no handshake after the first. Bodies are asked for gzipped
+    or deflated, and decoded as they are read.
+
+    Connecting may take up to connect_timeout seconds, and every read up to
+    read_timeout seconds. A request failing with a network error, or with
+    429 or a 5xx status, is retried up to retries times, with exponential
+    backoff. Other statuses are raised as HTTPError, as urlopen does, so
+    responses can be handled the same either way.
+
+    Counters of connections opened and reused, retries, and bytes saved by
+    compression are kept for StartitMetrics.
+    """
+    RETRY_STATUSES = (429, 500, 502, 503, 504)
+    REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+    MAX_REDIRECTS = 5
+
+    # Errors of a connection the server closed while it was idle.
+    STALE_ERRORS = (
+        http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError
+    )
+
+    def __init__(self, connect_timeout=10, read_timeout=30, retries=3,
+                 backoff=0.5, max_idle=4):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_idle = max_idle
+        self.context = ssl.create_default_context()
+
+        # Idle connections, by scheme and host.
+        self.idle = {}
+        self.lock = threading.Lock()
+
+        self.requests = 0
+        self.connections = 0
+        self.reused = 0
+        self.retried = 0
+        # Bytes of bodies as received, and as decoded.
+        self.received = 0
+        self.decoded = 0
+
+    @property
+    def saved(self):
+        """
+        Bytes compression saved on the wire.
+        """
+        return self.decoded - self.received
+
+    def open(self, request):
+        """
+        Send the urllib request, following redirects, and return the
+        response once its headers have arrived.
+        """
+        url = request.get_full_url()
+        headers = dict(request.header_items())
+        headers['Accept-Encoding'] = 'gzip, deflate'
+        method = request.get_method()
+
+        for _ in range(self.MAX_REDIRECTS + 1):
+            response = self.send(method, url, headers, request.data)
+            if response.status not in self.REDIRECT_STATUSES:
+                return response
+            response.read()
+            url = urljoin(url, response.info()['Location'])
+            if response.status == 303:
+                method = 'GET'
+        raise HTTPError(
+            url, response.status, 'Too many redirects', response.info(), None
+        )
+
+    def send(self, method, url, headers, data=None):
+        """
+        Send a single request, retrying it if it fails, and return the
+        response. Error statuses are raised as HTTPError.
+        """
+        attempt = 0
+        while True:
+            try:
+                response = self.attempt(method, url, headers, data)
+            except URLError:
+                if attempt >= self.retries:
+                    raise
+            else:
+                if 200 <= response.status < 300:
+                    return response
+                if response.status in self.REDIRECT_STATUSES \
+                        and response.info().get('Location'):
+                    return response
+                body = response.read()
+                error = HTTPError(
+                    url, response.status, response.reason, response.info(),
+                    BytesIO(body)
+                )
+                if response.status not in self.RETRY_STATUSES \
+                        or attempt >= self.retries:
+                    raise error
+            attempt += 1
+            with self.lock:
+                self.retried += 1
+            delay = self.backoff * 2 ** (attempt - 1)
+            log.warning('Retrying %s in %.1fs', url, delay)
+            time.sleep(delay)
+
+    def attempt(self, method, url, headers, data=None):
+        """
+        Send the request over an idle connection to the host, or a new one,
+        and return the response. Network errors are raised as URLError.
+        """
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+
+        with self.lock:
+            self.requests += 1
+        connection = self.checkout(key)
+        reused = connection is not None
+        try:
+            if connection is None:
+                connection = self.connect(key)
+            try:
+                connection.request(method, path, data, headers)
+                response = connection.getresponse()
+            except self.STALE_ERRORS:
+                if not reused:
+                    raise
+                # The server dropped the idle connection, not the request.
+                connection.close()
+                reused = False
+                connection = self.connect(key)
+                connection.request(method, path, data, headers)
+                response = connection.getresponse()
+        except (OSError, http.client.HTTPException) as e:
+            if connection is not None:
+                connection.close()
+            raise URLError(e)
+
+        if reused:
+            with self.lock:
+                self.reused += 1
+        return StartitHTTPResponse(self, key, connection, response, url)
+
+    def connect(self, key):
+        scheme, host = key
+        if scheme == 'https':
+            connection = http.client.HTTPSConnection(
+                host, timeout=self.connect_timeout, context=self.context
+            )
+        elif scheme == 'http':
+            connection = http.client.HTTPConnection(
+                host, timeout=self.connect_timeout
+            )
+        else:
+            raise URLError('Unsupported scheme: %s' % scheme)
+        connection.connect()
+        connection.sock.settimeout(self.read_timeout)
+        with self.lock:
+            self.connections += 1
+        return connection
+
+    def checkout(self, key):
+        with self.lock:
+            idle = self.idle.get(key)
+            return idle.pop() if idle else None
+
+    def release(self, key, connection):
+        """
+        Keep the connection for the next request to the host, unless enough
+        are kept already.
+        """
+        with self.lock:
+            idle = self.idle.setdefault(key, [])
+            if len(idle) < self.max_idle:
+                idle.append(connection)
+                return
+        connection.close()
+        return
+
+    def count(self, received, decoded):
+        with self.lock:
+            self.received += received
+            self.decoded += decoded
+        return
+
+    def close(self):
+        """
+        Close idle connections. The client can still be used afterwards.
+        """
+        with self.lock:
+            idle, self.idle = self.idle, {}
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
+        return
+
+
+class StartitHTTPResponse(object):
+    """
+    Response of StartitHTTPClient, read like the one urlopen returns. The
+    body is decoded as it is read, and the connection handed back to the
+    client once the body has been read through.
+    """
+
+    def __init__(self, client, key, connection, response, url):
+        self.client = client
+        self.key = key
+        self.connection = connection
+        self.response = response
+        self.url = url
+        self.status = self.code = response.status
+        self.reason = response.reason
+
+        encoding = (response.getheader('Content-Encoding') or '').strip().lower()
+        self.encoding = encoding if encoding in ('gzip', 'deflate') else None
+        self.decoder = None
+        if self.encoding == 'gzip':
+            self.decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif self.encoding == 'deflate':
+            self.decoder = zlib.decompressobj()
+        # Deflated bodies come with or without the zlib header.
+        self.raw = False
+
+    def info(self):
+        return self.response.msg
+
+    def getcode(self):
+        return self.status
+
+    def geturl(self):
+        return self.url
+
+    def read(self, amt=None):
+        """
+        Return up to amt bytes of the decoded body, all of it if amt is None,
+        or b'' once it has been read through.
+        """
+        if self.connection is None:
+            return b''
+        body = b''
+        try:
+            while True:
+                data = self.response.read(amt)
+                if not data:
+                    body += self.finish()
+                    return body
+                body += self.decode(data)
+                if body and amt is not None:
+                    return body
+        except (OSError, http.client.HTTPException, zlib.error) as e:
+            self.close()
+            raise URLError(e)
+
+    def decode(self, data):
+        if self.decoder is None:
+            self.client.count(len(data), len(data))
+            return data
+        try:
+            decoded = self.decoder.decompress(data)
+        except zlib.error:
+            if self.encoding != 'deflate' or self.raw:
+                raise
+            self.raw = True
+            self.decoder = zlib.decompressobj(-zlib.MAX_WBITS)
+            decoded = self.decoder.decompress(data)
+        self.client.count(len(data), len(decoded))
+        return decoded
+
+    def finish(self):
+        """
+        Hand the connection back to the client, and return what is left of
+        the decoded body.
+        """
+        rest = self.decoder.flush() if self.decoder is not None else b''
+        self.client.count(0, len(rest))
+        connection, self.connection = self.connection, None
+        if self.response.will_close:
+            connection.close()
+        else:
+            self.client.release(self.key, connection)
+        return rest
+
+    def close(self):
+        """
+        Close the connection if the body was not read through, as it can not
+        be reused then.
+        """
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+        return
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+        return
+
+
+class StartitTokenBucket(object):
+    """
+    Let through rate requests per second on average, and bursts of up to
+    burst requests. acquire() blocks until a request may be made.
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.burst, self.tokens + (now - self.updated) * self.rate
+                )
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class StartitDetailFetcher(object):
+    """
+    Fetch detail pages of new jobs, and take their description, location and
+    seniority. Pages are fetched by a bounded pool of threads, each host at
+    no more than rate pages per second. Details are stored in the database,
+    so the page of a job is never fetched twice, across runs.
+
+    Details are taken from schema.org JobPosting data if the page has it,
+    from the usual markup otherwise. Seniority is guessed from the job's
+    title, or failing that, from its description.
+    """
+    JSON_LD = etree.XPath('//script[@type="application/ld+json"]/text()')
+
+    DESCRIPTION = (
+        etree.XPath('string(//*[@itemprop="description"])'),
+        etree.XPath('string(//*[contains(concat(" ", normalize-space(@class), " "), " job-description ")])'),
+        etree.XPath('string(//article)'),
+        etree.XPath('string(//meta[@property="og:description"]/@content)'),
+        etree.XPath('string(//meta[@name="description"]/@content)'),
+    )
+
+    LOCATION = (
+        etree.XPath('string(//*[@itemprop="addressLocality"])'),
+        etree.XPath('string(//*[@itemprop="jobLocation"])'),
+        etree.XPath('string(//*[contains(concat(" ", normalize-space(@class), " "), " location ")])'),
+    )
+
+    SENIORITY = OrderedDict([
+        ('intern', re.compile(r'\b(intern(ship)?|praksa|praktikant)', re.I)),
+        ('junior', re.compile(r'\b(junior|jr\.?)(\b|$)', re.I)),
+        ('medior', re.compile(r'\b(medior|mid[- ]level|intermediate)\b', re.I)),
+        ('senior', re.compile(r'\b(senior|sr\.?)(\b|$)', re.I)),
+        ('lead', re.compile(r'\b(lead|principal|head of|architect)\b', re.I)),
+    ])
+
+    def __init__(self, max_workers=4, rate=1.0, burst=1, timeout=30):
+        self.max_workers = max_workers
+        self.rate = rate
+        self.burst = burst
+        self.timeout = timeout
+        # Shares connections with the spiders, if set (see StartitHTTPClient).
+        self.client = None
+
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def bucket(self, url):
+        """
+        Return the token bucket limiting requests to the url's host.
+        """
+        host = urlparse(url).netloc
+        with self.lock:
+            if host not in self.buckets:
+                self.buckets[host] = StartitTokenBucket(self.rate, self.burst)
+            return self.buckets[host]
+
+    def fetch(self, storage, jobs, writer=None):
+        """
+        Return details of the jobs, given as database rows, by url. Details
+        which are not in the database yet are fetched and stored, through
+        the writer if given.
+        """
+        titles = OrderedDict((job[2], job[1]) for job in jobs)
+        details = storage.load_details(titles)
+        missing = [url for url in titles if url not in details]
+        if not missing:
+            return details
+
+        workers = min(self.max_workers, len(missing))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            fetched = list(executor.map(
+                lambda url: self.fetch_one(url, titles[url]), missing
+            ))
+
+        rows = [
+            (url,) + found for url, found in zip(missing, fetched)
+            if found is not None
+        ]
+        (writer or storage).save_details(rows)
+        details.update((row[0], row[1:]) for row in rows)
+        return details
+
+    def fetch_one(self, url, job_title=''):
+        """
+        Fetch and parse the detail page. Return None if it can not be
+        fetched; it is tried again the next time the job is new.
+        """
+        if urlparse(url).scheme not in ('http', 'https'):
+            return None
+        self.bucket(url).acquire()
+        try:
+            body, content_type = self.fetch_body(url)
+        except (HTTPError, URLError, OSError):
+            log.warning('Fetching details of %s failed', url, exc_info=True)
+            return None
+        # Some jobs link straight to a PDF or similar. Those are stored
+        # without details, so they are not fetched again.
+        if 'html' not in content_type:
+            return (None, None, self.seniority(job_title, ''))
+        return self.parse(body, job_title)
+
+    def fetch_body(self, url):
+        request = Request(url, headers={'User-Agent' : Startit.USER_AGENT})
+        if self.client is not None:
+            response = self.client.open(request)
+        else:
+            response = urlopen(request, timeout=self.timeout)
+        return response.read(), response.info().get('Content-Type', 'text/html')
+
+    def parse(self, body, job_title=''):
+        """
+        Return description, location and seniority found in the page.
+        """
+        if isinstance(body, bytes):
+            body = UnicodeDammit(body, is_html=True).unicode_markup
+        # Pages are parsed by several threads, so lxml's default parser is
+        # used, which is kept per thread.
+        root = etree.HTML(body) if body and body.strip() else None
+        if root is None:
+            return (None, None, self.seniority(job_title, ''))
+
+        description, location = self.from_json_ld(root)
+        if not description:
+            description = self.first_text(root, self.DESCRIPTION)
+        if not location:
+            location = self.first_text(root, self.LOCATION)
+        return (
+            description, location, self.seniority(job_title, description or '')
+        )
+
+    def from_json_ld(self, root):
+        """
+        Return description and location of the page's JobPosting, if any.
+        """
+        for script in self.JSON_LD(root):
+            try:
+                data = json.loads(script)
+            except ValueError:
+                continue
+            for item in data if isinstance(data, list) else [data]:
+                if not isinstance(item, dict) or item.get('@type') != 'JobPosting':
+                    continue
+                description = item.get('description')
+                if description:
+                    description = self.clean(
+                        etree.HTML('<div>%s</div>' % description).xpath('string()')
+                    )
+                return description or None, self.json_ld_location(item)
+        return None, None
+
+    def json_ld_location(self, posting):
+        locations = posting.get('jobLocation') or []
+        for location in locations if isinstance(locations, list) else [locations]:
+            address = location.get('address') if isinstance(location, dict) else None
+            if isinstance(address, dict) and address.get('addressLocality'):
+                return address['addressLocality'].strip()
+        return None
+
+    def first_text(self, root, xpaths):
+        for xpath in xpaths:
+            text = self.clean(xpath(root))
+            if text:
+                return text
+        return None
+
+    def clean(self, text):
+        return ' '.join(text.split())
+
+    def seniority(self, job_title, description):
+        """
+        Return the seniority level named first in the job's title, or in its
+        description, or None.
+        """
+        for text in (job_title, description):
+            found = [
+                (match.start(), level) for level, pattern in self.SENIORITY.items()
+                for match in [pattern.search(text)] if match
+            ]
+            if found:
+                return min(found)[1]
+        return None
+
+
+class StartitResponseCache(object):
+    """
+    Responses kept on disk, so that pages can be processed again, e.g. after
+    a parser change, without fetching them. Bodies are stored gzipped, one
+    file per url, with their validators and access times in a SQLite index.
+    The least recently used responses are evicted once bodies take more than
+    max_bytes on disk.
+
+    Cached responses are revalidated with the server; in offline mode they
+    are served as they are, and pages which are not cached can not be
+    fetched at all.
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS responses (
+          Url TEXT PRIMARY KEY,
+          File TEXT,
+          ETag TEXT,
+          LastModified TEXT,
+          Size INTEGER,
+          Stored REAL,
+          Accessed REAL
+         );
+
+        CREATE INDEX IF NOT EXISTS responses_accessed ON responses(Accessed);
+    """
+
+    def __init__(self, directory, max_bytes=256 * 2 ** 20, offline=False):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.offline = offline
+
+        os.makedirs(directory, exist_ok=True)
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(
+            os.path.join(directory, 'index.db'), check_same_thread=False,
+            isolation_level=None
+        )
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.executescript(self.SCHEMA)
+        self.size = self.conn.execute(
+            'SELECT COALESCE(SUM(Size), 0) FROM responses'
+        ).fetchone()[0]
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def validators(self, url):
+        """
+        Return the ETag and Last-Modified of the url's cached response, as
+        page_request takes them, or None. The body is not read.
+        """
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT ETag, LastModified FROM responses WHERE Url=?', (url,)
+            ).fetchone()
+        if row is None:
+            return None
+        return {'etag' : row[0], 'last-modified' : row[1]}
+
+    def get(self, url):
+        """
+        Return the cached body, ETag and Last-Modified of the url, or None.
+        """
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT File, ETag, LastModified FROM responses WHERE Url=?', (url,)
+            ).fetchone()
+            if row is None:
+                return None
+            try:
+                with open(self.path(row[0]), 'rb') as f:
+                    body = gzip.decompress(f.read())
+            except OSError:
+                log.warning('Cached response of %s is gone', url)
+                self.remove(url)
+                return None
+            self.conn.execute(
+                'UPDATE responses SET Accessed=? WHERE Url=?', (time.time(), url)
+            )
+        return body, row[1], row[2]
+
+    def put(self, url, body, etag=None, last_modified=None):
+        """
+        Store the response, then evict the least recently used ones if the
+        cache grew too big.
+        """
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        name = hashlib.sha1(url.encode('utf-8')).hexdigest() + '.gz'
+        data = gzip.compress(body)
+
+        with self.lock:
+            tmp_path = self.path(name + '.tmp')
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, self.path(name))
+
+            row = self.conn.execute(
+                'SELECT Size FROM responses WHERE Url=?', (url,)
+            ).fetchone()
+            now = time.time()
+            self.conn.execute(
+                'INSERT OR REPLACE INTO responses VALUES(?,?,?,?,?,?,?)',
+                (url, name, etag, last_modified, len(data), now, now)
+            )
+            self.size += len(data) - (row[0] if row else 0)
+            self.evict()
+        return
+
+    def evict(self):
+        with self.lock:
+            while self.size > self.max_bytes:
+                row = self.conn.execute(
+                    'SELECT Url FROM responses ORDER BY Accessed, rowid LIMIT 1'
+                ).fetchone()
+                if row is None:
+                    break
+                self.remove(row[0])
+        return
+
+    def remove(self, url):
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT File, Size FROM responses WHERE Url=?', (url,)
+            ).fetchone()
+            if row is None:
+                return
+            self.conn.execute('DELETE FROM responses WHERE Url=?', (url,))
+            self.size -= row[1]
+            try:
+                os.remove(self.path(row[0]))
+            except FileNotFoundError:
+                pass
+        return
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+        return
+
+
+class StartitSMTPTransport(object):
+    """
+    Send emails over a single authenticated SMTP connection, which is kept
+    open between messages, and reopened if the server drops it.
+    """
+
+    def __init__(self, user, password, host='smtp.gmail.com', port=587,
+                 starttls=True, timeout=60):
+        self.user = user
+        self.password = password
+        self.host = host
+        self.port = port
+        self.starttls = starttls
+        self.timeout = timeout
+        self.server = None
+
+    def connect(self):
+        self.server = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        if self.starttls:
+            self.server.starttls()
+        if self.password:
+            self.server.login(self.user, self.password)
+        return
+
+    def send(self, from_address, to_address, text):
+        if self.server is None:
+            self.connect()
+        try:
+            self.server.sendmail(from_address, to_address, text)
+        except smtplib.SMTPServerDisconnected:
+            # Idle connections get dropped, reconnect once.
+            self.connect()
+            self.server.sendmail(from_address, to_address, text)
+        return
+
+    def close(self):
+        if self.server is not None:
+            try:
+                self.server.quit()
+            except smtplib.SMTPException:
+                pass
+            self.server = None
+        return
+
+
+class StartitNotifier(object):
+    """
+    Send emails from a background thread, so that a slow mail server does not
+    stall the crawl. New jobs are collected per recipient for window seconds,
+    across categories and runs, and sent as one digest. A failed send is
+    retried with exponential backoff, then given up and logged.
+
+    Any object with send(from_address, to_address, text) and close() methods
+    can be used as the transport.
+    """
+    NEW_JOBS_SUBJECT = "Hey, a new job! ::::)"
+    UPDATED_JOBS_SUBJECT = "Hey, a job ad was updated ::::)"
+
+    def __init__(self, transport, from_address, window=0, retries=3,
+                 backoff=1):
+        self.transport = transport
+        self.from_address = from_address
+        self.window = window
+        self.retries = retries
+        self.backoff = backoff
+
+        self.queue = queue.Queue()
+        self.thread = None
+        self.sent = 0
+        self.failed = 0
+        # Seconds spent talking to the mail server.
+        self.seconds = 0.0
+
+    def start(self):
+        self.thread = threading.Thread(
+            target=self.run, name='startit-notifier', daemon=True
+        )
+        self.thread.start()
+        return
+
+    def notify_new_jobs(self, to_address, jobs):
+        """
+        Queue new jobs for the recipient's next digest.
+        """
+        self.queue.put(('jobs', to_address, list(jobs)))
+        return
+
+    def notify_updated_jobs(self, to_address, jobs):
+        """
+        Queue edited jobs for the recipient's next digest.
+        """
+        self.queue.put(('updated', to_address, list(jobs)))
+        return
+
+    def send(self, to_address, subject, body):
+        """
+        Queue an email, to be sent as soon as possible.
+        """
+        self.queue.put(('message', to_address, subject, body))
+        return
+
+    def close(self):
+        """
+        Send everything queued so far, including pending digests, and stop.
+        """
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+        self.transport.close()
+        return
+
+    def run(self):
+        digests = OrderedDict()
+        deadline = None
+        while True:
+            timeout = None
+            if deadline is not None:
+                timeout = max(0, deadline - time.monotonic())
+            try:
+                item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                item = False
+
+            if item is None:
+                self.flush(digests)
+                return
+            elif item is False:
+                self.flush(digests)
+                deadline = None
+            elif item[0] in ('jobs', 'updated'):
+                digest = digests.setdefault(item[1], {'jobs' : [], 'updated' : []})
+                digest[item[0]].extend(item[2])
+                if deadline is None:
+                    deadline = time.monotonic() + self.window
+            else:
+                self.deliver(*item[1:])
+
+    def flush(self, digests):
+        while digests:
+            to_address, digest = digests.popitem(last=False)
+            # The same job may be routed to a recipient more than once.
+            jobs = list(OrderedDict.fromkeys(digest['jobs']))
+            updated = [
+                job for job in OrderedDict.fromkeys(digest['updated'])
+                if job not in jobs
+            ]
+
+            body = self.format_jobs(jobs)
+            if updated:
+                body += 'Updated:\n\n' + self.format_jobs(updated)
+            subject = self.NEW_JOBS_SUBJECT if jobs else self.UPDATED_JOBS_SUBJECT
+            self.deliver(to_address, subject, body)
+        return
+
+    def format_jobs(self, jobs):
+        body = ''
+
+        for job in jobs:
+            body += job[0] + '\n' + job[1] + '\n' + job[2] + '\n' + job[3] + '\n\n'
+
+        return body
+
+    def deliver(self, to_address, subject, body):
+        msg = MIMEMultipart()
+        msg['From'] = self.from_address
+        msg['To'] = to_address
+        msg['Subject'] = subject
+        msg.attach(MIMEText(body.encode('utf-8'), _charset='utf-8'))
+        text = msg.as_string()
+
+        for attempt in range(self.retries + 1):
+            start = time.perf_counter()
+            try:
+                self.transport.send(self.from_address, to_address, text)
+                self.sent += 1
+                return True
+            except (smtplib.SMTPException, OSError):
+                log.warning(
+                    'Sending email to %s failed (attempt %d)', to_address,
+                    attempt + 1, exc_info=True
+                )
+                self.transport.close()
+            finally:
+                self.seconds += time.perf_counter() - start
+            if attempt < self.retries:
+                time.sleep(self.backoff * 2 ** attempt)
+
+        self.failed += 1
+        log.error('Giving up on email to %s: %s', to_address, subject)
+        return False
+
+
+class StartitTimings(OrderedDict):
+    """
+    Seconds a spider spent in each stage. Stages may be nested, e.g. pages
+    are fetched and parsed while jobs are streamed into the database; the
+    time of a nested stage counts only towards the nested one.
+    """
+    STAGES = ('fetch', 'parse', 'extract', 'sqlite')
+
+    def __init__(self):
+        super().__init__((stage, 0.0) for stage in self.STAGES)
+        self.nested = []
+
+    def enter(self):
+        self.nested.append(0.0)
+        return time.perf_counter()
+
+    def leave(self, stage, start):
+        elapsed = time.perf_counter() - start
+        self[stage] += elapsed - self.nested.pop()
+        if self.nested:
+            self.nested[-1] += elapsed
+        return
+
+    @contextmanager
+    def measure(self, stage):
+        start = self.enter()
+        try:
+            yield
+        finally:
+            self.leave(stage, start)
+
+
+class StartitMetrics(object):
+    """
+    Collect timings and counters of watched spiders, and hand a record of
+    each run to the hooks. A hook is any callable taking the record, e.g.
+    StartitJSONLog or StartitPrometheusTextfile.
+
+    Spiders which are not watched skip the timers altogether.
+    """
+    # Keys of Startit.stats. Ads are counted per type (see StartitJobTypes).
+    COUNTERS = (
+        'pages', 'bytes', 'skipped', 'failed', 'premium', 'standard', 'mini',
+        'new', 'expired', 'updated', 'duplicates', 'rows', 'emails',
+    )
+
+    def __init__(self, hooks=()):
+        self.hooks = list(hooks)
+        self.spiders = []
+        self.lock = threading.Lock()
+        # Notifier counters as of the previous report.
+        self.notified = {}
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+        return
+
+    def watch(self, spider):
+        """
+        Instrument the spider, and include it in the next report.
+        """
+        spider.metrics = self
+        spider.timings = StartitTimings()
+        with self.lock:
+            self.spiders.append(spider)
+        return
+
+    # Counters of StartitHTTPClient, reported when the run has a client.
+    HTTP_COUNTERS = ('requests', 'connections', 'reused', 'retried', 'saved')
+
+    def report(self, notifier=None, client=None):
+        """
+        Build a record of spiders watched since the previous report, and of
+        emails sent and requests made in the meantime, and pass it to the
+        hooks.
+        """
+        with self.lock:
+            spiders, self.spiders = self.spiders, []
+
+        categories = []
+        totals = OrderedDict((counter, 0) for counter in self.COUNTERS)
+        seconds = OrderedDict((stage, 0.0) for stage in StartitTimings.STAGES)
+        for spider in spiders:
+            category = OrderedDict([('url', spider.url)])
+            for counter in self.COUNTERS:
+                category[counter] = int(spider.stats[counter])
+                totals[counter] += category[counter]
+            category['seconds'] = OrderedDict(spider.timings)
+            for stage, spent in spider.timings.items():
+                seconds[stage] += spent
+            categories.append(category)
+
+        seconds['smtp'] = self.delta(notifier, 'seconds')
+        totals['emails-sent'] = self.delta(notifier, 'sent')
+        totals['emails-failed'] = self.delta(notifier, 'failed')
+        if client is not None:
+            for counter in self.HTTP_COUNTERS:
+                totals['http-' + counter] = self.delta(client, counter)
+
+        record = OrderedDict([('time', time.time())])
+        record.update(totals)
+        record['seconds'] = seconds
+        record['categories'] = categories
+
+        for hook in self.hooks:
+            try:
+                hook(record)
+            except Exception:
+                log.exception('Metrics hook %r failed', hook)
+        return record
+
+    def delta(self, source, counter):
+        """
+        Return how much the counter of the notifier, or of the HTTP client,
+        grew since the last report.
+        """
+        if source is None:
+            return 0
+        current = getattr(source, counter)
+        previous = self.notified.get((id(source), counter), 0)
+        self.notified[(id(source), counter)] = current
+        return current - previous
+
+
+class StartitJSONLog(object):
+    """
+    Metrics hook writing each record as a line of JSON, appended to the file,
+    or logged if there is no file.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+
+    def __call__(self, record):
+        line = json.dumps(record)
+        if self.path is None:
+            log.info('%s', line)
+            return
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.write(line + '\n')
+        return
+
+
+class StartitPrometheusTextfile(object):
+    """
+    Metrics hook writing the last record in the Prometheus text format, for
+    the node exporter's textfile collector. The file is replaced atomically,
+    so the collector never reads half of it.
+    """
+    PREFIX = 'startit_'
+
+    def __init__(self, path):
+        self.path = path
+
+    def __call__(self, record):
+        lines = []
+        self.metric(lines, 'last_run_timestamp_seconds', 'Time of the last run.',
+                    [({}, record['time'])])
+        self.metric(lines, 'stage_seconds', 'Seconds spent in each stage.', [
+            ({'stage' : stage}, spent) for stage, spent in record['seconds'].items()
+        ])
+        for counter in StartitMetrics.COUNTERS:
+            self.metric(lines, counter, 'Value of %s in the last run.' % counter, [
+                ({'url' : category['url']}, category[counter])
+                for category in record['categories']
+            ])
+        run_counters = ['emails-sent', 'emails-failed'] + [
+            'http-' + counter for counter in StartitMetrics.HTTP_COUNTERS
+            if 'http-' + counter in record
+        ]
+        for counter in run_counters:
+            self.metric(lines, counter.replace('-', '_'),
+                        'Value of %s in the last run.' % counter,
+                        [({}, record[counter])])
+
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(tmp_path, self.path)
+        return
+
+    def metric(self, lines, name, description, samples):
+        name = self.PREFIX + name
+        lines.append('# HELP %s %s' % (name, description))
+        lines.append('# TYPE %s gauge' % name)
+        for labels, value in samples:
+            label = ','.join(
+                '%s="%s"' % (key, text.replace('\\', '\\\\').replace('"', '\\"'))
+                for key, text in labels.items()
+            )
+            lines.append('%s%s %s' % (name, '{%s}' % label if label else '', value))
+        return
+
+
+class StartitRouter(object):
+    """
+    Match new jobs to subscribers. Filter values are kept in an inverted
+    index, so a job only touches the subscribers sharing one of its tags,
+    its company or one of the words in its title, and never scans every
+    subscriber.
+
+    A subscriber gets a job if, for every kind of filter the subscriber has,
+    at least one of its values matches. Subscribers without filters get all
+    jobs. Matching is case insensitive.
+    """
+    KINDS = ('tag', 'company', 'keyword')
+
+    WORD = re.compile(r'\w[\w+#.-]*')
+
+    def __init__(self, subscriptions=(), version=None):
+        self.index = {}
+        self.kinds = {}
+        self.everything = set()
+        self.version = version
+
+        for email, kind, value in subscriptions:
+            if kind is None:
+                self.everything.add(email)
+                continue
+            if kind not in self.KINDS:
+                raise StartitException('Unknown filter kind!')
+            self.index.setdefault((kind, value.strip().lower()), set()).add(email)
+            self.kinds.setdefault(email, set()).add(kind)
+        self.everything.difference_update(self.kinds)
+
+    @classmethod
+    def from_storage(cls, storage):
+        return cls(storage.subscriptions(), storage.subscriptions_version())
+
+    def terms(self, job):
+        """
+        Yield index keys describing a job, given as a database row.
+        """
+        for tag in json.loads(job[3]):
+            yield ('tag', tag.lower())
+        yield ('company', job[0].strip().lower())
+        for word in self.WORD.findall(job[1].lower()):
+            yield ('keyword', word)
+            yield ('keyword', word.rstrip('.-'))
+
+    def match(self, job):
+        """
+        Return emails of subscribers who should get the job.
+        """
+        matched = {}
+        for term in self.terms(job):
+            for email in self.index.get(term, ()):
+                matched.setdefault(email, set()).add(term[0])
+
+        emails = set(self.everything)
+        for email, kinds in matched.items():
+            if len(kinds) == len(self.kinds[email]):
+                emails.add(email)
+        return emails
+
+    def route(self, jobs):
+        """
+        Group jobs by the subscribers who should get them.
+        """
+        routed = OrderedDict()
+        for job in jobs:
+            for email in sorted(self.match(job)):
+                routed.setdefault(email, []).append(job)
+        return routed
+
+
+class StartitBloomFilter(object):
+    """
+    Set of keys in a fixed number of bits, sized for capacity keys at the
+    given false positive rate. Membership may be wrongly claimed, never
+    wrongly denied.
+    """
+
+    def __init__(self, capacity, error_rate=0.01):
+        self.size = max(8, int(
+            -capacity * math.log(error_rate) / math.log(2) ** 2
+        ))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def positions(self, key):
+        digest = hashlib.blake2b(repr(key).encode('ascii'), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], 'big')
+        second = int.from_bytes(digest[8:], 'big') | 1
+        return [(first + i * second) % self.size for i in range(self.hashes)]
+
+    def add(self, key):
+        for position in self.positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        return
+
+    def __contains__(self, key):
+        return all(
+            self.bits[position >> 3] & (1 << (position & 7))
+            for position in self.positions(key)
+        )
+
+
+class StartitSeenIndex(object):
+    """
+    Posting versions handled so far, by any category, in this run or an
+    earlier one. A posting listed under several categories gets its details
+    fetched and is notified about only once, by whichever category claims
+    it first; the others skip it.
+
+    Postings are keyed by their url fingerprint and content hash, so an
+    edited ad is handled again, once. Keys are kept in the database, and in
+    memory as a set; for large histories, a Bloom filter can stand in for
+    the set, and only its positive answers are checked in the database.
+    """
+
+    def __init__(self, storage, bloom_capacity=0):
+        self.storage = storage
+        # Records claimed postings instead of the storage, if set.
+        self.writer = None
+        self.lock = threading.Lock()
+        if bloom_capacity:
+            self.keys = StartitBloomFilter(bloom_capacity)
+        else:
+            self.keys = set()
+        for key in storage.seen_keys():
+            self.keys.add(tuple(key))
+
+    def seen(self, key):
+        if key not in self.keys:
+            return False
+        if isinstance(self.keys, StartitBloomFilter):
+            return self.storage.has_seen(key)
+        return True
+
+    def claim(self, jobs, source):
+        """
+        Return the jobs, given as database rows, which were not handled
+        before, and record them as handled by the source.
+        """
+        fresh, keys = [], []
+        with self.lock:
+            for job in jobs:
+                key = (job_fingerprint(job[2]), job_content_hash(job[0], job[1], job[3]))
+                if key in keys or self.seen(key):
+                    continue
+                fresh.append(job)
+                keys.append(key)
+            if keys:
+                (self.writer or self.storage).mark_seen(keys, source)
+                for key in keys:
+                    self.keys.add(key)
+        return fresh
+
+
+def job_fingerprint(url):
+    """
+    Return the stable id of a posting: a 64-bit hash of its url, which stays
+    the same however the ad is edited. Only the scheme and host are
+    normalized, and the fragment dropped.
+    """
+    parts = urlparse(url.strip())
+    url = parts._replace(
+        scheme=parts.scheme.lower(), netloc=parts.netloc.lower(), fragment=''
+    ).geturl()
+    return int.from_bytes(
+        hashlib.sha1(url.encode('utf-8')).digest()[:8], 'big', signed=True
+    )
+
+
+def job_content_hash(company_title, job_title, tags):
+    """
+    Return a 64-bit hash of what an ad says, tags given as stored (JSON).
+    """
+    content = '\x1f'.join((company_title or '', job_title or '', tags or ''))
+    return int.from_bytes(
+        hashlib.sha1(content.encode('utf-8')).digest()[:8], 'big', signed=True
+    )
+
+
+class StartitStorage(object):
+    """
+    Jobs database. A single connection is kept open for the whole run, and
+    writes are batched with executemany inside one transaction. The schema is
+    versioned with PRAGMA user_version, and brought up to date by applying
+    pending MIGRATIONS when the storage is opened, so existing data is never
+    dropped.
+
+    The connection may be shared by several threads; access is serialized.
+    """
+    PRAGMAS = """
+        PRAGMA journal_mode=WAL;
+        PRAGMA synchronous=NORMAL;
+        PRAGMA temp_store=MEMORY;
+        PRAGMA cache_size=-16000;
+    """
+
+    # Schema changes, in order. Never edit an existing migration, append a new
+    # one instead. Migrations must also work on databases created before
+    # migrations existed, hence IF NOT EXISTS.
+    MIGRATIONS = (
+        """
+        CREATE TABLE IF NOT EXISTS jobs (
+          CompanyTitle TEXT,
+          JobTitle TEXT,
+          Url TEXT,
+          Tags BLOB,
+          Active TEXT,
+          FirstCrawled TEXT
+         );
+        """,
+        # Old databases may have the same url active more than once. Only the
+        # latest of those rows is kept active.
+        """
+        UPDATE jobs SET Active=0
+        WHERE Active=1 AND rowid NOT IN (
+          SELECT MAX(rowid) FROM jobs WHERE Active=1 GROUP BY Url
+        );
+
+        CREATE UNIQUE INDEX IF NOT EXISTS jobs_active_url
+          ON jobs(Url) WHERE Active=1;
+        """,
+        # Validators of the last processed response, per page. Used to skip
+        # pages which have not changed since the previous crawl.
+        """
+        CREATE TABLE IF NOT EXISTS pages (
+          Url TEXT PRIMARY KEY,
+          ETag TEXT,
+          LastModified TEXT,
+          Hash TEXT
+         );
+        """,
+        # Category each job was crawled from, so that categories can be polled
+        # independently. Rows from before this migration have no source, and
+        # are claimed by the first category crawled (see claim_legacy).
+        """
+        ALTER TABLE jobs ADD COLUMN Source TEXT;
+
+        DROP INDEX IF EXISTS jobs_active_url;
+        CREATE UNIQUE INDEX jobs_active_source_url
+          ON jobs(Source, Url) WHERE Active=1;
+        """,
+        # Poll history of each source, driving the daemon's poll intervals.
+        """
+        CREATE TABLE polls (
+          Source TEXT PRIMARY KEY,
+          Interval REAL,
+          Polls INTEGER,
+          Changes INTEGER,
+          LastPolled REAL,
+          LastChanged REAL
+         );
+        """,
+        # Subscribers, and the filters new jobs are matched against. Kind is
+        # one of StartitRouter.KINDS.
+        """
+        CREATE TABLE subscribers (
+          Id INTEGER PRIMARY KEY,
+          Email TEXT UNIQUE
+         );
+
+        CREATE TABLE subscriber_filters (
+          SubscriberId INTEGER REFERENCES subscribers(Id) ON DELETE CASCADE,
+          Kind TEXT,
+          Value TEXT
+         );
+
+        CREATE INDEX subscriber_filters_subscriber
+          ON subscriber_filters(SubscriberId);
+        """,
+        # Tags, normalized so that jobs can be looked up by tag through an
+        # index. The jobs table is rebuilt to give jobs a stable id (rowids
+        # of a table without one may change on VACUUM). Triggers keep
+        # job_tags in sync with the Tags column, however jobs are written.
+        """
+        CREATE TABLE jobs_rebuilt (
+          Id INTEGER PRIMARY KEY,
+          CompanyTitle TEXT,
+          JobTitle TEXT,
+          Url TEXT,
+          Tags BLOB,
+          Active TEXT,
+          FirstCrawled TEXT,
+          Source TEXT
+         );
+
+        INSERT INTO jobs_rebuilt
+        SELECT rowid, CompanyTitle, JobTitle, Url, Tags, Active, FirstCrawled, Source
+        FROM jobs;
+
+        DROP TABLE jobs;
+        ALTER TABLE jobs_rebuilt RENAME TO jobs;
+
+        CREATE UNIQUE INDEX jobs_active_source_url
+          ON jobs(Source, Url) WHERE Active=1;
+
+        CREATE TABLE tags (
+          Id INTEGER PRIMARY KEY,
+          Name TEXT UNIQUE COLLATE NOCASE
+         );
+
+        CREATE TABLE job_tags (
+          TagId INTEGER REFERENCES tags(Id),
+          JobId INTEGER REFERENCES jobs(Id),
+          PRIMARY KEY (TagId, JobId)
+         ) WITHOUT ROWID;
+
+        CREATE INDEX job_tags_job ON job_tags(JobId);
+
+        CREATE TRIGGER jobs_tags_insert AFTER INSERT ON jobs BEGIN
+          INSERT OR IGNORE INTO tags (Name)
+          SELECT value FROM json_each(
+            CASE WHEN json_valid(NEW.Tags) THEN NEW.Tags ELSE '[]' END
+          );
+          INSERT OR IGNORE INTO job_tags (TagId, JobId)
+          SELECT tags.Id, NEW.Id FROM json_each(
+            CASE WHEN json_valid(NEW.Tags) THEN NEW.Tags ELSE '[]' END
+          ) AS tag JOIN tags ON tags.Name=tag.value;
+        END;
+
+        CREATE TRIGGER jobs_tags_delete AFTER DELETE ON jobs BEGIN
+          DELETE FROM job_tags WHERE JobId=OLD.Id;
+        END;
+
+        INSERT OR IGNORE INTO tags (Name)
+        SELECT tag.value FROM jobs, json_each(
+          CASE WHEN json_valid(jobs.Tags) THEN jobs.Tags ELSE '[]' END
+        ) AS tag;
+
+        INSERT OR IGNORE INTO job_tags (TagId, JobId)
+        SELECT tags.Id, jobs.Id FROM jobs, json_each(
+          CASE WHEN json_valid(jobs.Tags) THEN jobs.Tags ELSE '[]' END
+        ) AS tag JOIN tags ON tags.Name=tag.value;
+        """,
+        # Details taken from the job's own page, so that it is fetched once.
+        """
+        CREATE TABLE details (
+          Url TEXT PRIMARY KEY,
+          Description TEXT,
+          Location TEXT,
+          Seniority TEXT,
+          Fetched TEXT
+         );
+        """,
+        # Jobs are identified by the fingerprint of their url, and diffed by
+        # a hash of their content, so an edited ad is updated in place. What
+        # it said before is kept in job_versions.
+        """
+        ALTER TABLE jobs ADD COLUMN Fingerprint INTEGER;
+        ALTER TABLE jobs ADD COLUMN ContentHash INTEGER;
+
+        UPDATE jobs SET
+          Fingerprint=startit_fingerprint(Url),
+          ContentHash=startit_content_hash(CompanyTitle, JobTitle, Tags);
+
+        UPDATE jobs SET Active=0
+        WHERE Active=1 AND Id NOT IN (
+          SELECT MAX(Id) FROM jobs WHERE Active=1 GROUP BY Source, Fingerprint
+        );
+
+        DROP INDEX jobs_active_source_url;
+        CREATE UNIQUE INDEX jobs_active_source_fingerprint
+          ON jobs(Source, Fingerprint) WHERE Active=1;
+
+        CREATE TABLE job_versions (
+          JobId INTEGER REFERENCES jobs(Id),
+          Version INTEGER,
+          CompanyTitle TEXT,
+          JobTitle TEXT,
+          Url TEXT,
+          Tags BLOB,
+          ContentHash INTEGER,
+          Replaced TEXT,
+          PRIMARY KEY (JobId, Version)
+         );
+
+        CREATE TRIGGER jobs_tags_update AFTER UPDATE OF Tags ON jobs BEGIN
+          DELETE FROM job_tags WHERE JobId=OLD.Id;
+          INSERT OR IGNORE INTO tags (Name)
+          SELECT value FROM json_each(
+            CASE WHEN json_valid(NEW.Tags) THEN NEW.Tags ELSE '[]' END
+          );
+          INSERT OR IGNORE INTO job_tags (TagId, JobId)
+          SELECT tags.Id, NEW.Id FROM json_each(
+            CASE WHEN json_valid(NEW.Tags) THEN NEW.Tags ELSE '[]' END
+          ) AS tag JOIN tags ON tags.Name=tag.value;
+        END;
+        """,
+        # Versions of postings already handled by some category, so that a
+        # posting listed under several categories is handled only once (see
+        # StartitSeenIndex).
+        """
+        CREATE TABLE seen (
+          Fingerprint INTEGER,
+          ContentHash INTEGER,
+          Source TEXT,
+          FirstSeen TEXT,
+          PRIMARY KEY (Fingerprint, ContentHash)
+         ) WITHOUT ROWID;
+
+        INSERT OR IGNORE INTO seen
+        SELECT Fingerprint, ContentHash, Source, FirstCrawled FROM jobs
+        ORDER BY Id;
+
+        INSERT OR IGNORE INTO seen
+        SELECT jobs.Fingerprint, job_versions.ContentHash, jobs.Source,
+          job_versions.Replaced
+        FROM job_versions JOIN jobs ON jobs.Id=job_versions.JobId;
+        """,
+        # When jobs were deactivated, and archived pages being backfilled
+        # (see StartitBackfill). Jobs holds the page's jobs as JSON rows, until
+        # the capture is replayed.
+        """
+        ALTER TABLE jobs ADD COLUMN Deactivated TEXT;
+
+        CREATE TABLE snapshots (
+          Source TEXT,
+          Captured TEXT,
+          Page INTEGER,
+          Jobs TEXT,
+          Replayed INTEGER DEFAULT 0,
+          PRIMARY KEY (Source, Captured, Page)
+         ) WITHOUT ROWID;
+        """,
+        # Full-text index of titles and tags, for StartitQueryService. It is
+        # external content, kept in sync with jobs by triggers.
+        """
+        CREATE VIRTUAL TABLE jobs_fts USING fts5(
+          CompanyTitle, JobTitle, Tags,
+          content='jobs', content_rowid='Id',
+          tokenize='unicode61 remove_diacritics 2'
+        );
+        INSERT INTO jobs_fts(jobs_fts) VALUES('rebuild');
+
+        CREATE TRIGGER jobs_fts_insert AFTER INSERT ON jobs BEGIN
+          INSERT INTO jobs_fts(rowid, CompanyTitle, JobTitle, Tags)
+          VALUES (NEW.Id, NEW.CompanyTitle, NEW.JobTitle, NEW.Tags);
+        END;
+
+        CREATE TRIGGER jobs_fts_delete AFTER DELETE ON jobs BEGIN
+          INSERT INTO jobs_fts(jobs_fts, rowid, CompanyTitle, JobTitle, Tags)
+          VALUES ('delete', OLD.Id, OLD.CompanyTitle, OLD.JobTitle, OLD.Tags);
+        END;
+
+        CREATE TRIGGER jobs_fts_update
+        AFTER UPDATE OF CompanyTitle, JobTitle, Tags ON jobs BEGIN
+          INSERT INTO jobs_fts(jobs_fts, rowid, CompanyTitle, JobTitle, Tags)
+          VALUES ('delete', OLD.Id, OLD.CompanyTitle, OLD.JobTitle, OLD.Tags);
+          INSERT INTO jobs_fts(rowid, CompanyTitle, JobTitle, Tags)
+          VALUES (NEW.Id, NEW.CompanyTitle, NEW.JobTitle, NEW.Tags);
+        END;
+        """,
+        # Jobs by source, so that a crawl finds whether its source was
+        # crawled before, and jobs without a source, by index.
+        """
+        CREATE INDEX jobs_source ON jobs(Source);
+        """,
+    )
+
+    # Jobs found by the current crawl. They are diffed against active jobs of
+    # the same source with joins on Url, which is unique and indexed on both
+    # sides.
+    STAGING_TEMPLATE = """
+        CREATE TEMP TABLE crawl (
+          Fingerprint INTEGER UNIQUE,
+          ContentHash INTEGER,
+          CompanyTitle TEXT,
+          JobTitle TEXT,
+          Url TEXT,
+          Tags BLOB
+         );
+    """
+
+    def __init__(self, path, timeout=30):
+        self.path = path
+        # Set if the database did not exist before, i.e. this is the first
+        # time the spider is set loose. Cleared once a crawl is stored.
+        self.created = not os.path.exists(path)
+
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(
+            path, timeout=timeout, isolation_level=None,
+            check_same_thread=False
+        )
+        # Used by migrations to hash jobs stored before hashes were.
+        self.conn.create_function('startit_fingerprint', 1, job_fingerprint)
+        self.conn.create_function('startit_content_hash', 3, job_content_hash)
+        self.conn.executescript(self.PRAGMAS)
+        self.migrate()
+
+    def migrate(self):
+        """
+        Apply pending migrations, each in its own transaction. The version is
+        checked again once the write lock is held, since another process may
+        have applied the migration in the meantime.
+        """
+        with self.lock:
+            version = self.conn.execute('PRAGMA user_version').fetchone()[0]
+            for number, migration in enumerate(self.MIGRATIONS, 1):
+                if number <= version:
+                    continue
+                with self.transaction() as c:
+                    if c.execute('PRAGMA user_version').fetchone()[0] >= number:
+                        continue
+                    for statement in self.split_statements(migration):
+                        c.execute(statement)
+                    c.execute('PRAGMA user_version=%d' % number)
+        return
+
+    def split_statements(self, script):
+        """
+        Split an SQL script into complete statements. Unlike executescript,
+        this lets a script run inside an already open transaction.
+        """
+        statement = ''
+        for part in script.split(';'):
+            statement += part + ';'
+            if sqlite3.complete_statement(statement):
+                if statement.strip(' \n;'):
+                    yield statement.strip()
+                statement = ''
+        return
+
+    @contextmanager
+    def transaction(self):
+        """
+        Run the block inside a single write transaction, and yield a cursor.
+        """
+        with self.lock:
+            cursor = self.conn.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            try:
+                yield cursor
+            except BaseException:
+                cursor.execute('ROLLBACK')
+                raise
+            cursor.execute('COMMIT')
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+        return
+
+    def has_jobs(self, source):
+        """
+        Check if the source was crawled before.
+        """
+        with self.lock:
+            return self.conn.execute(
+                'SELECT 1 FROM jobs WHERE Source=? LIMIT 1', (source,)
+            ).fetchone() is not None
+
+    def apply_crawl(self, source, tup_jobs, crawled=None):
+        """
+        Diff jobs of the current crawl against active jobs of the same source,
+        in a single transaction. Jobs are matched by fingerprint, and compared
+        by content hash. Expired jobs are deactivated, edited ones updated,
+        with their previous version kept in job_versions, and new ones
+        inserted. Return new jobs, the number of expired ones, and updated
+        jobs.
+
+        Changes are dated crawled, as a string, or now. Archived crawls pass
+        their capture time (see StartitBackfill).
+
+        Jobs may be streamed, e.g. straight from the network. They are staged
+        before the write transaction begins, so the database is not locked for
+        writing while they arrive.
+        """
+        with self.lock:
+            self.stage(tup_jobs)
+            with self.transaction() as c:
+                return self.apply_staged(c, source, crawled)
+
+    def record_crawl(self, source, tup_jobs, crawled=None):
+        """
+        Apply the crawl as apply_crawl does, and return whether it is the
+        first crawl of the source, followed by apply_crawl's result. Both
+        are decided in the same transaction, so crawls of several sources
+        applied at once can not all take themselves for crawled before.
+        """
+        with self.lock:
+            self.stage(tup_jobs)
+            with self.transaction() as c:
+                return self.record_staged(c, source, crawled)
+
+    def apply_crawls(self, crawls):
+        """
+        Apply several crawls, given as (source, jobs, crawled), in a single
+        write transaction, and return their results in order. Either all of
+        them are applied, or none.
+        """
+        return self.apply_writes(('apply_crawl', crawl) for crawl in crawls)
+
+    # Writes of staged crawls apply_writes takes, by name, and the methods
+    # doing them within a transaction.
+    CRAWL_WRITES = {
+        'apply_crawl' : 'apply_staged',
+        'record_crawl' : 'record_staged',
+    }
+    # Other writes apply_writes takes.
+    WRITES = {
+        'save_validators' : 'write_validators',
+        'save_details' : 'write_details',
+        'mark_seen' : 'write_seen',
+        'record_poll' : 'write_poll',
+    }
+
+    def apply_writes(self, writes):
+        """
+        Apply several writes, given as (name, args), in a single write
+        transaction, and return their results in order. A write is named
+        after the method doing it on its own, one of CRAWL_WRITES or WRITES.
+        Either all of them are applied, or none.
+        """
+        with self.transaction() as c:
+            results = []
+            for name, args in writes:
+                if name in self.CRAWL_WRITES:
+                    source, tup_jobs, crawled = args
+                    self.fill_staging(c, tup_jobs)
+                    results.append(
+                        getattr(self, self.CRAWL_WRITES[name])(c, source, crawled)
+                    )
+                else:
+                    results.append(getattr(self, self.WRITES[name])(c, *args))
+        return results
+
+    def apply_staged(self, cursor, source, crawled=None):
+        """
+        Diff the staged crawl against active jobs of the source, within the
+        cursor's transaction. See apply_crawl.
+        """
+        self.claim_legacy(cursor, source)
+        expired = self.deactivate_unstaged(cursor, source, crawled)
+        updated_jobs = self.update_staged(cursor, source, crawled)
+        new_jobs = self.new_staged(cursor, source)
+        self.insert_new_staged(cursor, source, crawled)
+        self.created = False
+        return new_jobs, expired, updated_jobs
+
+    def record_staged(self, cursor, source, crawled=None):
+        """
+        Return whether the source was never crawled, followed by the result
+        of apply_staged. See record_crawl.
+        """
+        self.claim_legacy(cursor, source)
+        first = cursor.execute(
+            'SELECT 1 FROM jobs WHERE Source=? LIMIT 1', (source,)
+        ).fetchone() is None
+        return (first,) + self.apply_staged(cursor, source, crawled)
+
+    def claim_legacy(self, cursor, source):
+        """
+        Give jobs stored before sources were kept, expired ones included, to
+        the source. They belong to the first source crawled since. Once
+        claimed, there are none left, and the index on Source finds that
+        right away.
+        """
+        cursor.execute('UPDATE jobs SET Source=? WHERE Source IS NULL', (source,))
+        return
+
+    def claim_created(self):
+        """
+        Return True if this connection created the database, only the first
+        time it is asked.
+        """
+        with self.lock:
+            created, self.created = self.created, False
+        return created
+
+    def stage(self, tup_jobs):
+        """
+        Load jobs of the current crawl into the temporary crawl table. If the
+        same url is listed more than once, the first listing is kept.
+        """
+        with self.lock:
+            c = self.conn.cursor()
+            # Only the temporary database is written to, so this does not
+            # block writers of the jobs database.
+            c.execute('BEGIN')
+            try:
+                self.fill_staging(c, tup_jobs)
+            except BaseException:
+                c.execute('ROLLBACK')
+                raise
+            c.execute('COMMIT')
+        return
+
+    def fill_staging(self, cursor, tup_jobs):
+        cursor.execute('DROP TABLE IF EXISTS temp.crawl')
+        cursor.execute(self.STAGING_TEMPLATE)
+        cursor.executemany(
+            'INSERT OR IGNORE INTO crawl VALUES(?,?,?,?,?,?)',
+            (self.hashed(job) for job in tup_jobs)
+        )
+        return
+
+    def hashed(self, job):
+        """
+        Return the job's fingerprint and content hash, followed by the job.
+        """
+        return (
+            job_fingerprint(job[2]), job_content_hash(job[0], job[1], job[3])
+        ) + tuple(job)
+
+    def deactivate_unstaged(self, cursor, source, crawled=None):
+        """
+        Deactivate active jobs of the source which are not in the current
+        crawl, and return their number.
+        """
+        cursor.execute("""
+            UPDATE jobs
+            SET Active=0, Deactivated=?
+            WHERE Source=? AND Active=1 AND NOT EXISTS (
+              SELECT 1 FROM crawl WHERE crawl.Fingerprint=jobs.Fingerprint
+            )
+        """, (crawled or str(datetime.now()), source))
+        return cursor.rowcount
+
+    def update_staged(self, cursor, source, crawled=None):
+        """
+        Update active jobs of the source whose content changed, keeping what
+        they said before in job_versions. Return the updated jobs.
+        """
+        cursor.execute("""
+            SELECT crawl.CompanyTitle, crawl.JobTitle, crawl.Url, crawl.Tags
+            FROM crawl JOIN jobs
+              ON jobs.Source=? AND jobs.Fingerprint=crawl.Fingerprint
+                AND jobs.Active=1
+            WHERE jobs.ContentHash IS NOT crawl.ContentHash
+            ORDER BY crawl.rowid
+        """, (source,))
+        updated_jobs = cursor.fetchall()
+        if not updated_jobs:
+            return updated_jobs
+
+        cursor.execute("""
+            INSERT INTO job_versions
+            SELECT
+              jobs.Id,
+              (SELECT COUNT(*) + 1 FROM job_versions WHERE JobId=jobs.Id),
+              jobs.CompanyTitle, jobs.JobTitle, jobs.Url, jobs.Tags,
+              jobs.ContentHash, ?
+            FROM crawl JOIN jobs
+              ON jobs.Source=? AND jobs.Fingerprint=crawl.Fingerprint
+                AND jobs.Active=1
+            WHERE jobs.ContentHash IS NOT crawl.ContentHash
+        """, (crawled or str(datetime.now()), source))
+        cursor.execute("""
+            UPDATE jobs
+            SET (CompanyTitle, JobTitle, Url, Tags, ContentHash) = (
+              SELECT CompanyTitle, JobTitle, Url, Tags, ContentHash FROM crawl
+              WHERE crawl.Fingerprint=jobs.Fingerprint
+            )
+            WHERE Source=? AND Active=1 AND EXISTS (
+              SELECT 1 FROM crawl
+              WHERE crawl.Fingerprint=jobs.Fingerprint
+                AND crawl.ContentHash IS NOT jobs.ContentHash
+            )
+        """, (source,))
+        return updated_jobs
+
+    def new_staged(self, cursor, source):
+        """
+        Return jobs of the current crawl which are not active for the source.
+        """
+        cursor.execute("""
+            SELECT CompanyTitle, JobTitle, Url, Tags FROM crawl
+            WHERE NOT EXISTS (
+              SELECT 1 FROM jobs
+              WHERE jobs.Source=? AND jobs.Fingerprint=crawl.Fingerprint
+                AND jobs.Active=1
+            )
+            ORDER BY crawl.rowid
+        """, (source,))
+        return cursor.fetchall()
+
+    def insert_new_staged(self, cursor, source, crawled=None):
+        """
+        Insert jobs of the current crawl which are not active for the source,
+        and return their number. Expired jobs must be deactivated first.
+        """
+        cursor.execute("""
+            INSERT INTO jobs
+              (CompanyTitle, JobTitle, Url, Tags, Active, FirstCrawled, Source,
+               Fingerprint, ContentHash)
+            SELECT CompanyTitle, JobTitle, Url, Tags, 1, ?, ?, Fingerprint,
+              ContentHash
+            FROM crawl
+            WHERE NOT EXISTS (
+              SELECT 1 FROM jobs
+              WHERE jobs.Source=? AND jobs.Fingerprint=crawl.Fingerprint
+                AND jobs.Active=1
+            )
+            ORDER BY crawl.rowid
+        """, (crawled or str(datetime.now()), source, source))
+        return cursor.rowcount
+
+    def job_versions(self, url):
+        """
+        Return earlier versions of the job at url, oldest first, as
+        (version, company title, job title, url, tags, replaced).
+        """
+        with self.lock:
+            return self.conn.execute("""
+                SELECT Version, job_versions.CompanyTitle, job_versions.JobTitle,
+                  job_versions.Url, job_versions.Tags, Replaced
+                FROM job_versions JOIN jobs ON jobs.Id=job_versions.JobId
+                WHERE jobs.Fingerprint=?
+                ORDER BY jobs.Id, Version
+            """, (job_fingerprint(url),)).fetchall()
+
+    def active_jobs(self, source=None):
+        """
+        Return all active jobs, or only those of the given source.
+        """
+        query = 'SELECT CompanyTitle, JobTitle, Url, Tags FROM jobs WHERE Active=1'
+        with self.lock:
+            if source is None:
+                return self.conn.execute(query + ' ORDER BY Id').fetchall()
+            return self.conn.execute(
+                query + ' AND Source=? ORDER BY Id', (source,)
+            ).fetchall()
+
+    def jobs_with_tags(self, tags, active=True):
+        """
+        Return jobs having all the given tags, newest first. Tags are matched
+        case insensitively. If active is None, inactive jobs are included.
+        """
+        tags = list(OrderedDict.fromkeys(tag.lower() for tag in tags))
+        if not tags:
+            return []
+
+        query = """
+            SELECT CompanyTitle, JobTitle, Url, Tags FROM jobs
+            WHERE Id IN (
+              SELECT JobId FROM job_tags
+              JOIN tags ON tags.Id=job_tags.TagId
+              WHERE tags.Name IN (%s)
+              GROUP BY JobId
+              HAVING COUNT(*)=?
+            )
+        """ % ','.join('?' * len(tags))
+        params = tags + [len(tags)]
+        if active is not None:
+            query += ' AND Active=?'
+            params.append(1 if active else 0)
+        query += ' ORDER BY Id DESC'
+
+        with self.lock:
+            return self.conn.execute(query, params).fetchall()
+
+    @classmethod
+    def search_query(cls, keywords=None, tags=(), company=None, active=None,
+                     source=None, before=None, limit=None):
+        """
+        Return the query, and its parameters, selecting jobs newest first,
+        as (id, company title, job title, url, tags, active, first crawled,
+        deactivated, source).
+
+        Keywords are matched against the full-text index of titles and tags,
+        each as a word, or as a prefix if it ends with *. Tags must all match,
+        company exactly, both case insensitively. Only jobs older than the
+        before id are selected, for keyset pagination.
+        """
+        where, params = [], []
+        words = []
+        for word in (keywords or '').split():
+            prefix = word.endswith('*')
+            word = word.rstrip('*')
+            if word:
+                words.append('"%s"%s' % (word.replace('"', '""'), '*' if prefix else ''))
+        if words:
+            where.append('Id IN (SELECT rowid FROM jobs_fts WHERE jobs_fts MATCH ?)')
+            params.append(' '.join(words))
+
+        tags = list(OrderedDict.fromkeys(tag.lower() for tag in tags))
+        if tags:
+            where.append("""Id IN (
+              SELECT JobId FROM job_tags
+              JOIN tags ON tags.Id=job_tags.TagId
+              WHERE tags.Name IN (%s)
+              GROUP BY JobId
+              HAVING COUNT(*)=?
+            )""" % ','.join('?' * len(tags)))
+            params.extend(tags + [len(tags)])
+
+        if company is not None:
+            where.append('CompanyTitle=? COLLATE NOCASE')
+            params.append(company)
+        if active is not None:
+            where.append('Active=?')
+            params.append(1 if active else 0)
+        if source is not None:
+            where.append('Source=?')
+            params.append(source)
+        if before is not None:
+            where.append('Id<?')
+            params.append(before)
+
+        query = """
+            SELECT Id, CompanyTitle, JobTitle, Url, Tags, Active, FirstCrawled,
+              Deactivated, Source
+            FROM jobs
+        """
+        if where:
+            query += ' WHERE ' + ' AND '.join(where)
+        query += ' ORDER BY Id DESC'
+        if limit is not None:
+            query += ' LIMIT %d' % limit
+        return query, params
+
+    def insert_jobs(self, tup_jobs, active, source=None):
+        """
+        Write jobs in one batch. All of them get the same crawl time.
+        """
+        crawled = str(datetime.now())
+        with self.transaction() as c:
+            c.executemany("""
+                INSERT INTO jobs
+                  (Fingerprint, ContentHash, CompanyTitle, JobTitle, Url, Tags,
+                   Active, FirstCrawled, Source)
+                VALUES(?,?,?,?,?,?,?,?,?)
+            """, (self.hashed(job) + (active, crawled, source) for job in tup_jobs))
+        return
+
+    def deactivate_jobs(self, tup_jobs, source=None):
+        deactivated = str(datetime.now())
+        with self.transaction() as c:
+            c.executemany("""
+                UPDATE jobs
+                SET Active=0, Deactivated=?
+                WHERE Source IS ? AND Fingerprint=? AND Active=1
+                  AND ContentHash=?
+            """, ((deactivated, source) + self.hashed(job)[:2] for job in tup_jobs))
+        return
+
+    def load_validators(self, url):
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT ETag, LastModified, Hash FROM pages WHERE Url=?', (url,)
+            ).fetchone()
+        if row is None:
+            return None
+        return {'etag' : row[0], 'last-modified' : row[1], 'hash' : row[2]}
+
+    def save_validators(self, validators):
+        with self.transaction() as c:
+            self.write_validators(c, validators)
+        return
+
+    def write_validators(self, cursor, validators):
+        cursor.execute('INSERT OR REPLACE INTO pages VALUES(?,?,?,?)', validators)
+        return
+
+    def load_details(self, urls):
+        """
+        Return details of the urls which were fetched before, by url.
+        """
+        details = {}
+        with self.lock:
+            c = self.conn.cursor()
+            for url in urls:
+                row = c.execute(
+                    'SELECT Description, Location, Seniority FROM details WHERE Url=?',
+                    (url,)
+                ).fetchone()
+                if row is not None:
+                    details[url] = row
+        return details
+
+    def save_details(self, details):
+        """
+        Store details, given as (url, description, location, seniority).
+        """
+        with self.transaction() as c:
+            self.write_details(c, details)
+        return
+
+    def write_details(self, cursor, details):
+        fetched = str(datetime.now())
+        cursor.executemany(
+            'INSERT OR REPLACE INTO details VALUES(?,?,?,?,?)',
+            (tuple(row) + (fetched,) for row in details)
+        )
+        return
+
+    def seen_keys(self):
+        """
+        Yield (fingerprint, content hash) of every posting version handled
+        so far. The storage is locked until the iteration is done.
+        """
+        with self.lock:
+            for row in self.conn.execute('SELECT Fingerprint, ContentHash FROM seen'):
+                yield row
+
+    def has_seen(self, key):
+        with self.lock:
+            return self.conn.execute(
+                'SELECT 1 FROM seen WHERE Fingerprint=? AND ContentHash=?', key
+            ).fetchone() is not None
+
+    def mark_seen(self, keys, source):
+        """
+        Record posting versions, given as (fingerprint, content hash), as
+        handled by the source.
+        """
+        with self.transaction() as c:
+            self.write_seen(c, keys, source)
+        return
+
+    def write_seen(self, cursor, keys, source):
+        seen = str(datetime.now())
+        cursor.executemany(
+            'INSERT OR IGNORE INTO seen VALUES(?,?,?,?)',
+            (tuple(key) + (source, seen) for key in keys)
+        )
+        return
+
+    def changes(self, source):
+        """
+        Return when jobs of the source first appeared, and when they last
+        appeared or expired, or (None, None).
+        """
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT MIN(FirstCrawled), MAX(FirstCrawled), MAX(Deactivated) '
+                'FROM jobs WHERE Source=?',
+                (source,)
+            ).fetchone()
+        return row[0], max((date for date in row[1:] if date), default=None)
+
+    def snapshot_keys(self):
+        """
+        Return (source, captured, page) of every snapshot loaded so far,
+        replayed or not.
+        """
+        with self.lock:
+            return set(self.conn.execute(
+                'SELECT Source, Captured, Page FROM snapshots'
+            ))
+
+    def save_snapshots(self, snapshots):
+        """
+        Store parsed snapshots, given as (source, captured, page, jobs), jobs
+        as database rows.
+        """
+        with self.transaction() as c:
+            c.executemany(
+                'INSERT OR IGNORE INTO snapshots VALUES(?,?,?,?,0)',
+                ((source, captured, page, json.dumps(jobs))
+                 for source, captured, page, jobs in snapshots)
+            )
+        return
+
+    def snapshot_sources(self):
+        with self.lock:
+            return [row[0] for row in self.conn.execute(
+                'SELECT DISTINCT Source FROM snapshots WHERE Replayed=0 ORDER BY Source'
+            )]
+
+    def snapshot_captures(self, source):
+        """
+        Return capture times of the source not replayed yet, in order.
+        """
+        with self.lock:
+            return [row[0] for row in self.conn.execute(
+                'SELECT DISTINCT Captured FROM snapshots '
+                'WHERE Source=? AND Replayed=0 ORDER BY Captured',
+                (source,)
+            )]
+
+    def snapshot_jobs(self, source, captured):
+        """
+        Return jobs of the capture, in page order.
+        """
+        with self.lock:
+            pages = self.conn.execute(
+                'SELECT Jobs FROM snapshots WHERE Source=? AND Captured=? ORDER BY Page',
+                (source, captured)
+            ).fetchall()
+        return [tuple(job) for page in pages for job in json.loads(page[0])]
+
+    def finish_snapshot(self, source, captured):
+        """
+        Mark the capture as replayed, and drop its jobs.
+        """
+        with self.transaction() as c:
+            c.execute(
+                'UPDATE snapshots SET Jobs=NULL, Replayed=1 WHERE Source=? AND Captured=?',
+                (source, captured)
+            )
+        return
+
+    def drop_history(self, history):
+        """
+        Delete jobs left under the history source by an interrupted replay.
+        """
+        with self.transaction() as c:
+            c.execute(
+                'DELETE FROM job_versions WHERE JobId IN (SELECT Id FROM jobs WHERE Source=?)',
+                (history,)
+            )
+            c.execute('DELETE FROM jobs WHERE Source=?', (history,))
+        return
+
+    def merge_history(self, history, source, until, captures):
+        """
+        Move jobs replayed under the history source to the source, ending
+        those still active at until, when the source's own jobs begin, and
+        mark the captures as replayed, in one transaction.
+        """
+        with self.transaction() as c:
+            c.execute(
+                'UPDATE jobs SET Active=0, Deactivated=? WHERE Source=? AND Active=1',
+                (until, history)
+            )
+            c.execute('UPDATE jobs SET Source=? WHERE Source=?', (source, history))
+            c.executemany(
+                'UPDATE snapshots SET Jobs=NULL, Replayed=1 WHERE Source=? AND Captured=?',
+                ((source, captured) for captured in captures)
+            )
+        return
+
+    def add_subscriber(self, email, tags=(), companies=(), keywords=()):
+        """
+        Add a subscriber, or replace the filters of an existing one. Return
+        the subscriber's id.
+        """
+        filters = [('tag', value) for value in tags] + \
+            [('company', value) for value in companies] + \
+            [('keyword', value) for value in keywords]
+        with self.transaction() as c:
+            c.execute('INSERT OR IGNORE INTO subscribers (Email) VALUES(?)', (email,))
+            subscriber = c.execute(
+                'SELECT Id FROM subscribers WHERE Email=?', (email,)
+            ).fetchone()[0]
+            c.execute(
+                'DELETE FROM subscriber_filters WHERE SubscriberId=?',
+                (subscriber,)
+            )
+            c.executemany(
+                'INSERT INTO subscriber_filters VALUES(?,?,?)',
+                ((subscriber, kind, value) for kind, value in filters)
+            )
+        return subscriber
+
+    def remove_subscriber(self, email):
+        with self.transaction() as c:
+            c.execute("""
+                DELETE FROM subscriber_filters WHERE SubscriberId IN (
+                  SELECT Id FROM subscribers WHERE Email=?
+                )
+            """, (email,))
+            c.execute('DELETE FROM subscribers WHERE Email=?', (email,))
+        return
+
+    def subscriptions(self):
+        """
+        Return (email, kind, value) of every filter. Subscribers without any
+        filter are returned once, with kind and value set to None.
+        """
+        with self.lock:
+            return self.conn.execute("""
+                SELECT Email, Kind, Value FROM subscribers
+                LEFT JOIN subscriber_filters ON SubscriberId=Id
+            """).fetchall()
+
+    def subscriptions_version(self):
+        """
+        Return a value which changes whenever subscriptions change.
+        """
+        with self.lock:
+            return self.conn.execute("""
+                SELECT
+                  (SELECT COUNT(*) FROM subscribers),
+                  (SELECT MAX(Id) FROM subscribers),
+                  (SELECT COUNT(*) FROM subscriber_filters),
+                  (SELECT MAX(rowid) FROM subscriber_filters)
+            """).fetchone()
+
+    def load_poll(self, source):
+        """
+        Return the poll state of the source, or None if it was never polled.
+        """
+        with self.lock:
+            row = self.conn.execute("""
+                SELECT Interval, Polls, Changes, LastPolled FROM polls
+                WHERE Source=?
+            """, (source,)).fetchone()
+        if row is None:
+            return None
+        return {
+            'interval' : row[0],
+            'polls' : row[1],
+            'changes' : row[2],
+            'last-polled' : row[3],
+        }
+
+    def record_poll(self, source, interval, changed):
+        """
+        Record a poll of the source, and its new interval. Return the number
+        of polls, and of polls which found changes, so far.
+        """
+        with self.transaction() as c:
+            return self.write_poll(c, source, interval, changed)
+
+    def write_poll(self, cursor, source, interval, changed):
+        now = time.time()
+        cursor.execute("""
+            INSERT OR IGNORE INTO polls VALUES(?, ?, 0, 0, NULL, NULL)
+        """, (source, interval))
+        cursor.execute("""
+            UPDATE polls
+            SET Interval=?, Polls=Polls+1, Changes=Changes+?,
+                LastPolled=?,
+                LastChanged=CASE WHEN ? THEN ? ELSE LastChanged END
+            WHERE Source=?
+        """, (interval, int(changed), now, int(changed), now, source))
+        return cursor.execute(
+            'SELECT Polls, Changes FROM polls WHERE Source=?', (source,)
+        ).fetchone()
+
+
+class StartitWriter(object):
+    """
+    Apply writes of many spiders to the database from a single thread, over
+    a connection of its own. Spiders hand crawls, and writes to the side
+    tables (validators, details, seen postings and polls), over through a
+    queue, and wait for the result. Writes which queue up while a
+    transaction runs are applied together in the next one, up to max_batch
+    of them, so the write lock is taken, and a commit paid for, once per
+    group rather than once per write. Spiders keep reading through their
+    own connection, from the last committed snapshot of the write-ahead
+    log.
+
+    The writing methods take and return the same as StartitStorage's, so a
+    spider can use either (see Startit.writer).
+    """
+
+    def __init__(self, path, max_batch=32):
+        self.storage = StartitStorage(path)
+        self.max_batch = max_batch
+        self.queue = queue.Queue()
+        self.thread = None
+
+        self.applied = 0
+        self.transactions = 0
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='startit-writer')
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def write(self, name, *args):
+        """
+        Queue the write (see StartitStorage.apply_writes), and return a
+        future of its result.
+        """
+        future = Future()
+        self.queue.put((name, args, future))
+        return future
+
+    def submit(self, source, tup_jobs, crawled=None):
+        """
+        Queue the crawl, and return a future of apply_crawl's result. Jobs
+        are read right away, by the calling thread.
+        """
+        return self.write('apply_crawl', source, list(tup_jobs), crawled)
+
+    def apply_crawl(self, source, tup_jobs, crawled=None):
+        return self.submit(source, tup_jobs, crawled).result()
+
+    def record_crawl(self, source, tup_jobs, crawled=None):
+        return self.write('record_crawl', source, list(tup_jobs), crawled).result()
+
+    def save_validators(self, validators):
+        return self.write('save_validators', validators).result()
+
+    def save_details(self, details):
+        return self.write('save_details', list(details)).result()
+
+    def mark_seen(self, keys, source):
+        return self.write('mark_seen', list(keys), source).result()
+
+    def record_poll(self, source, interval, changed):
+        return self.write('record_poll', source, interval, changed).result()
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            group = [item]
+            while len(group) < self.max_batch:
+                try:
+                    item = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    self.apply(group)
+                    return
+                group.append(item)
+            self.apply(group)
+
+    def apply(self, group):
+        """
+        Apply the group in one transaction. If it fails, each write is
+        applied on its own, so one bad write fails alone.
+        """
+        try:
+            results = self.storage.apply_writes(item[:2] for item in group)
+        except Exception as e:
+            if len(group) > 1:
+                for item in group:
+                    self.apply([item])
+            else:
+                log.exception('Applying %s failed', group[0][0])
+                group[0][2].set_exception(e)
+            return
+
+        self.transactions += 1
+        self.applied += len(group)
+        for item, result in zip(group, results):
+            item[2].set_result(result)
+        return
+
+    def close(self):
+        """
+        Apply what is queued, and close the writer's connection.
+        """
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+        self.storage.close()
+        return
+
+
+class StartitQueryService(object):
+    """
+    Local HTTP service answering queries over the jobs database as JSON:
+
+        GET /jobs?q=python+backend&tag=django&company=Acme&active=1
+
+    Filters are those of StartitStorage.search_query; source takes a
+    category url. Pages of limit jobs come newest first, with the cursor of
+    the next page in "next", passed back as cursor. Rows are streamed to the
+    client with fetchmany as they are read.
+
+    Requests are served by threads, reading through a pool of read-only
+    connections, so queries run alongside a crawler writing to the
+    database. Responses of hot queries
+    are kept in an LRU cache, which is dropped whenever the database (or its
+    write-ahead log) changes.
+    """
+    DEFAULT_LIMIT = 50
+    MAX_LIMIT = 500
+    FETCH_SIZE = 64
+
+    def __init__(self, path, host='127.0.0.1', port=8080, cache_size=128):
+        self.path = path
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.version = None
+        self.lock = threading.Lock()
+        # Idle read-only connections.
+        self.readers = queue.LifoQueue()
+        self.hits = 0
+        self.misses = 0
+
+        # Brings the schema up to date, so readers find the index.
+        StartitStorage(path).close()
+
+        handler = type(
+            'StartitQueryHandler', (StartitQueryHandler,), {'service' : self}
+        )
+        self.server = ThreadingHTTPServer((host, port), handler)
+        self.server.daemon_threads = True
+
+    @property
+    def address(self):
+        return self.server.server_address
+
+    def serve_forever(self):
+        self.server.serve_forever()
+        return
+
+    def shutdown(self):
+        """
+        Stop serve_forever, running in another thread, and close.
+        """
+        self.server.shutdown()
+        self.close()
+        return
+
+    def close(self):
+        self.server.server_close()
+        while True:
+            try:
+                self.readers.get_nowait().close()
+            except queue.Empty:
+                return
+
+    @contextmanager
+    def reader(self):
+        """
+        Lend an idle read-only connection, opening one if there is none.
+        """
+        try:
+            conn = self.readers.get_nowait()
+        except queue.Empty:
+            conn = sqlite3.connect(
+                'file:%s?mode=ro' % self.path, uri=True, check_same_thread=False
+            )
+        try:
+            yield conn
+        finally:
+            self.readers.put(conn)
+
+    def database_version(self):
+        """
+        Return what changes whenever a transaction is committed.
+        """
+        version = []
+        for path in (self.path, self.path + '-wal'):
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                version.append(None)
+            else:
+                version.append((stat.st_mtime_ns, stat.st_size))
+        return tuple(version)
+
+    def cached(self, key):
+        version = self.database_version()
+        with self.lock:
+            if version != self.version:
+                self.cache.clear()
+                self.version = version
+            body = self.cache.get(key)
+            if body is None:
+                self.misses += 1
+                return None, version
+            self.cache.move_to_end(key)
+            self.hits += 1
+            return body, version
+
+    def remember(self, key, version, body):
+        with self.lock:
+            if version != self.version or not self.cache_size:
+                return
+            self.cache[key] = body
+            self.cache.move_to_end(key)
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return
+
+    def parse_query(self, params):
+        """
+        Return keyword arguments of search_query, and the limit, from query
+        string parameters. Raise ValueError if they are invalid.
+        """
+        def single(name):
+            values = params.get(name)
+            return values[-1] if values else None
+
+        active = single('active')
+        if active not in (None, '0', '1'):
+            raise ValueError('active must be 0 or 1')
+        cursor = single('cursor')
+        limit = int(single('limit') or self.DEFAULT_LIMIT)
+        if not 0 < limit <= self.MAX_LIMIT:
+            raise ValueError('limit must be between 1 and %d' % self.MAX_LIMIT)
+
+        return dict(
+            keywords=single('q'),
+            tags=params.get('tag', []),
+            company=single('company'),
+            active=None if active is None else active == '1',
+            source=single('source'),
+            before=int(cursor) if cursor else None,
+        ), limit
+
+    def iter_page(self, search, limit):
+        """
+        Yield the page as chunks of JSON, reading rows with fetchmany. One
+        row more than the limit is read, to tell whether there is a next
+        page.
+        """
+        query, params = StartitStorage.search_query(limit=limit + 1, **search)
+        with self.reader() as conn:
+            cursor = conn.execute(query, params)
+            sent, last = 0, None
+            yield b'{"jobs": ['
+            try:
+                while sent < limit:
+                    rows = cursor.fetchmany(min(self.FETCH_SIZE, limit - sent))
+                    if not rows:
+                        break
+                    yield (',' if sent else '').encode('utf-8') + ','.join(
+                        json.dumps(self.job(row)) for row in rows
+                    ).encode('utf-8')
+                    sent += len(rows)
+                    last = rows[-1][0]
+                more = sent == limit and cursor.fetchone() is not None
+            finally:
+                cursor.close()
+        yield ('], "next": %s}' % json.dumps(str(last) if more else None)).encode('utf-8')
+
+    def job(self, row):
+        job = OrderedDict()
+        job['id'] = row[0]
+        job['company-title'] = row[1]
+        job['job-title'] = row[2]
+        job['url'] = row[3]
+        try:
+            job['tags'] = json.loads(row[4])
+        except (TypeError, ValueError):
+            job['tags'] = []
+        job['active'] = bool(int(row[5] or 0))
+        job['first-crawled'] = row[6]
+        job['deactivated'] = row[7]
+        job['source'] = row[8]
+        return job
+
+
+class StartitQueryHandler(BaseHTTPRequestHandler):
+    """
+    Request handler of StartitQueryService.
+    """
+    service = None
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        if url.path == '/health':
+            return self.send_json(200, {'status' : 'ok'})
+        if url.path != '/jobs':
+            return self.send_json(404, {'error' : 'not found'})
+
+        try:
+            search, limit = self.service.parse_query(parse_qs(url.query))
+        except ValueError as e:
+            return self.send_json(400, {'error' : str(e)})
+
+        key = json.dumps([sorted(search.items()), limit])
+        body, version = self.service.cached(key)
+        if body is not None:
+            return self.send_body(200, body)
+
+        try:
+            chunks = self.service.iter_page(search, limit)
+            first = next(chunks)
+        except sqlite3.OperationalError as e:
+            # e.g. a malformed full-text query.
+            return self.send_json(400, {'error' : str(e)})
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.end_headers()
+        sent = [first]
+        self.wfile.write(first)
+        for chunk in chunks:
+            self.wfile.write(chunk)
+            sent.append(chunk)
+        self.service.remember(key, version, b''.join(sent))
+        return
+
+    def send_json(self, status, data):
+        return self.send_body(status, json.dumps(data).encode('utf-8'))
+
+    def send_body(self, status, body):
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        return
+
+    def log_message(self, format, *args):
+        log.debug('%s %s', self.address_string(), format % args)
+        return
+
+
+class StartitJob(object):
+    """
+    A job ad. Jobs are compared and hashed by their key, a tuple of (company
+    title, job title, url, tags), which is built, and hashed, only once, when
+    the job is extracted. Tags are kept as a tuple.
+    """
+    __slots__ = ('key', '_hash')
+
+    def __init__(self, company_title, job_title, url, tags):
+        self.key = (company_title, job_title, url, tuple(tags))
+        self._hash = hash(self.key)
+
+    @property
+    def company_title(self):
+        return self.key[0]
+
+    @property
+    def job_title(self):
+        return self.key[1]
+
+    @property
+    def url(self):
+        return self.key[2]
+
+    @property
+    def tags(self):
+        return self.key[3]
+
+    def as_row(self):
+        """
+        Return the job as stored in the jobs table, with tags as JSON.
+        """
+        return self.key[:3] + (json.dumps(list(self.key[3])),)
+
+    def as_dict(self):
+        d = OrderedDict()
+        d['company-title'] = self.company_title
+        d['job-title'] = self.job_title
+        d['url'] = self.url
+        d['tags'] = list(self.tags)
+
+        return d
+
+    def __eq__(self, other):
+        if not isinstance(other, StartitJob):
+            return NotImplemented
+        return self.key == other.key
+
+    def __hash__(self):
+        return self._hash
+
+    def __reduce__(self):
+        return (
+            StartitJob,
+            (self.company_title, self.job_title, self.url, self.tags)
+        )
+
+    def __repr__(self):
+        return 'StartitJob(%r, %r, %r, %r)' % (
+            self.company_title, self.job_title, self.url, self.tags
+        )
+
+
+class StartitJobTypes(object):
+    PREMIUM = 'premium'
+    STANDARD = 'standard'
+    MINI = 'mini'
+
+
+class StartitLxmlBackend(object):
+    """
+    Extraction backend working directly on the lxml tree. Job ads of all types
+    are classified in one pass over the document, and their content is taken
+    by walking the ad's own subtree, mirroring what the BeautifulSoup backend
+    does. Both backends produce identical jobs, in the same order.
+    """
+    CONTAINERS = {
+        'listing-oglas-premium' : StartitJobTypes.PREMIUM,
+        'listing-oglas-standard' : StartitJobTypes.STANDARD,
+        'oglas-mini' : StartitJobTypes.MINI,
+    }
+    TEXT_CONTAINERS = {
+        StartitJobTypes.PREMIUM : 'listing-oglas-premium-text',
+        StartitJobTypes.STANDARD : 'listing-oglas-standard-text',
+    }
+    ORDER = (
+        StartitJobTypes.PREMIUM,
+        StartitJobTypes.STANDARD,
+        StartitJobTypes.MINI,
+    )
+
+    NEXT_PAGE = etree.XPath(
+        '//link[@rel="next"]/@href | '
+        '//a[contains(concat(" ", normalize-space(@class), " "), " next ")]/@href'
+    )
+    STRING_VALUE = etree.XPath('string()')
+
+    def __init__(self):
+        self.parser = etree.HTMLParser()
+
+    def parse(self, body):
+        """
+        Parse the page, decoding it the same way BeautifulSoup does.
+        """
+        if isinstance(body, bytes):
+            body = UnicodeDammit(body, is_html=True).unicode_markup
+        return etree.fromstring(body, self.parser)
+
+    def next_page_href(self, page):
+        hrefs = self.NEXT_PAGE(page)
+        return hrefs[0] if hrefs else None
+
+    def iter_divs(self, page):
+        """
+        Yield packed job related divs, in the order extract_divs stores them:
+        premium first, then standard, then mini ads.
+        """
+        found = {job_type : [] for job_type in self.ORDER}
+        if page is not None:
+            for div in page.iter('div'):
+                for name in div.get('class', '').split():
+                    job_type = self.CONTAINERS.get(name)
+                    if job_type is not None:
+                        found[job_type].append(div)
+
+        for job_type in self.ORDER:
+            for div in found[job_type]:
+                yield {
+                    'type' : job_type,
+                    'job-post' : div,
+                }
+        return
+
+    def extract_job(self, job):
+        if job['type'] in self.TEXT_CONTAINERS:
+            return self.extract_from_text(
+                job['job-post'], self.TEXT_CONTAINERS[job['type']]
+            )
+        elif job['type'] == StartitJobTypes.MINI:
+            return self.extract_from_mini(job['job-post'])
+        raise StartitException('Unknown job type!')
+
+    def extract_from_text(self, ad, text_class):
+        """
+        Extract content from premium and standard job ads.
+        """
+        text = self.first_with_class(ad, 'div', text_class)
+
+        link = self.first(self.first(text, 'h1'), 'a')
+        url = link.get('href')
+        job_title = self.string(link).strip()
+
+        company = self.first(self.first(text, 'div'), 'a')
+        title = self.string(company)
+        company_title = title.strip() if title else \
+            self.STRING_VALUE(self.first(company, 'span')).strip()
+        tags = self.extract_tags(text.iterdescendants('small'))
+
+        return StartitJob(company_title, job_title, url, tags)
+
+    def extract_from_mini(self, mini):
+        """
+        Extract content from mini job ad.
+        """
+        link = self.first(self.first(mini, 'h1'), 'a')
+        url = link.get('href')
+        job_title = self.string(link).strip()
+        company_title = self.string(self.first(mini, 'div')).strip()
+        tags = self.extract_tags(
+            self.first_with_class(mini, 'div', 'oglas-mini-tagovi')
+            .iterdescendants('small')
+        )
+
+        return StartitJob(company_title, job_title, url, tags)
+
+    def extract_tags(self, smalls):
+        return [self.string(self.first(small, 'a')).strip() for small in smalls]
+
+    def first(self, element, tag):
+        """
+        Return the first descendant with the given tag, like soup.tag does.
+        """
+        return next(element.iterdescendants(tag), None)
+
+    def first_with_class(self, element, tag, class_name):
+        for candidate in element.iterdescendants(tag):
+            if class_name in candidate.get('class', '').split():
+                return candidate
+        return None
+
+    def string(self, element):
+        """
+        Return the only string inside the element, like soup.string does, or
+        None if the element has more than one child.
+        """
+        children = [element.text] if element.text else []
+        for child in element:
+            children.append(child)
+            if child.tail:
+                children.append(child.tail)
+
+        if len(children) != 1:
+            return None
+        child = children[0]
+        if isinstance(child, str):
+            return child
+        if not isinstance(child.tag, str):
+            # Comments and processing instructions.
+            return child.text
+        return self.string(child)
+
+
+class StartitStreamBackend(StartitLxmlBackend):
+    """
+    lxml backend which parses the page incrementally, as chunks of it are
+    fed in. Each ad is yielded as soon as its container is closed, and
+    discarded, along with everything parsed before it, once the caller moves
+    on. Unlike the other backends, ads come in document order.
+
+    Whole pages can still be parsed as with StartitLxmlBackend.
+    """
+
+    def iter_stream(self, chunks):
+        """
+        Yield packed job related divs of the page, given as chunks of bytes.
+        Return the link to the next page, if any.
+        """
+        parser = etree.HTMLPullParser(events=('start', 'end'))
+        state = {'open' : 0, 'next' : None}
+        for chunk in chunks:
+            parser.feed(chunk)
+            yield from self.handle_events(parser.read_events(), state)
+        parser.close()
+        yield from self.handle_events(parser.read_events(), state)
+        return state['next']
+
+    def handle_events(self, events, state):
+        for event, element in events:
+            if not isinstance(element.tag, str):
+                continue
+
+            job_type = self.container_type(element)
+            if event == 'start':
+                if job_type is not None:
+                    state['open'] += 1
+                continue
+
+            if job_type is not None:
+                state['open'] -= 1
+                yield {
+                    'type' : job_type,
+                    'job-post' : element,
+                }
+            elif state['next'] is None and self.is_next_link(element):
+                state['next'] = element.get('href')
+
+            # Elements within an ad are needed until the whole ad is parsed.
+            if state['open'] == 0:
+                self.discard(element)
+        return
+
+    def container_type(self, element):
+        if element.tag != 'div':
+            return None
+        for name in element.get('class', '').split():
+            if name in self.CONTAINERS:
+                return self.CONTAINERS[name]
+        return None
+
+    def is_next_link(self, element):
+        if element.tag == 'link':
+            return element.get('rel') == 'next'
+        return element.tag == 'a' and 'next' in element.get('class', '').split()
+
+    def discard(self, element):
+        """
+        Free the element, and its preceding siblings, which were processed.
+        """
+        element.clear()
+        parent = element.getparent()
+        if parent is not None:
+            while element.getprevious() is not None:
+                del parent[0]
+        return
+
+
+class StartitException(Exception):
+    """
+    This exception is raised if the supplied link is not valid.
+    """
+    pass
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+
+    if args.serve is not None:
+        logging.basicConfig(level=logging.INFO, format='%(message)s')
+        service = StartitQueryService(args.database, args.serve_host, args.serve)
+        log.info('Serving %s on http://%s:%d/jobs', args.database, *service.address)
+        try:
+            service.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            service.close()
+        sys.exit(0)
+
+    if args.backfill:
+        logging.basicConfig(level=logging.INFO, format='%(message)s')
+        storage = StartitStorage(args.database)
+        try:
+            stats = StartitBackfill(
+                storage, args.URL, args.processes or None, args.backend
+            ).run(args.backfill)
+        finally:
+            storage.close()
+        log.info('Backfilled %s', json.dumps(stats))
+        sys.exit(0)
+
+    if args.daemon:
+        logging.basicConfig(
+            level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s'
+        )
+        crawler = StartitDaemon(
+            args.URL, args.email, args.interval, args.jitter, args.backend,
+            args.min_interval, args.max_interval, args.digest_window
+        )
+    else:
+        crawler = StartitCrawler(
+            args.URL, args.email, args.workers, args.per_host, args.backend,
+            args.processes, args.digest_window
+        )
+
+    crawler.db_path = args.database
+    crawler.config_path = args.config
+    crawler.client = StartitHTTPClient(
+        args.connect_timeout, args.timeout, args.retries
+    )
+
+    crawler.bloom = args.bloom
+    crawler.low_memory = args.low_memory
+    if args.cache:
+        crawler.cache = StartitResponseCache(
+            args.cache, int(args.cache_size * 2 ** 20), args.offline
+        )
+    if args.details:
+        crawler.details = StartitDetailFetcher(args.detail_workers, args.detail_rate)
+        crawler.details.client = crawler.client
 
-    startit.extract_divs()
-    startit.extract_jobs()
+    hooks = []
+    if args.metrics_json:
+        hooks.append(StartitJSONLog(args.metrics_json))
+    if args.metrics_textfile:
+        hooks.append(StartitPrometheusTextfile(args.metrics_textfile))
+    if hooks:
+        crawler.metrics = StartitMetrics(hooks)
 
-    startit.check_and_notify()
+    crawler.run()
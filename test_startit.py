@@ -3,16 +3,53 @@
 
 import pytest
 
+import os
+import gzip
+import json
+import time
+import tarfile
+import threading
+import email
 import pickle
+import sqlite3
 from urllib.request import addinfourl
+from urllib.request import Request
+from urllib.request import urlopen
 from urllib.request import build_opener
 from urllib.request import install_opener
 from urllib.request import HTTPSHandler
+from urllib.error import HTTPError
+from urllib.error import URLError
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from email.message import Message
 from io import StringIO
 from bs4 import BeautifulSoup
 from collections import deque
 
 from startit import Startit
+from startit import StartitCrawler
+from startit import StartitDaemon
+from startit import StartitJob
+from startit import StartitMetrics
+from startit import StartitJSONLog
+from startit import StartitPrometheusTextfile
+from startit import StartitNotifier
+from startit import StartitResponseCache
+from startit import StartitDetailFetcher
+from startit import StartitTokenBucket
+from startit import StartitHTTPClient
+from startit import StartitRouter
+from startit import StartitSeenIndex
+from startit import StartitBloomFilter
+from startit import StartitStorage
+from startit import StartitBatchParser
+from startit import StartitBackfill
+from startit import parse_page_jobs
+from startit import job_fingerprint
+from startit import StartitQueryService
+from startit import StartitWriter
+from startit import StartitStreamBackend
 from startit import StartitJobTypes
 from startit import StartitException
 
@@ -26,12 +63,21 @@ def read_mock_page():
     with open('example_page_python.html', 'r', encoding='utf-8') as f:
         return StringIO(f.read())
 
+MOCK_ETAG = '"mock-etag"'
+
+def mock_headers():
+    headers = Message()
+    headers['ETag'] = MOCK_ETAG
+    return headers
+
 def mock_startit_response(request):
     mock_url = 'https://startit.rs/poslovi/pretraga/python/'
     if request.get_full_url() == mock_url:
+        if request.get_header('If-none-match') == MOCK_ETAG:
+            raise HTTPError(mock_url, 304, 'Not Modified', mock_headers(), None)
         # addinfourl: https://archive.is/LpjxV
         response = addinfourl(
-            read_mock_page(), 'mock header', request.get_full_url()
+            read_mock_page(), mock_headers(), request.get_full_url()
         )
         response.code = 200
         response.msg = 'OK'
@@ -163,12 +209,12 @@ def test_extract_from_premium(jobs):
     """
     soup = BeautifulSoup(read_mock_page(), 'lxml')
     premium = soup.find_all('div', attrs={'class' : 'listing-oglas-premium'})
-    result = {
-        'company-title' : 'Joker Games',
-        'job-title' : 'C# .NET Developer',
-        'url' : 'https://startit.rs/poslovi/c-net-developer-meridianbet/',
-        'tags' : ['.net', 'chrarp', 'node.js', 'python'],
-    }
+    result = StartitJob(
+        'Joker Games',
+        'C# .NET Developer',
+        'https://startit.rs/poslovi/c-net-developer-meridianbet/',
+        ['.net', 'chrarp', 'node.js', 'python'],
+    )
     assert jobs.extract_from_premium(premium[0]) == result
 
 def test_extract_from_standard(jobs):
@@ -177,12 +223,12 @@ def test_extract_from_standard(jobs):
     """
     soup = BeautifulSoup(read_mock_page(), 'lxml')
     standard = soup.find_all('div', attrs={'class' : 'listing-oglas-standard'})
-    result = {
-        'company-title' : 'AllThingsTalk',
-        'job-title' : 'Backend Engineer',
-        'url' : 'https://startit.rs/poslovi/backend-engineer-allthingstalk/',
-        'tags' : ['backend', 'csharp', 'devops', 'iot', 'linux', 'python'],
-    }
+    result = StartitJob(
+        'AllThingsTalk',
+        'Backend Engineer',
+        'https://startit.rs/poslovi/backend-engineer-allthingstalk/',
+        ['backend', 'csharp', 'devops', 'iot', 'linux', 'python'],
+    )
     assert jobs.extract_from_standard(standard[0]) == result
 
 def test_extract_from_mini(jobs):
@@ -191,20 +237,1481 @@ def test_extract_from_mini(jobs):
     """
     soup = BeautifulSoup(read_mock_page(), 'lxml')
     mini = soup.find_all('div', attrs={'class' : 'oglas-mini'})
-    result = {
-        'company-title' : 'Itekako doo',
-        'job-title' : 'Python Developer',
-        'url' : 'https://www.dropbox.com/s/fxlbin0i9z5189h/Py.pdf?dl=0',
-        'tags' : ['Beograd', 'python'],
-    }
+    result = StartitJob(
+        'Itekako doo',
+        'Python Developer',
+        'https://www.dropbox.com/s/fxlbin0i9z5189h/Py.pdf?dl=0',
+        ['Beograd', 'python'],
+    )
     assert jobs.extract_from_mini(mini[0]) == result
 
 def test_extract_jobs(jobs):
     """
-    Test extract_jobs method. This method should return a deque of job
-    dictionaries.
+    Test extract_jobs method. This method should return a deque of jobs,
+    which are equal to the job dictionaries.
     """
     result = pickle.load(open('pickled_jobs.p', 'rb'))
     jobs.extract_divs()
     jobs.extract_jobs()
-    assert jobs.jobs == result
+    assert deque(job.as_dict() for job in jobs.jobs) == result
+
+def test_page_retrieved_lazily():
+    """
+    Test that the page is not retrieved before it is needed.
+    """
+    startit = Startit('https://startit.rs/poslovi/pretraga/python/', 'dummy@example.com')
+    assert startit._page is None
+    assert startit.page is not None
+
+def test_crawler_crawls_categories():
+    """
+    Test that StartitCrawler fetches and extracts all categories.
+    """
+    result = pickle.load(open('pickled_jobs.p', 'rb'))
+    crawler = StartitCrawler([
+        'https://startit.rs/poslovi/pretraga/python/',
+        'https://startit.rs/poslovi/pretraga/python/',
+    ], 'dummy@example.com', max_workers=2, max_per_host=1)
+    crawler.crawl()
+    for spider in crawler.spiders:
+        assert [job.as_dict() for job in spider.jobs] == list(result)
+
+def test_crawler_survives_failed_category():
+    """
+    Test that a category which fails to crawl is flagged, and does not stop
+    the others.
+    """
+    crawler = StartitCrawler([
+        'https://startit.rs/poslovi/pretraga/python/',
+        'https://startit.rs/poslovi/pretraga/django/',
+    ], 'dummy@example.com', max_workers=2)
+    def iter_jobs():
+        raise URLError('unreachable')
+    crawler.spiders[1].iter_jobs = iter_jobs
+    crawler.crawl()
+    python, django = crawler.spiders
+    assert len(python.jobs) > 0 and not python.stats['failed']
+    assert django.stats['failed']
+
+def test_crawler_host_limit():
+    """
+    Test that spiders on the same host share a single throttle.
+    """
+    crawler = StartitCrawler([
+        'https://startit.rs/poslovi/pretraga/python/',
+        'https://startit.rs/poslovi/pretraga/django/',
+    ], 'dummy@example.com')
+    first = crawler.host_limit(crawler.spiders[0].url)
+    assert crawler.host_limit(crawler.spiders[1].url) is first
+
+def test_next_page_url_last_page(jobs):
+    """
+    Test that next_page_url returns None when there are no more pages.
+    """
+    assert jobs.next_page_url(jobs.page) is None
+
+def test_iter_jobs_follows_pagination(jobs, monkeypatch):
+    """
+    Test that iter_jobs yields jobs from every page, and stops at the last one.
+    """
+    first = read_mock_page().read().replace(
+        '</head>', '<link rel="next" href="/poslovi/pretraga/python/page/2/"></head>'
+    )
+    pages = {
+        'https://startit.rs/poslovi/pretraga/python/': first,
+        'https://startit.rs/poslovi/pretraga/python/page/2/': read_mock_page().read(),
+    }
+    fetched = []
+    def fetch_page(url, conditional=False):
+        fetched.append(url)
+        return pages[url]
+    monkeypatch.setattr(jobs, 'fetch_page', fetch_page)
+
+    result = pickle.load(open('pickled_jobs.p', 'rb'))
+    assert [job.as_dict() for job in jobs.iter_jobs()] == list(result) + list(result)
+    assert fetched == list(pages)
+
+def first_crawl(db_path, monkeypatch):
+    """
+    Crawl the mock page into a fresh database, without sending any email.
+    """
+    startit = Startit('https://startit.rs/poslovi/pretraga/python/', 'dummy@example.com')
+    startit.db_path = db_path
+    monkeypatch.setattr(startit, 'send_welcome_email', lambda: None)
+    startit.check_and_notify(startit.iter_jobs())
+    return startit
+
+def test_not_modified_page_is_skipped(tmpdir, monkeypatch):
+    """
+    Test that a page answered with 304 Not Modified is not processed at all.
+    """
+    db_path = str(tmpdir.join('jobs.db'))
+    first_crawl(db_path, monkeypatch)
+
+    startit = Startit('https://startit.rs/poslovi/pretraga/python/', 'dummy@example.com')
+    startit.db_path = db_path
+    assert startit.load_validators(startit.url)['etag'] == MOCK_ETAG
+    startit.check_and_notify(startit.iter_jobs())
+    assert startit.unchanged
+    assert startit.stats['skipped']
+    assert startit.stats['pages'] == 0
+
+def test_identical_page_is_skipped(tmpdir, monkeypatch):
+    """
+    Test that a page hashing the same as the last time is not processed.
+    """
+    db_path = str(tmpdir.join('jobs.db'))
+    first_crawl(db_path, monkeypatch)
+
+    startit = Startit('https://startit.rs/poslovi/pretraga/python/', 'dummy@example.com')
+    startit.db_path = db_path
+    # Pretend the server does not support ETags.
+    monkeypatch.setattr(startit, 'load_validators', lambda url: dict(
+        Startit.load_validators(startit, url), etag=None
+    ))
+    startit.check_and_notify(startit.iter_jobs())
+    assert startit.stats['skipped']
+    assert startit.stats['pages'] == 1
+
+def test_unknown_backend():
+    """
+    Test that an unknown extraction backend raises an exception.
+    """
+    with pytest.raises(StartitException):
+        Startit('https://startit.rs/poslovi/pretraga/python/', 'dummy@example.com', 'regex')
+
+@pytest.mark.parametrize('backend', Startit.BACKENDS)
+def test_extract_jobs_backends(backend):
+    """
+    Test that every extraction backend extracts the same jobs, in the same
+    order.
+    """
+    result = pickle.load(open('pickled_jobs.p', 'rb'))
+    startit = Startit('https://startit.rs/poslovi/pretraga/python/', 'dummy@example.com', backend)
+    startit.extract_divs()
+    startit.extract_jobs()
+    assert deque(job.as_dict() for job in startit.jobs) == result
+    assert [job['type'] for job in startit.raw_data] == \
+        [job['type'] for job in pickle.load(open('pickled_raw_data.p', 'rb'))]
+
+def test_lxml_backend_matches_soup():
+    """
+    Test that the lxml backend produces the same output as the soup backend.
+    """
+    soup = Startit('https://startit.rs/poslovi/pretraga/python/', 'dummy@example.com', 'soup')
+    lxml = Startit('https://startit.rs/poslovi/pretraga/python/', 'dummy@example.com', 'lxml')
+    assert list(lxml.iter_jobs()) == list(soup.iter_jobs())
+
+def test_check_and_notify_diff(tmpdir, monkeypatch):
+    """
+    Test that check_and_notify deactivates expired jobs, updates edited ones
+    in place, and notifies about them apart from new ones.
+    """
+    db_path = str(tmpdir.join('jobs.db'))
+    first_crawl(db_path, monkeypatch)
+
+    startit = Startit('https://startit.rs/poslovi/pretraga/python/', 'dummy@example.com')
+    startit.db_path = db_path
+    startit.conditional = False
+    notified = []
+    updated = []
+    monkeypatch.setattr(startit, 'notify_master_about_new_jobs', notified.extend)
+    monkeypatch.setattr(startit, 'notify_master_about_updated_jobs', updated.extend)
+
+    jobs = list(startit.iter_jobs())
+    expired = jobs.pop()
+    jobs[0] = StartitJob(
+        jobs[0].company_title, jobs[0].job_title, jobs[0].url,
+        jobs[0].tags + ('flask',)
+    )
+    startit.check_and_notify(jobs)
+
+    assert startit.stats['new'] == 0
+    assert startit.stats['expired'] == 1
+    assert startit.stats['updated'] == 1
+    assert notified == []
+    assert updated == [jobs[0].as_row()]
+
+    conn = sqlite3.connect(db_path)
+    active = conn.execute('SELECT Url, Tags FROM jobs WHERE Active=1').fetchall()
+    conn.close()
+    assert len(active) == len(jobs)
+    assert expired.url not in [url for url, _ in active]
+    assert (jobs[0].url, jobs[0].as_row()[3]) in active
+
+def test_check_and_notify_indexes_old_database(tmpdir, monkeypatch):
+    """
+    Test that a database created without the index on active jobs gets one,
+    and that duplicate active urls are resolved.
+    """
+    db_path = str(tmpdir.join('jobs.db'))
+    conn = sqlite3.connect(db_path)
+    conn.executescript('''
+        CREATE TABLE jobs (
+          CompanyTitle TEXT, JobTitle TEXT, Url TEXT, Tags BLOB,
+          Active TEXT, FirstCrawled TEXT
+        );
+    ''')
+    row = ('Old', 'Old job', 'https://startit.rs/poslovi/old/', json.dumps([]), True, '')
+    conn.executemany('INSERT INTO jobs VALUES(?,?,?,?,?,?)', [row, row])
+    conn.commit()
+    conn.close()
+
+    startit = Startit('https://startit.rs/poslovi/pretraga/python/', 'dummy@example.com')
+    startit.db_path = db_path
+    monkeypatch.setattr(startit, 'notify_master_about_new_jobs', lambda jobs: None)
+    startit.check_and_notify(startit.iter_jobs())
+
+    conn = sqlite3.connect(db_path)
+    indexes = conn.execute(
+        "SELECT name FROM sqlite_master WHERE type='index'"
+    ).fetchall()
+    old = conn.execute(
+        "SELECT COUNT(*) FROM jobs WHERE Url=? AND Active=1", (row[2],)
+    ).fetchone()
+    conn.close()
+    assert ('jobs_active_source_fingerprint',) in indexes
+    assert old == (0,)
+
+def test_storage_claims_legacy_jobs_once(tmpdir):
+    """
+    Test that jobs stored before sources were kept, expired ones included,
+    go to the first source crawled after the upgrade, by index, so that a
+    new source still counts as never crawled.
+    """
+    db_path = str(tmpdir.join('jobs.db'))
+    conn = sqlite3.connect(db_path)
+    conn.executescript('''
+        CREATE TABLE jobs (
+          CompanyTitle TEXT, JobTitle TEXT, Url TEXT, Tags BLOB,
+          Active TEXT, FirstCrawled TEXT
+        );
+    ''')
+    conn.executemany('INSERT INTO jobs VALUES(?,?,?,?,?,?)', [
+        ('Old', 'Old job', 'https://startit.rs/poslovi/old/', json.dumps([]), True, ''),
+        ('Gone', 'Gone job', 'https://startit.rs/poslovi/gone/', json.dumps([]), False, ''),
+    ])
+    conn.commit()
+    conn.close()
+
+    storage = StartitStorage(db_path)
+    python = 'https://startit.rs/poslovi/pretraga/python/'
+    django = 'https://startit.rs/poslovi/pretraga/django/'
+    claim = storage.conn.execute(
+        'EXPLAIN QUERY PLAN UPDATE jobs SET Source=? WHERE Source IS NULL', (python,)
+    ).fetchall()
+    assert 'jobs_source' in claim[0][-1]
+    assert storage.record_crawl(python, []) == (False, [], 1, [])
+    assert storage.record_crawl(django, []) == (True, [], 0, [])
+    assert storage.has_jobs(python) and not storage.has_jobs(django)
+    assert storage.conn.execute(
+        'SELECT COUNT(*) FROM jobs WHERE Source=?', (python,)
+    ).fetchone() == (2,)
+    storage.close()
+
+def test_storage_migrations_keep_data(tmpdir):
+    """
+    Test that opening an existing database migrates it without dropping any
+    jobs, and that reopening it does not apply migrations again.
+    """
+    db_path = str(tmpdir.join('jobs.db'))
+    storage = StartitStorage(db_path)
+    assert storage.created
+    storage.insert_jobs([
+        ('Company', 'Job', 'https://startit.rs/poslovi/job/', json.dumps(['python'])),
+    ], True)
+    storage.close()
+
+    storage = StartitStorage(db_path)
+    assert not storage.created
+    assert storage.conn.execute('PRAGMA user_version').fetchone() == \
+        (len(StartitStorage.MIGRATIONS),)
+    assert storage.conn.execute('PRAGMA journal_mode').fetchone() == ('wal',)
+    assert len(storage.active_jobs()) == 1
+    storage.close()
+
+def test_storage_apply_crawl(tmpdir):
+    """
+    Test that apply_crawl returns new jobs, the number of expired ones, and
+    updated jobs.
+    """
+    storage = StartitStorage(str(tmpdir.join('jobs.db')))
+    first = ('A', 'Job A', 'https://startit.rs/poslovi/a/', '[]')
+    second = ('B', 'Job B', 'https://startit.rs/poslovi/b/', '[]')
+    source = 'https://startit.rs/poslovi/pretraga/python/'
+    assert storage.apply_crawl(source, [first]) == ([first], 0, [])
+    assert storage.apply_crawl(source, [second, second]) == ([second], 1, [])
+    assert storage.active_jobs() == [second]
+    storage.close()
+
+def test_storage_keeps_job_versions(tmpdir):
+    """
+    Test that an edited ad is matched by its url fingerprint, updated in
+    place, and its previous versions kept.
+    """
+    storage = StartitStorage(str(tmpdir.join('jobs.db')))
+    source = 'https://startit.rs/poslovi/pretraga/python/'
+    first = ('A', 'Job A', 'https://startit.rs/poslovi/a/', '["python"]')
+    renamed = ('A', 'Senior Job A', 'HTTPS://Startit.rs/poslovi/a/#apply', '["python"]')
+    retagged = ('A', 'Senior Job A', 'https://startit.rs/poslovi/a/', '["python", "django"]')
+    storage.apply_crawl(source, [first])
+    assert storage.apply_crawl(source, [renamed]) == ([], 0, [renamed])
+    assert storage.apply_crawl(source, [renamed]) == ([], 0, [])
+    assert storage.apply_crawl(source, [retagged]) == ([], 0, [retagged])
+    assert storage.active_jobs() == [retagged]
+
+    versions = storage.job_versions(first[2])
+    assert [v[:5] for v in versions] == [(1,) + first, (2,) + renamed]
+    assert storage.jobs_with_tags(['django']) == [retagged]
+    storage.close()
+
+def test_job_identity():
+    """
+    Test that jobs are equal, and hash the same, when their content is equal,
+    and that they survive pickling.
+    """
+    job = StartitJob('Company', 'Job', 'https://startit.rs/poslovi/job/', ['python'])
+    same = StartitJob('Company', 'Job', 'https://startit.rs/poslovi/job/', ('python',))
+    other = StartitJob('Company', 'Job', 'https://startit.rs/poslovi/job/', ['django'])
+    assert job == same and hash(job) == hash(same)
+    assert job != other
+    assert len({job, same, other}) == 2
+    assert pickle.loads(pickle.dumps(job)) == job
+    assert job.as_row() == ('Company', 'Job', 'https://startit.rs/poslovi/job/', '["python"]')
+
+def test_job_memory():
+    """
+    Test that a StartitJob takes less than half the memory of the OrderedDict
+    it replaces.
+    """
+    import tracemalloc
+    from collections import OrderedDict
+
+    fields = [
+        ('Company %d' % i, 'Job %d' % i, 'https://startit.rs/poslovi/%d/' % i,
+         ['python', 'django'])
+        for i in range(1000)
+    ]
+
+    def measure(make):
+        tracemalloc.start()
+        jobs = [make(*f) for f in fields]
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        return size
+
+    def make_dict(company_title, job_title, url, tags):
+        d = OrderedDict()
+        d['company-title'] = company_title
+        d['job-title'] = job_title
+        d['url'] = url
+        d['tags'] = list(tags)
+        return d
+
+    assert measure(StartitJob) * 2 < measure(make_dict)
+
+def measure_extraction(backend, low_memory, ads=1000):
+    """
+    Extract jobs of a generated page with the given number of ads. Return
+    the spider, and the bytes allocated by extraction which are still held
+    afterwards, and at the peak.
+    """
+    import gc
+    import tracemalloc
+    from bench_startit import synthetic_page
+
+    body = synthetic_page(ads)
+    spider = Startit('https://startit.rs/poslovi/pretraga/python/', 'dummy@example.com', backend)
+    spider.low_memory = low_memory
+    spider.fetch_page = lambda url, conditional=False: body
+
+    gc.collect()
+    tracemalloc.start()
+    spider.extract_divs()
+    spider.extract_jobs()
+    gc.collect()
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return spider, retained, peak
+
+@pytest.mark.parametrize('backend', ['soup', 'lxml'])
+def test_low_memory_budget(backend):
+    """
+    Test that in low-memory mode, extracting 1,000 ads stays within a peak
+    budget, and keeps only the jobs once done, with repeated strings shared.
+    """
+    spider, retained, peak = measure_extraction(backend, True)
+    assert len(spider.jobs) == 1000 and not spider.raw_data
+    assert spider.page is None
+    assert retained < 512 * 1024
+    assert peak < 16 * 2 ** 20
+
+    tags = {}
+    for job in spider.jobs:
+        for tag in job.tags:
+            assert tags.setdefault(tag, tag) is tag
+
+    _, kept, _ = measure_extraction(backend, False)
+    assert retained < kept
+
+def test_low_memory_check_and_notify(tmpdir):
+    """
+    Test that a spider whose tree was released still gets its jobs stored.
+    """
+    startit = Startit('https://startit.rs/poslovi/pretraga/python/', 'dummy@example.com')
+    startit.db_path = str(tmpdir.join('jobs.db'))
+    startit.low_memory = True
+    startit.send_welcome_email = lambda: None
+    startit.extract_divs()
+    startit.extract_jobs()
+    assert startit.page is None and startit.changed()
+
+    startit.check_and_notify()
+    assert not startit.stats['skipped']
+    assert len(startit.open_storage().active_jobs()) == len(startit.jobs)
+    startit.close()
+
+def test_storage_sources_are_independent(tmpdir):
+    """
+    Test that crawling one category does not expire jobs of another.
+    """
+    storage = StartitStorage(str(tmpdir.join('jobs.db')))
+    python = 'https://startit.rs/poslovi/pretraga/python/'
+    django = 'https://startit.rs/poslovi/pretraga/django/'
+    first = ('A', 'Job A', 'https://startit.rs/poslovi/a/', '[]')
+    second = ('B', 'Job B', 'https://startit.rs/poslovi/b/', '[]')
+    storage.apply_crawl(python, [first])
+    assert storage.apply_crawl(django, [first, second]) == ([first, second], 0, [])
+    assert storage.apply_crawl(python, [first]) == ([], 0, [])
+    assert storage.active_jobs(python) == [first]
+    assert storage.active_jobs(django) == [first, second]
+    storage.close()
+
+def test_daemon_next_delay():
+    """
+    Test that the poll interval stays within the jitter.
+    """
+    daemon = StartitDaemon(
+        ['https://startit.rs/poslovi/pretraga/python/'], 'dummy@example.com',
+        interval=100, jitter=0.2
+    )
+    for _ in range(100):
+        assert 80 <= daemon.next_delay(daemon.urls[0]) <= 120
+
+def test_daemon_polls_until_stopped(tmpdir, monkeypatch):
+    """
+    Test that the daemon polls every category repeatedly, survives a failed
+    poll, and stops when asked to.
+    """
+    import threading
+
+    config = tmpdir.join('config')
+    config.write('email:spidy@example.com\npassword:secret')
+    daemon = StartitDaemon([
+        'https://startit.rs/poslovi/pretraga/python/',
+        'https://startit.rs/poslovi/pretraga/django/',
+    ], 'dummy@example.com', interval=0.01, jitter=0)
+    daemon.db_path = str(tmpdir.join('jobs.db'))
+    daemon.config_path = str(config)
+
+    polled = []
+    def poll(url):
+        polled.append(url)
+        if len(polled) == 1:
+            raise StartitException('Failed poll.')
+        if len(polled) >= 6:
+            daemon.stop()
+    monkeypatch.setattr(daemon, 'poll', poll)
+
+    thread = threading.Thread(target=daemon.run)
+    thread.start()
+    thread.join(5)
+    assert not thread.is_alive()
+    assert set(polled) == set(daemon.urls)
+    assert len(polled) >= 6
+
+def test_daemon_adapts_interval(tmpdir):
+    """
+    Test that polls finding changes shorten the interval, quiet polls
+    lengthen it, within bounds, and that intervals survive a restart.
+    """
+    daemon = StartitDaemon(
+        ['https://startit.rs/poslovi/pretraga/python/'], 'dummy@example.com',
+        interval=100, min_interval=40, max_interval=200
+    )
+    daemon.storage = StartitStorage(str(tmpdir.join('jobs.db')))
+    url = daemon.urls[0]
+    spider = Startit(url, 'dummy@example.com')
+
+    spider.stats['new'] = 1
+    assert daemon.adapt_interval(url, spider) == 50
+    assert daemon.adapt_interval(url, spider) == 40
+    spider.stats['new'] = 0
+    assert daemon.adapt_interval(url, spider) == 60
+    for _ in range(5):
+        daemon.adapt_interval(url, spider)
+    assert daemon.intervals[url] == 200
+
+    state = daemon.storage.load_poll(url)
+    assert (state['interval'], state['polls'], state['changes']) == (200, 8, 2)
+
+    restarted = StartitDaemon(
+        [url], 'dummy@example.com', interval=100, min_interval=40,
+        max_interval=200, jitter=0
+    )
+    restarted.storage = daemon.storage
+    restarted.restore_schedule()
+    assert restarted.next_delay(url) == 200
+    # The url was just polled, so it is not due before its interval passes.
+    due, _ = restarted.schedule[0]
+    assert due - time.monotonic() > 190
+
+    # Edited jobs are a change as well.
+    spider.stats['updated'] = 1
+    assert daemon.adapt_interval(url, spider) == 100
+    daemon.storage.close()
+
+class RecordingTransport(object):
+    """
+    Stand-in for StartitSMTPTransport, failing the first `failures` sends.
+    """
+
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.sent = []
+        self.closed = 0
+
+    def send(self, from_address, to_address, text):
+        if self.failures:
+            self.failures -= 1
+            raise OSError('Connection refused.')
+        self.sent.append((from_address, to_address, text))
+
+    def close(self):
+        self.closed += 1
+
+def test_notifier_digest():
+    """
+    Test that new jobs queued within the window are sent as one email per
+    recipient, and that other emails are not held back.
+    """
+    transport = RecordingTransport()
+    notifier = StartitNotifier(transport, 'spidy@example.com', window=60)
+    notifier.start()
+    notifier.notify_new_jobs('dummy@example.com', [('A', 'Job A', 'https://startit.rs/a/', '[]')])
+    notifier.notify_new_jobs('other@example.com', [('B', 'Job B', 'https://startit.rs/b/', '[]')])
+    notifier.notify_new_jobs('dummy@example.com', [('C', 'Job C', 'https://startit.rs/c/', '[]')])
+    notifier.send('dummy@example.com', 'Hello', 'Hello there.')
+    time.sleep(0.1)
+    assert [to for _, to, _ in transport.sent] == ['dummy@example.com']
+
+    notifier.close()
+    assert [to for _, to, _ in transport.sent] == \
+        ['dummy@example.com', 'dummy@example.com', 'other@example.com']
+    digest = email.message_from_string(transport.sent[1][2]) \
+        .get_payload()[0].get_payload(decode=True).decode('utf-8')
+    assert 'Job A' in digest and 'Job C' in digest and 'Job B' not in digest
+    assert notifier.sent == 3
+
+def test_notifier_digest_lists_updated_jobs():
+    """
+    Test that updated jobs are listed apart from new ones, and alone get
+    their own subject.
+    """
+    transport = RecordingTransport()
+    notifier = StartitNotifier(transport, 'spidy@example.com', window=60)
+    notifier.start()
+    notifier.notify_updated_jobs('dummy@example.com', [('B', 'Job B', 'https://startit.rs/b/', '[]')])
+    notifier.notify_new_jobs('dummy@example.com', [('A', 'Job A', 'https://startit.rs/a/', '[]')])
+    notifier.notify_updated_jobs('other@example.com', [('B', 'Job B', 'https://startit.rs/b/', '[]')])
+    notifier.close()
+
+    first, second = [email.message_from_string(text) for _, _, text in transport.sent]
+    assert first['Subject'] == StartitNotifier.NEW_JOBS_SUBJECT
+    body = first.get_payload()[0].get_payload(decode=True).decode('utf-8')
+    assert body.index('Job A') < body.index('Updated:') < body.index('Job B')
+    assert second['Subject'] == StartitNotifier.UPDATED_JOBS_SUBJECT
+
+def test_notifier_retries():
+    """
+    Test that a failed send is retried, reconnecting in between, and given up
+    after the last retry.
+    """
+    transport = RecordingTransport(failures=2)
+    notifier = StartitNotifier(transport, 'spidy@example.com', retries=2, backoff=0)
+    assert notifier.deliver('dummy@example.com', 'Subject', 'Body')
+    assert len(transport.sent) == 1 and transport.closed == 2
+
+    transport.failures = 3
+    assert not notifier.deliver('dummy@example.com', 'Subject', 'Body')
+    assert notifier.failed == 1
+
+def test_check_and_notify_uses_notifier(tmpdir):
+    """
+    Test that the welcome email goes through the spider's notifier.
+    """
+    transport = RecordingTransport()
+    startit = Startit('https://startit.rs/poslovi/pretraga/python/', 'dummy@example.com')
+    startit.db_path = str(tmpdir.join('jobs.db'))
+    startit.notifier = StartitNotifier(transport, 'spidy@example.com')
+    startit.notifier.start()
+    startit.check_and_notify(startit.iter_jobs())
+    startit.close()
+    assert len(transport.sent) == 1
+    assert 'Greetings' in transport.sent[0][2]
+
+def test_router_matches_filters():
+    """
+    Test that filters of the same kind are alternatives, that every kind a
+    subscriber has must match, and that subscribers without filters get all
+    jobs.
+    """
+    router = StartitRouter([
+        ('python@example.com', 'tag', 'Python'),
+        ('python@example.com', 'tag', 'Django'),
+        ('acme@example.com', 'company', 'Acme'),
+        ('acme@example.com', 'keyword', 'senior'),
+        ('all@example.com', None, None),
+    ])
+    python = ('Foo', 'Junior Developer', 'https://startit.rs/a/', '["django"]')
+    senior = ('ACME', 'Senior Developer', 'https://startit.rs/b/', '["java"]')
+    junior = ('Acme', 'Junior Developer', 'https://startit.rs/c/', '["python"]')
+    assert router.match(python) == {'python@example.com', 'all@example.com'}
+    assert router.match(senior) == {'acme@example.com', 'all@example.com'}
+    assert router.match(junior) == {'python@example.com', 'all@example.com'}
+
+    routed = router.route([python, senior, junior])
+    assert sorted(routed) == ['acme@example.com', 'all@example.com', 'python@example.com']
+    assert routed['python@example.com'] == [python, junior]
+
+    with pytest.raises(StartitException):
+        StartitRouter([('dummy@example.com', 'salary', '1000')])
+
+def test_storage_subscribers(tmpdir):
+    """
+    Test that adding a subscriber again replaces its filters, and that
+    subscription changes can be detected.
+    """
+    storage = StartitStorage(str(tmpdir.join('jobs.db')))
+    version = storage.subscriptions_version()
+    storage.add_subscriber('dummy@example.com', tags=['python'], keywords=['senior'])
+    storage.add_subscriber('all@example.com')
+    assert storage.subscriptions_version() != version
+    assert sorted(storage.subscriptions(), key=str) == [
+        ('all@example.com', None, None),
+        ('dummy@example.com', 'keyword', 'senior'),
+        ('dummy@example.com', 'tag', 'python'),
+    ]
+
+    storage.add_subscriber('dummy@example.com', companies=['Acme'])
+    storage.remove_subscriber('all@example.com')
+    assert storage.subscriptions() == [('dummy@example.com', 'company', 'Acme')]
+    storage.close()
+
+def test_check_and_notify_routes_to_subscribers(tmpdir):
+    """
+    Test that subscribers get new jobs matching their filters, besides the
+    spider's own email.
+    """
+    db_path = str(tmpdir.join('jobs.db'))
+    storage = StartitStorage(db_path)
+    storage.insert_jobs([('Old', 'Old job', 'https://startit.rs/old/', '[]')], 1,
+                        'https://startit.rs/poslovi/pretraga/python/')
+    storage.add_subscriber('all@example.com')
+    storage.add_subscriber('nobody@example.com', companies=['No such company'])
+
+    transport = RecordingTransport()
+    startit = Startit('https://startit.rs/poslovi/pretraga/python/', 'dummy@example.com')
+    startit.storage = storage
+    startit.router = StartitRouter.from_storage(storage)
+    startit.notifier = StartitNotifier(transport, 'spidy@example.com')
+    startit.notifier.start()
+    startit.check_and_notify(startit.iter_jobs())
+    startit.close()
+    assert sorted(to for _, to, _ in transport.sent) == \
+        ['all@example.com', 'dummy@example.com']
+
+@pytest.mark.parametrize('bloom_capacity', [0, 1000])
+def test_seen_index_claims_each_posting_once(tmpdir, bloom_capacity):
+    """
+    Test that a posting is claimed by the first category listing it, in
+    this run or a later one, and again once it is edited.
+    """
+    storage = StartitStorage(str(tmpdir.join('jobs.db')))
+    python = 'https://startit.rs/poslovi/pretraga/python/'
+    django = 'https://startit.rs/poslovi/pretraga/django/'
+    first = ('A', 'Job A', 'https://startit.rs/poslovi/a/', '[]')
+    second = ('B', 'Job B', 'https://startit.rs/poslovi/b/', '[]')
+    edited = ('A', 'Senior Job A', 'https://startit.rs/poslovi/a/', '[]')
+
+    seen = StartitSeenIndex(storage, bloom_capacity)
+    assert seen.claim([first, first], python) == [first]
+    assert seen.claim([first, second], django) == [second]
+
+    seen = StartitSeenIndex(storage, bloom_capacity)
+    assert seen.claim([first, second, edited], python) == [edited]
+    storage.close()
+
+def test_bloom_filter():
+    """
+    Test that added keys are always found, and others rarely.
+    """
+    bloom = StartitBloomFilter(1000, 0.01)
+    for key in range(1000):
+        bloom.add((key, key))
+    assert all((key, key) in bloom for key in range(1000))
+    assert sum((key, key) in bloom for key in range(1000, 11000)) < 300
+
+def test_check_and_notify_skips_postings_of_other_categories(tmpdir):
+    """
+    Test that postings another category handled are neither notified about
+    again nor fetched details for.
+    """
+    python = 'https://startit.rs/poslovi/pretraga/python/'
+    storage = StartitStorage(str(tmpdir.join('jobs.db')))
+    storage.insert_jobs([('Old', 'Old job', 'https://startit.rs/old/', '[]')], 1, python)
+    seen = StartitSeenIndex(storage)
+    rows = [job.as_row() for job in Startit(python, 'dummy@example.com').iter_jobs()]
+    seen.claim(rows[1:], 'https://startit.rs/poslovi/pretraga/django/')
+
+    startit = Startit(python, 'dummy@example.com')
+    startit.storage = storage
+    startit.seen = seen
+    notified = []
+    startit.notify_master_about_new_jobs = notified.extend
+    startit.check_and_notify(startit.iter_jobs())
+    assert notified == rows[:1]
+    assert startit.stats['new'] == len(rows)
+    assert startit.stats['duplicates'] == len(rows) - 1
+    storage.close()
+
+def test_benchmark_stages():
+    """
+    Test that the benchmark suite times every stage of a generated page.
+    """
+    from bench_startit import STAGES, run_benchmarks, synthetic_page
+    assert synthetic_page(20) == synthetic_page(20)
+    try:
+        report = run_benchmarks([20], backends=['lxml'], repeat=1)
+    finally:
+        install_opener(mock_opener)
+    result = report['results'][-1]
+    assert result['page'] == 'synthetic-20' and result['ads'] == 20
+    assert list(result['stages']) == list(STAGES)
+    assert all(stage['peak-bytes'] > 0 for stage in result['stages'].values())
+    json.dumps(report)
+
+def test_metrics_report(tmpdir):
+    """
+    Test that a watched spider times each stage, counts ads by type, rows
+    and emails, and that the record of the run is handed to the hooks once
+    the emails are sent.
+    """
+    records = []
+    metrics = StartitMetrics([records.append])
+    transport = RecordingTransport()
+    startit = Startit('https://startit.rs/poslovi/pretraga/python/', 'dummy@example.com')
+    startit.db_path = str(tmpdir.join('jobs.db'))
+    startit.notifier = StartitNotifier(transport, 'spidy@example.com')
+    startit.notifier.start()
+    metrics.watch(startit)
+    startit.check_and_notify(startit.iter_jobs())
+    startit.close()
+
+    record, = records
+    assert record['pages'] == 1 and record['bytes'] > 0 and record['skipped'] == 0
+    assert record['premium'] + record['standard'] + record['mini'] == record['new']
+    assert record['rows'] == record['new'] > 0
+    assert record['emails'] == record['emails-sent'] == 1
+    assert list(record['seconds']) == ['fetch', 'parse', 'extract', 'sqlite', 'smtp']
+    assert all(spent > 0 for spent in record['seconds'].values())
+    assert record['categories'][0]['url'] == startit.url
+    assert metrics.report()['categories'] == []
+
+def test_metrics_disabled():
+    """
+    Test that a spider which is not watched keeps counting, but not timing.
+    """
+    startit = Startit('https://startit.rs/poslovi/pretraga/python/', 'dummy@example.com')
+    jobs = list(startit.iter_jobs())
+    assert startit.timings is None
+    assert startit.stats['premium'] + startit.stats['standard'] + startit.stats['mini'] == len(jobs)
+
+def test_metrics_exporters(tmpdir):
+    """
+    Test that records are appended as JSON lines, and that the Prometheus
+    textfile holds the last record.
+    """
+    json_path = str(tmpdir.join('startit.json'))
+    prom_path = str(tmpdir.join('startit.prom'))
+    metrics = StartitMetrics([StartitJSONLog(json_path), StartitPrometheusTextfile(prom_path)])
+    startit = Startit('https://startit.rs/poslovi/pretraga/python/', 'dummy@example.com')
+    metrics.watch(startit)
+    list(startit.iter_jobs())
+    metrics.report()
+    metrics.report()
+
+    with open(json_path) as f:
+        lines = [json.loads(line) for line in f]
+    assert len(lines) == 2 and lines[0]['pages'] == 1 and lines[1]['pages'] == 0
+    with open(prom_path) as f:
+        text = f.read()
+    assert '# TYPE startit_stage_seconds gauge' in text
+    assert 'startit_stage_seconds{stage="fetch"}' in text
+    assert 'startit_pages{' not in text
+    assert 'startit_emails_sent 0' in text
+
+def test_storage_jobs_with_tags(tmpdir):
+    """
+    Test that tags of jobs from an old database are normalized, that new jobs
+    are tagged as they are written, and that tag queries use the indexes.
+    """
+    db_path = str(tmpdir.join('jobs.db'))
+    conn = sqlite3.connect(db_path)
+    conn.execute("""
+        CREATE TABLE jobs (
+          CompanyTitle TEXT, JobTitle TEXT, Url TEXT, Tags BLOB, Active TEXT,
+          FirstCrawled TEXT
+         )
+    """)
+    conn.executemany('INSERT INTO jobs VALUES(?,?,?,?,?,?)', [
+        ('A', 'Old', 'https://startit.rs/a/', json.dumps(['Python', 'Django']), 0, ''),
+        ('B', 'Old', 'https://startit.rs/b/', json.dumps(['python']), 1, ''),
+    ])
+    conn.commit()
+    conn.close()
+
+    storage = StartitStorage(db_path)
+    storage.insert_jobs([
+        ('C', 'New', 'https://startit.rs/c/', json.dumps(['django', 'python'])),
+        ('D', 'New', 'https://startit.rs/d/', json.dumps(['java'])),
+    ], True)
+    urls = lambda jobs: [job[2] for job in jobs]
+    assert urls(storage.jobs_with_tags(['python'])) == \
+        ['https://startit.rs/c/', 'https://startit.rs/b/']
+    assert urls(storage.jobs_with_tags(['DJANGO', 'python'], active=None)) == \
+        ['https://startit.rs/c/', 'https://startit.rs/a/']
+    assert urls(storage.jobs_with_tags(['django'], active=False)) == ['https://startit.rs/a/']
+    assert storage.jobs_with_tags(['go']) == []
+
+    plan = ' '.join(row[-1] for row in storage.conn.execute(
+        'EXPLAIN QUERY PLAN SELECT JobId FROM job_tags JOIN tags ON tags.Id=TagId '
+        'WHERE tags.Name IN (?)', ('python',)
+    ))
+    assert 'SCAN' not in plan
+    storage.close()
+
+def test_detail_fetcher_parse():
+    """
+    Test that details are taken from JobPosting data, or from the markup.
+    """
+    fetcher = StartitDetailFetcher()
+    posting = json.dumps({
+        '@type' : 'JobPosting',
+        'description' : '<p>Work on <b>Django</b> apps.</p>',
+        'jobLocation' : {'address' : {'addressLocality' : 'Beograd'}},
+    })
+    page = '<html><head><script type="application/ld+json">%s</script></head></html>' % posting
+    assert fetcher.parse(page.encode('utf-8'), 'Senior Python Developer') == \
+        ('Work on Django apps.', 'Beograd', 'senior')
+
+    page = '<html><body><article> Junior  or medior. </article>' \
+        '<span class="location">Novi Sad</span></body></html>'
+    assert fetcher.parse(page, 'Python Developer') == \
+        ('Junior or medior.', 'Novi Sad', 'junior')
+    assert fetcher.parse('', 'Tech Lead') == (None, None, 'lead')
+
+def test_detail_fetcher_caches_details(tmpdir, monkeypatch):
+    """
+    Test that detail pages are fetched once, across runs, and that jobs which
+    can not be fetched are tried again.
+    """
+    fetched = []
+    def fetch_body(url):
+        fetched.append(url)
+        if url.endswith('/broken/'):
+            raise HTTPError(url, 500, 'Server Error', Message(), None)
+        return b'<html><body><article>About %s</article></body></html>' % url.encode(), 'text/html'
+
+    fetcher = StartitDetailFetcher(rate=1000)
+    monkeypatch.setattr(fetcher, 'fetch_body', fetch_body)
+    storage = StartitStorage(str(tmpdir.join('jobs.db')))
+    jobs = [
+        ('A', 'Junior Developer', 'https://startit.rs/a/', '[]'),
+        ('B', 'Developer', 'https://startit.rs/broken/', '[]'),
+        ('C', 'Developer', 'mailto:jobs@example.com', '[]'),
+    ]
+    details = fetcher.fetch(storage, jobs)
+    assert details == {'https://startit.rs/a/' : ('About https://startit.rs/a/', None, 'junior')}
+
+    jobs.append(('D', 'Developer', 'https://startit.rs/d/', '[]'))
+    assert len(fetcher.fetch(storage, jobs)) == 2
+    assert sorted(fetched) == [
+        'https://startit.rs/a/', 'https://startit.rs/broken/',
+        'https://startit.rs/broken/', 'https://startit.rs/d/',
+    ]
+    storage.close()
+
+def test_token_bucket():
+    """
+    Test that the bucket lets a burst through, then paces requests.
+    """
+    bucket = StartitTokenBucket(rate=20, burst=2)
+    start = time.monotonic()
+    for _ in range(4):
+        bucket.acquire()
+    assert 0.08 < time.monotonic() - start < 0.5
+
+class LocalHttpHandler(BaseHTTPRequestHandler):
+    """
+    Keep-alive server for StartitHTTPClient: /page is gzipped if asked for,
+    /flaky fails every other request, /slow stalls.
+    """
+    protocol_version = 'HTTP/1.1'
+    body = b'<html>%s</html>' % (b'job ' * 1000)
+    flaky = 0
+
+    def do_GET(self):
+        status, headers, body = 200, {}, self.body
+        if self.path == '/flaky':
+            LocalHttpHandler.flaky += 1
+            if LocalHttpHandler.flaky % 2:
+                status, body = 503, b'Busy'
+        elif self.path == '/slow':
+            time.sleep(0.5)
+        elif self.path != '/page':
+            status, body = 404, b'Not found'
+        if status == 200 and 'gzip' in self.headers.get('Accept-Encoding', ''):
+            body = gzip.compress(body)
+            headers['Content-Encoding'] = 'gzip'
+
+        self.send_response(status)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def local_server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), LocalHttpHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield 'http://127.0.0.1:%d' % server.server_address[1]
+    server.shutdown()
+    server.server_close()
+
+def test_http_client_keeps_connections_alive(local_server):
+    """
+    Test that requests to a host share one connection, and that gzipped
+    bodies are decoded, whole or in chunks.
+    """
+    client = StartitHTTPClient()
+    assert client.open(Request(local_server + '/page')).read() == LocalHttpHandler.body
+
+    response = client.open(Request(local_server + '/page'))
+    chunks = iter(lambda: response.read(64), b'')
+    assert b''.join(chunks) == LocalHttpHandler.body
+    assert response.info()['Content-Encoding'] == 'gzip'
+
+    assert (client.requests, client.connections, client.reused) == (2, 1, 1)
+    assert client.saved > len(LocalHttpHandler.body)
+    client.close()
+
+    record = StartitMetrics().report(client=client)
+    assert record['http-reused'] == 1 and record['http-saved'] == client.saved
+
+def test_http_client_retries_and_times_out(local_server):
+    """
+    Test that server errors are retried, client errors are not, and a
+    stalled response times out.
+    """
+    client = StartitHTTPClient(read_timeout=0.1, retries=1, backoff=0)
+    assert client.open(Request(local_server + '/flaky')).read() == LocalHttpHandler.body
+    assert client.retried == 1
+
+    with pytest.raises(HTTPError) as error:
+        client.open(Request(local_server + '/missing'))
+    assert error.value.code == 404 and client.retried == 1
+
+    with pytest.raises(URLError):
+        client.open(Request(local_server + '/slow'))
+    assert client.retried == 2
+    client.close()
+
+def test_response_cache_evicts_least_recently_used(tmpdir):
+    """
+    Test that bodies are stored compressed, and that the least recently used
+    responses go first once the cache is full.
+    """
+    body = b'<html>%s</html>' % (b'job ' * 1000)
+    cache = StartitResponseCache(str(tmpdir), max_bytes=100)
+    cache.put('https://startit.rs/a/', body, '"a"')
+    size = cache.size
+    assert 0 < size < len(body) // 10
+    assert cache.get('https://startit.rs/a/') == (body, '"a"', None)
+
+    cache.max_bytes = size * 2
+    cache.put('https://startit.rs/b/', body)
+    cache.get('https://startit.rs/a/')
+    cache.put('https://startit.rs/c/', body)
+    assert cache.get('https://startit.rs/b/') is None
+    assert cache.get('https://startit.rs/a/') is not None
+    assert len(tmpdir.listdir(lambda path: path.ext == '.gz')) == 2
+    cache.close()
+
+    cache = StartitResponseCache(str(tmpdir))
+    assert cache.size == size * 2
+    cache.close()
+
+def test_response_cache_revalidates_and_serves_offline(tmpdir):
+    """
+    Test that a cached response stands in for the body when the server says
+    it did not change, and is read only then, and that offline, pages come
+    from the cache only.
+    """
+    url = 'https://startit.rs/poslovi/pretraga/python/'
+    startit = Startit(url, 'dummy@example.com')
+    startit.cache = StartitResponseCache(str(tmpdir))
+    read = []
+    get = startit.cache.get
+    startit.cache.get = lambda url: read.append(url) or get(url)
+    body = startit.fetch_page(url)
+    assert read == []
+    assert startit.cache.validators(url) == {'etag' : MOCK_ETAG, 'last-modified' : None}
+    # Only the server's 304 makes the cached body worth reading.
+    assert startit.fetch_page(url) == body.encode('utf-8')
+    assert read == [url]
+    assert startit.stats['pages'] == 2 and startit.stats['bytes'] == len(body)
+    startit.close()
+
+    startit = Startit(url, 'dummy@example.com')
+    startit.cache = StartitResponseCache(str(tmpdir), offline=True)
+    startit.conditional = False
+    assert len(list(startit.iter_jobs())) > 0
+    assert startit.stats['bytes'] == 0
+    with pytest.raises(StartitException):
+        startit.fetch_page('https://startit.rs/poslovi/pretraga/go/')
+    startit.close()
+
+def test_stream_backend_matches_lxml(tmpdir, monkeypatch):
+    """
+    Test that streaming extracts the same jobs as the lxml backend, and that
+    an unchanged page is skipped without being read.
+    """
+    url = 'https://startit.rs/poslovi/pretraga/python/'
+    expected = list(Startit(url, 'dummy@example.com', backend='lxml').iter_jobs())
+    startit = Startit(url, 'dummy@example.com', backend='stream')
+    jobs = list(startit.iter_jobs())
+    assert sorted(jobs, key=repr) == sorted(expected, key=repr)
+    assert startit.stats['pages'] == 1 and startit.stats['bytes'] > 0
+    assert startit.changed() and startit.stats['pages'] == 1
+
+    db_path = str(tmpdir.join('jobs.db'))
+    first_crawl(db_path, monkeypatch)
+    startit = Startit(url, 'dummy@example.com', backend='stream')
+    startit.db_path = db_path
+    startit.check_and_notify(startit.iter_jobs())
+    assert startit.stats['skipped'] and startit.stats['pages'] == 0
+
+def test_stream_backend_discards_parsed_ads():
+    """
+    Test that ads are yielded while the page is being fed, and that nothing
+    parsed before an ad is kept.
+    """
+    from bench_startit import synthetic_page
+    body = synthetic_page(500)
+    chunks = [body[start:start + 4096] for start in range(0, len(body), 4096)]
+    fed = []
+    def feed():
+        for chunk in chunks:
+            fed.append(chunk)
+            yield chunk
+
+    backend = StartitStreamBackend()
+    divs = backend.iter_stream(feed())
+    first = next(divs)
+    assert len(fed) < len(chunks)
+    assert backend.extract_job(first).url == 'https://startit.rs/poslovi/premium-0/'
+
+    count = 1
+    for packed in divs:
+        # Ads before the current one are gone; only those parsed from the
+        # same chunk are ahead of it.
+        assert len(packed['job-post'].getparent()) < 50
+        count += 1
+    assert count == 500
+
+def test_batch_parser(tmpdir):
+    """
+    Test that pages parsed by worker processes give the same jobs, and that
+    pages of a category are merged for a single diff.
+    """
+    url = 'https://startit.rs/poslovi/pretraga/python/'
+    with open('example_page_python.html', 'rb') as f:
+        body = f.read()
+    expected = list(Startit(url, 'dummy@example.com', backend='lxml').iter_jobs())
+
+    storage = StartitStorage(str(tmpdir.join('jobs.db')))
+    with StartitBatchParser(max_workers=2) as batch:
+        (jobs, next_url, ads), = batch.parse([(url, body)])
+        assert jobs == expected and next_url is None
+        assert sum(ads.values()) == len(jobs)
+
+        other = 'https://startit.rs/poslovi/pretraga/django/'
+        applied = batch.apply(storage, [(url, body), (other, body), (url, body)])
+    assert list(applied) == [url, other]
+    assert len(applied[url][0]) == len(expected) and applied[url][1] == 0
+    storage.close()
+
+def test_crawler_parses_in_processes():
+    """
+    Test that the crawler can hand pages to worker processes.
+    """
+    url = 'https://startit.rs/poslovi/pretraga/python/'
+    crawler = StartitCrawler([url], 'dummy@example.com', backend='lxml', processes=1)
+    crawler.crawl()
+    spider, = crawler.spiders
+    expected = list(Startit(url, 'dummy@example.com', backend='lxml').iter_jobs())
+    assert list(spider.jobs) == expected
+    assert spider.stats['premium'] + spider.stats['standard'] + spider.stats['mini'] == len(expected)
+    assert spider.changed() and spider.stats['pages'] == 1
+
+def test_backfill_replays_snapshots_in_order(tmpdir):
+    """
+    Test that archived pages are replayed by capture time, dating when jobs
+    appeared and expired, and that a later run only loads new snapshots.
+    """
+    from bench_startit import synthetic_page
+    python = 'https://startit.rs/poslovi/pretraga/python/'
+    snapshots = tmpdir.mkdir('snapshots').mkdir('python')
+    snapshots.join('20190302T120000.html').write_binary(synthetic_page(4))
+    snapshots.join('20190301T120000.html').write_binary(synthetic_page(6))
+
+    storage = StartitStorage(str(tmpdir.join('jobs.db')))
+    stats = StartitBackfill(storage, processes=1).run(str(tmpdir.join('snapshots')))
+    assert (stats['loaded'], stats['captures'], stats['new'], stats['expired']) == (2, 2, 6, 2)
+
+    dates = dict(
+        (url, (first, deactivated)) for url, first, deactivated in storage.conn.execute(
+            'SELECT Url, FirstCrawled, Deactivated FROM jobs WHERE Source=?', (python,)
+        )
+    )
+    assert dates['https://startit.rs/poslovi/mini-3/'] == ('2019-03-01 12:00:00', None)
+    assert dates['https://startit.rs/poslovi/mini-5/'] == \
+        ('2019-03-01 12:00:00', '2019-03-02 12:00:00')
+
+    snapshots.join('20190303T120000.html').write_binary(synthetic_page(6))
+    with tarfile.open(str(tmpdir.join('snapshots.tar.gz')), 'w:gz') as tar:
+        tar.add(str(tmpdir.join('snapshots')), 'snapshots')
+    stats = StartitBackfill(storage, processes=1).run(str(tmpdir.join('snapshots.tar.gz')))
+    assert (stats['snapshots'], stats['loaded'], stats['captures'], stats['new']) == (3, 1, 1, 2)
+    assert len(storage.active_jobs(python)) == 6
+    storage.close()
+
+def test_backfill_dates_undated_pages_as_one_capture(tmpdir):
+    """
+    Test that pages of a capture without a capture time in their names are
+    dated by the earliest modification time among them, in a directory and
+    in a tarball alike.
+    """
+    from bench_startit import synthetic_page
+    python = 'https://startit.rs/poslovi/pretraga/python/'
+    snapshots = tmpdir.mkdir('snapshots').mkdir('python')
+    first, second = snapshots.join('index.html'), snapshots.join('index-2.html')
+    first.write_binary(synthetic_page(6))
+    second.write_binary(synthetic_page(4).replace(b'/poslovi/', b'/poslovi/p2-'))
+    os.utime(str(first), (0, time.mktime((2019, 3, 1, 12, 0, 0, 0, 0, -1))))
+    os.utime(str(second), (0, time.mktime((2019, 3, 1, 12, 0, 5, 0, 0, -1))))
+    with tarfile.open(str(tmpdir.join('snapshots.tar')), 'w') as tar:
+        tar.add(str(tmpdir.join('snapshots')), 'snapshots')
+
+    for path in ('snapshots', 'snapshots.tar'):
+        storage = StartitStorage(str(tmpdir.join(path + '.db')))
+        stats = StartitBackfill(storage, processes=1).run(str(tmpdir.join(path)))
+        assert (stats['loaded'], stats['captures'], stats['new'], stats['expired']) == (2, 1, 10, 0)
+        assert storage.conn.execute(
+            'SELECT DISTINCT FirstCrawled FROM jobs WHERE Source=?', (python,)
+        ).fetchall() == [('2019-03-01 12:00:00',)]
+        storage.close()
+
+def test_backfill_replays_history_before_live_jobs(tmpdir):
+    """
+    Test that captures older than live jobs are replayed as their history,
+    that newer ones are kept but not replayed, and that undated snapshots
+    are dated by modification time.
+    """
+    from bench_startit import synthetic_page
+    python = 'https://startit.rs/poslovi/pretraga/python/'
+    snapshots = tmpdir.mkdir('snapshots').mkdir('python')
+    snapshots.join('20190301T120000.html').write_binary(synthetic_page(6))
+    snapshots.join('20190302T120000.html').write_binary(synthetic_page(4))
+    snapshots.join('20190304T120000.html').write_binary(synthetic_page(2))
+    undated = snapshots.join('index.html')
+    undated.write_binary(synthetic_page(3))
+    os.utime(str(undated), (0, time.mktime((2019, 3, 1, 6, 0, 0, 0, 0, -1))))
+
+    storage = StartitStorage(str(tmpdir.join('jobs.db')))
+    live = [job.as_row() for job in parse_page_jobs(python, synthetic_page(3))[0]]
+    storage.apply_crawl(python, live, '2019-03-03 12:00:00')
+    storage.apply_crawl(python, live[:2], '2019-03-05 12:00:00')
+
+    stats = StartitBackfill(storage, processes=1).run(str(tmpdir.join('snapshots')))
+    assert (stats['loaded'], stats['captures'], stats['skipped']) == (4, 3, 1)
+
+    dates = {}
+    for url, first, deactivated in storage.conn.execute(
+        'SELECT Url, FirstCrawled, Deactivated FROM jobs WHERE Source=? ORDER BY Id',
+        (python,)
+    ):
+        dates.setdefault(url, []).append((first, deactivated))
+    assert dates['https://startit.rs/poslovi/mini-0/'] == [
+        ('2019-03-03 12:00:00', None),
+        ('2019-03-01 06:00:00', '2019-03-01 12:00:00'),
+    ]
+    assert dates['https://startit.rs/poslovi/mini-1/'] == [
+        ('2019-03-03 12:00:00', None),
+        ('2019-03-01 06:00:00', '2019-03-03 12:00:00'),
+    ]
+    assert dates['https://startit.rs/poslovi/mini-5/'] == \
+        [('2019-03-01 12:00:00', '2019-03-02 12:00:00')]
+    assert len(storage.active_jobs(python)) == 2
+    assert storage.snapshot_captures(python) == ['2019-03-04 12:00:00']
+    assert storage.snapshot_jobs(python, '2019-03-04 12:00:00')
+    storage.close()
+
+def search(storage, **filters):
+    query, params = StartitStorage.search_query(**filters)
+    return [row[3] for row in storage.conn.execute(query, params)]
+
+def test_storage_search_query(tmpdir):
+    """
+    Test that the full-text index follows inserted and edited jobs, and
+    that filters combine.
+    """
+    storage = StartitStorage(str(tmpdir.join('jobs.db')))
+    python = 'https://startit.rs/poslovi/pretraga/python/'
+    first = ('Acme', 'Python Developer', 'https://startit.rs/poslovi/a/', '["python", "django"]')
+    second = ('Initech', 'Backend Engineer', 'https://startit.rs/poslovi/b/', '["go"]')
+    storage.insert_jobs([('Old', 'Python Intern', 'https://startit.rs/poslovi/old/', '[]')], 0, python)
+    storage.apply_crawl(python, [first, second])
+
+    assert search(storage, keywords='python') == [first[2], 'https://startit.rs/poslovi/old/']
+    assert search(storage, keywords='pyth*', active=True) == [first[2]]
+    assert search(storage, keywords='django') == [first[2]]
+    assert search(storage, tags=['Python', 'django'], company='ACME') == [first[2]]
+    ids = [row[0] for row in storage.conn.execute(*StartitStorage.search_query())]
+    assert search(storage, before=ids[1]) == ['https://startit.rs/poslovi/old/']
+
+    storage.apply_crawl(python, [first, ('Initech', 'Platform Engineer', second[2], '["go"]')])
+    assert search(storage, keywords='backend') == []
+    assert search(storage, keywords='platform') == [second[2]]
+    storage.close()
+
+def test_query_service_pages_and_caches(tmpdir):
+    """
+    Test that the service pages through jobs with a cursor, answers hot
+    queries from its cache, and drops the cache once the database changes.
+    """
+    db_path = str(tmpdir.join('jobs.db'))
+    storage = StartitStorage(db_path)
+    python = 'https://startit.rs/poslovi/pretraga/python/'
+    jobs = [
+        ('Acme', 'Python Developer %d' % i, 'https://startit.rs/poslovi/%d/' % i, '["python"]')
+        for i in range(5)
+    ]
+    storage.apply_crawl(python, jobs)
+
+    service = StartitQueryService(db_path, port=0)
+    threading.Thread(target=service.serve_forever, daemon=True).start()
+    base = 'http://%s:%d/jobs' % service.address
+
+    def get(query):
+        return json.loads(urlopen(base + query, timeout=5).read().decode('utf-8'))
+
+    try:
+        urls, cursor = [], ''
+        while cursor is not None:
+            page = get('?q=python&limit=2&cursor=%s' % cursor)
+            urls.extend(job['url'] for job in page['jobs'])
+            cursor = page['next']
+        assert urls == [job[2] for job in reversed(jobs)]
+        assert service.misses == 3
+
+        assert get('?q=python&limit=2') == get('?limit=2&q=python')
+        assert service.hits == 2
+
+        storage.apply_crawl(python, jobs[1:])
+        assert get('?q=python&active=0')['jobs'][0]['url'] == jobs[0][2]
+        assert service.misses == 4
+
+        with pytest.raises(HTTPError) as error:
+            urlopen(base + '?limit=0', timeout=5)
+        assert error.value.code == 400
+    finally:
+        service.shutdown()
+        storage.close()
+
+def test_writer_groups_crawls(tmpdir):
+    """
+    Test that crawls queued while the writer is busy are applied together,
+    and that crawls from many threads all land.
+    """
+    db_path = str(tmpdir.join('jobs.db'))
+    writer = StartitWriter(db_path, max_batch=8)
+    sources = ['https://startit.rs/poslovi/pretraga/c%d/' % i for i in range(8)]
+    futures = [
+        writer.submit(source, [('A', 'Job', source + 'job/', '[]')])
+        for source in sources
+    ]
+    writer.start()
+    assert [len(future.result()[0]) for future in futures] == [1] * 8
+    assert writer.transactions == 1
+
+    def crawl(source):
+        for i in range(10):
+            writer.apply_crawl(source, [('A', 'Job %d' % i, source + 'job/', '[]')])
+
+    threads = [threading.Thread(target=crawl, args=(source,)) for source in sources]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert writer.applied == 88 and writer.transactions <= 81
+    writer.close()
+
+    storage = StartitStorage(db_path)
+    assert all(
+        storage.active_jobs(source) == [('A', 'Job 9', source + 'job/', '[]')]
+        for source in sources
+    )
+    storage.close()
+
+def test_writer_decides_first_crawls_of_upgraded_database(tmpdir):
+    """
+    Test that categories checked at once through a writer on a database
+    with jobs from before sources were kept do not all take themselves for
+    crawled before: only the one claiming the old jobs notifies.
+    """
+    db_path = str(tmpdir.join('jobs.db'))
+    conn = sqlite3.connect(db_path)
+    conn.executescript('''
+        CREATE TABLE jobs (
+          CompanyTitle TEXT, JobTitle TEXT, Url TEXT, Tags BLOB,
+          Active TEXT, FirstCrawled TEXT
+        );
+    ''')
+    conn.execute(
+        'INSERT INTO jobs VALUES(?,?,?,?,?,?)',
+        ('Old', 'Old job', 'https://startit.rs/poslovi/old/', json.dumps([]), False, '')
+    )
+    conn.commit()
+    conn.close()
+
+    storage = StartitStorage(db_path)
+    writer = StartitWriter(db_path, max_batch=2)
+    jobs = list(Startit('https://startit.rs/poslovi/pretraga/python/', 'dummy@example.com').iter_jobs())
+    notified = []
+    spiders = []
+    for category in ('python', 'django'):
+        spider = Startit('https://startit.rs/poslovi/pretraga/%s/' % category, 'dummy@example.com')
+        spider.storage = storage
+        spider.writer = writer
+        spider.conditional = False
+        spider.notify_master_about_new_jobs = lambda new_jobs, url=spider.url: notified.append(url)
+        spiders.append(spider)
+    # Both crawls are queued before the writer starts, so they are applied
+    # in one transaction.
+    threads = [
+        threading.Thread(target=spider.check_and_notify, args=(jobs,))
+        for spider in spiders
+    ]
+    for thread in threads:
+        thread.start()
+    while writer.queue.qsize() < 2:
+        time.sleep(0.01)
+    writer.start()
+    for thread in threads:
+        thread.join()
+    writer.close()
+
+    assert writer.transactions == 1
+    assert len(notified) == 1
+    assert all(spider.stats['new'] == len(jobs) for spider in spiders)
+    storage.close()
+
+def test_writer_groups_side_writes(tmpdir):
+    """
+    Test that writes to the side tables share the crawls' transactions, and
+    return what the storage's methods do.
+    """
+    db_path = str(tmpdir.join('jobs.db'))
+    writer = StartitWriter(db_path)
+    source = 'https://startit.rs/poslovi/pretraga/python/'
+    url = source + 'job/'
+    futures = [
+        writer.submit(source, [('A', 'Job', url, '[]')]),
+        writer.write('save_validators', (source, MOCK_ETAG, None, 'hash')),
+        writer.write('save_details', [(url, 'Description', 'Beograd', 'Senior')]),
+        writer.write('mark_seen', [(job_fingerprint(url), 1)], source),
+        writer.write('record_poll', source, 60, True),
+    ]
+    writer.start()
+    assert [future.result() for future in futures] == \
+        [([('A', 'Job', url, '[]')], 0, []), None, None, None, (1, 1)]
+    assert writer.transactions == 1 and writer.applied == 5
+    writer.close()
+
+    storage = StartitStorage(db_path)
+    assert storage.load_validators(source)['etag'] == MOCK_ETAG
+    assert storage.load_details([url]) == {url : ('Description', 'Beograd', 'Senior')}
+    assert storage.has_seen((job_fingerprint(url), 1))
+    storage.close()
+
+def first_run(db_path, source):
+    storage = StartitStorage(db_path)
+    storage.apply_crawl(source, [('A', 'Job', source + 'job/', '[]')])
+    storage.close()
+    return source
+
+def test_storage_concurrent_first_runs(tmpdir):
+    """
+    Test that processes creating the same database at once keep each
+    other's jobs.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    db_path = str(tmpdir.join('jobs.db'))
+    sources = ['https://startit.rs/poslovi/pretraga/c%d/' % i for i in range(4)]
+    with ProcessPoolExecutor(max_workers=4) as executor:
+        list(executor.map(first_run, [db_path] * len(sources), sources))
+    storage = StartitStorage(db_path)
+    assert sorted(row[2] for row in storage.active_jobs()) == \
+        sorted(source + 'job/' for source in sources)
+    storage.close()
+
+def test_check_and_notify_through_writer(tmpdir):
+    """
+    Test that a spider with a writer stores its crawl through it, and that
+    the greeting is still sent once.
+    """
+    db_path = str(tmpdir.join('jobs.db'))
+    # As in StartitCrawler, the spiders' storage is opened first, so it is
+    # the one which creates the database.
+    storage = StartitStorage(db_path)
+    writer = StartitWriter(db_path).start()
+    greeted = []
+    for _ in range(2):
+        startit = Startit('https://startit.rs/poslovi/pretraga/python/', 'dummy@example.com')
+        startit.storage = storage
+        startit.conditional = False
+        startit.writer = writer
+        startit.send_welcome_email = lambda: greeted.append(True)
+        startit.check_and_notify(startit.iter_jobs())
+    assert startit.stats['new'] == 0 and startit.stats['expired'] == 0
+    assert writer.applied == 2 and greeted == [True]
+    assert len(storage.active_jobs()) == len(list(startit.iter_jobs()))
+    writer.close()
+    storage.close()